@@ -0,0 +1,306 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+# See LICENSE file in the project root for full license information.
+"""
+Local stand-ins for the Azure AI inference and Azure AI Search services.
+
+The server implements the subset of the REST APIs, used by the application:
+
+- ``POST /models/chat/completions``: streams ``response_tokens`` tokens after ``first_token_latency``
+  seconds at ``tokens_per_second`` rate.
+- ``POST /models/embeddings``: returns the deterministic embeddings of the inputs after ``embedding_latency``.
+- ``/indexes``: creates and gets the index, stores the uploaded documents and returns
+  the top documents for the vector queries after ``search_latency``.
+
+The services accept any API key, so the application should be started with
+AZURE_AI_INFERENCE_KEY and AZURE_AI_SEARCH_KEY set. The Azure AI Search client accepts
+only https endpoints, so the server is usually started with the self-signed certificate,
+made by make_certificate, which the application trusts through the SSL_CERT_FILE variable.
+"""
+import argparse
+import asyncio
+import datetime
+import hashlib
+import ipaddress
+import json
+import math
+import os
+import random
+import re
+import ssl
+import time
+import uuid
+from typing import Any, Optional
+
+from aiohttp import web
+
+_INDEX_PATH = re.compile(r"^/indexes(?:\('(?P<name>[^']+)'\))?(?P<operation>/.*)?$")
+
+
+def make_certificate(directory: str) -> tuple[str, str]:
+    """
+    Write the self-signed certificate for localhost and 127.0.0.1.
+
+    :param directory: The directory to write the certificate and key files to.
+    :return: The tuple of the certificate and key file paths.
+    """
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import ec
+    from cryptography.x509.oid import NameOID
+
+    key = ec.generate_private_key(ec.SECP256R1())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, 'localhost')])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    certificate = (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(name)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - datetime.timedelta(minutes=5))
+        .not_valid_after(now + datetime.timedelta(days=1))
+        .add_extension(x509.SubjectAlternativeName([
+            x509.DNSName('localhost'), x509.IPAddress(ipaddress.ip_address('127.0.0.1'))]), critical=False)
+        .add_extension(x509.BasicConstraints(ca=True, path_length=None), critical=True)
+        .sign(key, hashes.SHA256())
+    )
+    certfile = os.path.join(directory, 'fake_services.crt')
+    keyfile = os.path.join(directory, 'fake_services.key')
+    with open(certfile, 'wb') as fp:
+        fp.write(certificate.public_bytes(serialization.Encoding.PEM))
+    with open(keyfile, 'wb') as fp:
+        fp.write(key.private_bytes(
+            serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()))
+    return certfile, keyfile
+
+
+class FakeServices:
+    """
+    The state and request handlers of the fake services.
+
+    :param embedding_latency: The time in seconds to answer the embedding request.
+    :param search_latency: The time in seconds to answer the search request.
+    :param first_token_latency: The time in seconds before the first streamed token.
+    :param tokens_per_second: The rate of streamed tokens after the first one.
+    :param response_tokens: The number of tokens in the chat response.
+    :param dimensions: The number of dimensions in the embedding, if the request does not set it.
+    """
+
+    def __init__(
+            self,
+            embedding_latency: float = 0.02,
+            search_latency: float = 0.01,
+            first_token_latency: float = 0.3,
+            tokens_per_second: float = 50.,
+            response_tokens: int = 100,
+            dimensions: int = 100,
+        ) -> None:
+        """Constructor."""
+        if tokens_per_second <= 0:
+            raise ValueError("The tokens_per_second must be positive.")
+        self._embedding_latency = embedding_latency
+        self._search_latency = search_latency
+        self._first_token_latency = first_token_latency
+        self._tokens_per_second = tokens_per_second
+        self._response_tokens = response_tokens
+        self._dimensions = dimensions
+        self._indexes: dict[str, dict[str, Any]] = {}
+        self._documents: dict[str, dict[str, dict[str, Any]]] = {}
+
+    def make_app(self) -> web.Application:
+        """
+        Create the web application with the routes of all services.
+
+        :return: The aiohttp application.
+        """
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post('/models/chat/completions', self.chat_completions)
+        app.router.add_post('/models/embeddings', self.embeddings)
+        app.router.add_route('*', '/indexes{tail:.*}', self.indexes)
+        return app
+
+    @staticmethod
+    def make_embedding(text: str, dimensions: int) -> list[float]:
+        """
+        Return the deterministic unit vector for the text.
+
+        :param text: The text to embed.
+        :param dimensions: The number of dimensions.
+        :return: The embedding.
+        """
+        rng = random.Random(hashlib.sha256(text.encode('utf-8')).digest())
+        vector = [rng.gauss(0., 1.) for _ in range(dimensions)]
+        norm = math.sqrt(sum(value * value for value in vector)) or 1.
+        return [value / norm for value in vector]
+
+    async def embeddings(self, request: web.Request) -> web.Response:
+        """Answer the embeddings request."""
+        body = await request.json()
+        inputs = body['input'] if isinstance(body['input'], list) else [body['input']]
+        dimensions = body.get('dimensions') or self._dimensions
+        await asyncio.sleep(self._embedding_latency)
+        tokens = sum(len(text.split()) for text in inputs)
+        return web.json_response({
+            'id': str(uuid.uuid4()),
+            'object': 'list',
+            'model': body.get('model') or 'fake-embedding',
+            'data': [
+                {'object': 'embedding', 'index': i, 'embedding': self.make_embedding(text, dimensions)}
+                for i, text in enumerate(inputs)
+            ],
+            'usage': {'prompt_tokens': tokens, 'total_tokens': tokens},
+        })
+
+    def _chat_chunk(
+            self, completion_id: str, model: str, content: Optional[str], finish_reason: Optional[str]) -> bytes:
+        """Serialize the streamed chat completion chunk."""
+        delta = {'role': 'assistant', 'content': content} if content is not None else {}
+        chunk = {
+            'id': completion_id,
+            'object': 'chat.completion.chunk',
+            'created': int(time.time()),
+            'model': model,
+            'choices': [{'index': 0, 'delta': delta, 'finish_reason': finish_reason}],
+        }
+        return f"data: {json.dumps(chunk)}\n\n".encode()
+
+    async def chat_completions(self, request: web.Request) -> web.StreamResponse:
+        """Answer the chat completions request, streaming the tokens if it was requested."""
+        body = await request.json()
+        model = body.get('model') or 'fake-chat'
+        completion_id = str(uuid.uuid4())
+        tokens = [f" token{i}" for i in range(self._response_tokens)]
+        await asyncio.sleep(self._first_token_latency)
+        if not body.get('stream'):
+            await asyncio.sleep(max(0, len(tokens) - 1) / self._tokens_per_second)
+            return web.json_response({
+                'id': completion_id,
+                'object': 'chat.completion',
+                'created': int(time.time()),
+                'model': model,
+                'choices': [{
+                    'index': 0,
+                    'message': {'role': 'assistant', 'content': ''.join(tokens)},
+                    'finish_reason': 'stop',
+                }],
+                'usage': {'prompt_tokens': 0, 'completion_tokens': len(tokens), 'total_tokens': len(tokens)},
+            })
+
+        response = web.StreamResponse(headers={'Content-Type': 'text/event-stream'})
+        await response.prepare(request)
+        start = time.perf_counter()
+        for i, token in enumerate(tokens):
+            # The tokens are scheduled from the start, so the slow writes do not slow down the rate.
+            delay = start + i / self._tokens_per_second - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            await response.write(self._chat_chunk(completion_id, model, token, None))
+        await response.write(self._chat_chunk(completion_id, model, None, 'stop'))
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+    async def indexes(self, request: web.Request) -> web.Response:
+        """Answer the index management and documents requests."""
+        match = _INDEX_PATH.match(request.path)
+        if match is None:
+            return self._error(404, "ResourceNotFound", f"Unknown path {request.path}.")
+        name = match.group('name')
+        operation = match.group('operation') or ''
+        if name is None:
+            if request.method == 'POST' and not operation:
+                index = await request.json()
+                if index['name'] in self._indexes:
+                    return self._error(409, "ResourceNameAlreadyInUse", f"The index {index['name']} exists.")
+                self._indexes[index['name']] = index
+                self._documents[index['name']] = {}
+                return web.json_response(index, status=201)
+            if request.method == 'GET' and not operation:
+                return web.json_response({'value': list(self._indexes.values())})
+        elif name not in self._indexes:
+            return self._error(404, "ResourceNameNotFound", f"The index {name} was not found.")
+        elif not operation:
+            if request.method == 'GET':
+                return web.json_response(self._indexes[name])
+            if request.method == 'DELETE':
+                del self._indexes[name]
+                del self._documents[name]
+                return web.Response(status=204)
+        elif operation == '/docs/search.index' and request.method == 'POST':
+            return await self._index_documents(name, request)
+        elif operation == '/docs/search.post.search' and request.method == 'POST':
+            return await self._search(name, request)
+        return self._error(404, "ResourceNotFound", f"Unsupported request {request.method} {request.path}.")
+
+    async def _index_documents(self, name: str, request: web.Request) -> web.Response:
+        """Upload or delete the documents."""
+        body = await request.json()
+        key_field = next(field['name'] for field in self._indexes[name]['fields'] if field.get('key'))
+        documents = self._documents[name]
+        results = []
+        for action in body['value']:
+            action = dict(action)
+            action_type = action.pop('@search.action', 'upload')
+            key = action[key_field]
+            if action_type == 'delete':
+                documents.pop(key, None)
+            else:
+                documents[key] = action
+            results.append({'key': key, 'status': True, 'errorMessage': None, 'statusCode': 200})
+        return web.json_response({'value': results})
+
+    async def _search(self, name: str, request: web.Request) -> web.Response:
+        """Return the top documents, ignoring the query."""
+        body = await request.json()
+        top = body.get('top')
+        for query in body.get('vectorQueries') or []:
+            top = top or query.get('k')
+        select = body.get('select')
+        select = select.split(',') if select else None
+        await asyncio.sleep(self._search_latency)
+        results = []
+        for document in list(self._documents[name].values())[:top or 50]:
+            result = {key: value for key, value in document.items() if select is None or key in select}
+            result['@search.score'] = 1.
+            results.append(result)
+        return web.json_response({'value': results})
+
+    @staticmethod
+    def _error(status: int, code: str, message: str) -> web.Response:
+        """Return the error in the format of Azure services."""
+        return web.json_response({'error': {'code': code, 'message': message}}, status=status)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the local stand-ins for the Azure AI services.")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--embedding-latency', type=float, default=0.02,
+                        help="The time in seconds to answer the embedding request.")
+    parser.add_argument('--search-latency', type=float, default=0.01,
+                        help="The time in seconds to answer the search request.")
+    parser.add_argument('--first-token-latency', type=float, default=0.3,
+                        help="The time in seconds before the first streamed token.")
+    parser.add_argument('--tokens-per-second', type=float, default=50.,
+                        help="The rate of the streamed tokens.")
+    parser.add_argument('--response-tokens', type=int, default=100,
+                        help="The number of tokens in the chat response.")
+    parser.add_argument('--dimensions', type=int, default=100,
+                        help="The number of dimensions in the embedding, if the request does not set it.")
+    parser.add_argument('--certfile', help="The certificate to serve https, see make_certificate.")
+    parser.add_argument('--keyfile', help="The private key of the certificate.")
+    args = parser.parse_args()
+    ssl_context = None
+    if args.certfile:
+        ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        ssl_context.load_cert_chain(args.certfile, args.keyfile)
+    services = FakeServices(
+        embedding_latency=args.embedding_latency,
+        search_latency=args.search_latency,
+        first_token_latency=args.first_token_latency,
+        tokens_per_second=args.tokens_per_second,
+        response_tokens=args.response_tokens,
+        dimensions=args.dimensions,
+    )
+    web.run_app(services.make_app(), host=args.host, port=args.port, ssl_context=ssl_context, access_log=None)
@@ -0,0 +1,131 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+# See LICENSE file in the project root for full license information.
+"""
+The load generator, driving the /chat endpoint with the concurrent SSE clients.
+
+Each client sends the next request as soon as the previous response stream has ended.
+The time to first byte is measured from sending the request to receiving the first chunk
+of the response body, the latency is measured to the end of the stream.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import time
+from collections.abc import Sequence
+from typing import Any, Optional
+
+import aiohttp
+import numpy as np
+
+PERCENTILES = (50, 95, 99)
+DEFAULT_QUESTIONS = (
+    "What tents do you have?",
+    "Which tent is the most waterproof?",
+    "What is the warranty of the TrailMaster X4 Tent?",
+    "Do you sell hiking boots?",
+)
+
+
+async def _send_request(
+        session: aiohttp.ClientSession,
+        url: str,
+        question: str,
+        ttfb: list[float],
+        latency: list[float]) -> None:
+    """Send one chat request and read the response stream to the end."""
+    payload = {'messages': [{'role': 'user', 'content': question}]}
+    start = time.perf_counter()
+    first_byte = None
+    body = b''
+    async with session.post(url, json=payload) as response:
+        response.raise_for_status()
+        async for chunk in response.content.iter_any():
+            if first_byte is None:
+                first_byte = time.perf_counter()
+            body += chunk
+    end = time.perf_counter()
+    if b'"stream_end"' not in body:
+        raise ValueError("The response stream has ended without the stream_end event.")
+    ttfb.append((first_byte or end) - start)
+    latency.append(end - start)
+
+
+def summarize(values: Sequence[float]) -> dict[str, float]:
+    """
+    Return the percentiles of the values in milliseconds.
+
+    :param values: The values in seconds.
+    :return: The dictionary with the p50, p95 and p99 keys.
+    """
+    if not values:
+        return {f'p{p}': float('nan') for p in PERCENTILES}
+    return {f'p{p}': float(np.percentile(values, p)) * 1000 for p in PERCENTILES}
+
+
+async def run_load(
+        base_url: str,
+        concurrency: int = 16,
+        requests: int = 200,
+        questions: Sequence[str] = DEFAULT_QUESTIONS,
+        auth: Optional[aiohttp.BasicAuth] = None,
+        timeout: float = 120.,
+    ) -> dict[str, Any]:
+    """
+    Send the chat requests from the concurrent clients and measure the latencies.
+
+    :param base_url: The URL of the application.
+    :param concurrency: The number of concurrent clients.
+    :param requests: The total number of requests.
+    :param questions: The questions, asked in turn.
+    :param auth: The basic authentication credentials, if the application requires them.
+    :param timeout: The timeout of one request in seconds.
+    :return: The dictionary with the number of requests and errors, the number of requests
+             per second and the percentiles of time to first byte and latency in milliseconds.
+    """
+    if concurrency <= 0 or requests <= 0:
+        raise ValueError("The concurrency and requests must be positive.")
+    url = base_url.rstrip('/') + '/chat'
+    ttfb: list[float] = []
+    latency: list[float] = []
+    errors: list[str] = []
+    counter = itertools.count()
+    question_cycle = itertools.cycle(questions)
+
+    async def client(session: aiohttp.ClientSession) -> None:
+        while next(counter) < requests:
+            try:
+                await _send_request(session, url, next(question_cycle), ttfb, latency)
+            except Exception as e:
+                errors.append(f"{type(e).__name__}: {e}")
+
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(
+            connector=connector, auth=auth, timeout=aiohttp.ClientTimeout(total=timeout)) as session:
+        start = time.perf_counter()
+        await asyncio.gather(*(client(session) for _ in range(concurrency)))
+        duration = time.perf_counter() - start
+    return {
+        'concurrency': concurrency,
+        'requests': len(latency),
+        'errors': len(errors),
+        'first_errors': errors[:5],
+        'seconds': duration,
+        'requests_per_second': len(latency) / duration if duration else 0.,
+        'ttfb_ms': summarize(ttfb),
+        'latency_ms': summarize(latency),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Drive the /chat endpoint with the concurrent SSE clients.")
+    parser.add_argument('--url', default='http://127.0.0.1:50505', help="The URL of the application.")
+    parser.add_argument('--concurrency', type=int, default=16, help="The number of concurrent clients.")
+    parser.add_argument('--requests', type=int, default=200, help="The total number of requests.")
+    parser.add_argument('--username', help="The basic authentication user name.")
+    parser.add_argument('--password', help="The basic authentication password.")
+    args = parser.parse_args()
+    basic_auth = aiohttp.BasicAuth(args.username, args.password) if args.username else None
+    report = asyncio.run(run_load(args.url, args.concurrency, args.requests, auth=basic_auth))
+    print(json.dumps(report, indent=2))
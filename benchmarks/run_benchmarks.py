@@ -0,0 +1,196 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+# See LICENSE file in the project root for full license information.
+"""
+Benchmark the application against the local stand-ins of the Azure services.
+
+The fake services are started once. For each number of workers the application is started
+with gunicorn, warmed up and loaded by the load generator, and the report with requests
+per second and time to first byte and latency percentiles is printed as the markdown table.
+"""
+import argparse
+import asyncio
+import json
+import os
+import signal
+import socket
+import ssl
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Optional
+
+import aiohttp
+from fake_services import make_certificate
+from load_generator import run_load
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+SRC_DIR = os.path.join(os.path.dirname(BENCHMARKS_DIR), 'src')
+
+
+def _free_port() -> int:
+    """Return the free TCP port on the loopback interface."""
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+async def _wait_ready(url: str, process: subprocess.Popen, timeout: float, cafile: Optional[str] = None) -> None:
+    """Wait until the URL answers, failing if the process has exited."""
+    deadline = time.monotonic() + timeout
+    connector = aiohttp.TCPConnector(ssl=ssl.create_default_context(cafile=cafile)) if cafile else None
+    async with aiohttp.ClientSession(connector=connector) as session:
+        while time.monotonic() < deadline:
+            if process.poll() is not None:
+                raise RuntimeError(f"The process {' '.join(process.args)} has exited with code {process.returncode}.")
+            try:
+                async with session.get(url) as response:
+                    if response.status < 500:
+                        return
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(0.2)
+    raise TimeoutError(f"{url} has not become ready in {timeout} seconds.")
+
+
+def _stop(process: subprocess.Popen) -> None:
+    """Stop the process gracefully, killing it if it does not exit."""
+    if process.poll() is None:
+        process.send_signal(signal.SIGTERM)
+        try:
+            process.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+
+
+def _app_environment(services_url: str, certfile: str) -> dict[str, str]:
+    """Return the environment of the application, pointing it to the fake services."""
+    env = dict(os.environ)
+    for name in ('WEB_APP_USERNAME', 'WEB_APP_PASSWORD', 'ENABLE_AZURE_MONITOR_TRACING',
+                 'PROMETHEUS_MULTIPROC_DIR', 'APP_LOG_FILE'):
+        env.pop(name, None)
+    env.update({
+        'RUNNING_IN_PRODUCTION': 'true',
+        'SSL_CERT_FILE': certfile,
+        'AZURE_EXISTING_AIPROJECT_ENDPOINT': f'{services_url}/api/projects/benchmark',
+        'AZURE_AI_INFERENCE_ENDPOINT': f'{services_url}/models',
+        'AZURE_AI_INFERENCE_KEY': 'benchmark',
+        'AZURE_AI_CHAT_DEPLOYMENT_NAME': 'benchmark-chat',
+        'AZURE_AI_EMBED_DEPLOYMENT_NAME': 'benchmark-embedding',
+        'AZURE_AI_SEARCH_ENDPOINT': services_url,
+        'AZURE_AI_SEARCH_KEY': 'benchmark',
+        'AZURE_AI_SEARCH_INDEX_NAME': 'benchmark-index',
+    })
+    env.setdefault('AZURE_AI_EMBED_DIMENSIONS', '100')
+    return env
+
+
+async def benchmark_workers(
+        args: argparse.Namespace,
+        services_url: str,
+        certfile: str,
+        workers: int) -> dict[str, Any]:
+    """
+    Start the application with the given number of workers and measure it.
+
+    :param args: The command line arguments.
+    :param services_url: The URL of the fake services.
+    :param certfile: The certificate of the fake services.
+    :param workers: The number of gunicorn workers.
+    :return: The report of the load generator.
+    """
+    port = _free_port()
+    app_url = f'http://127.0.0.1:{port}'
+    app = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', 'api.main:create_app()', '--config', 'gunicorn.conf.py',
+         '--workers', str(workers), '--bind', f'127.0.0.1:{port}', '--log-level', 'warning'],
+        cwd=SRC_DIR,
+        env=_app_environment(services_url, certfile),
+        stdout=None if args.verbose else subprocess.DEVNULL,
+        stderr=None if args.verbose else subprocess.DEVNULL,
+    )
+    try:
+        await _wait_ready(f'{app_url}/metrics', app, args.startup_timeout)
+        if args.warmup:
+            await run_load(app_url, concurrency=min(args.concurrency, args.warmup), requests=args.warmup)
+        report = await run_load(app_url, concurrency=args.concurrency, requests=args.requests)
+    finally:
+        _stop(app)
+    report['workers'] = workers
+    return report
+
+
+def format_report(reports: list[dict[str, Any]]) -> str:
+    """
+    Format the reports as the markdown table.
+
+    :param reports: The reports of the load generator with the number of workers.
+    :return: The markdown table.
+    """
+    lines = [
+        "| workers | requests/s | TTFB p50 | TTFB p95 | TTFB p99 | latency p50 | latency p95 | latency p99 | errors |",
+        "|---|---|---|---|---|---|---|---|---|",
+    ]
+    for report in reports:
+        ttfb = report['ttfb_ms']
+        latency = report['latency_ms']
+        lines.append(
+            f"| {report['workers']} | {report['requests_per_second']:.1f} "
+            f"| {ttfb['p50']:.0f} ms | {ttfb['p95']:.0f} ms | {ttfb['p99']:.0f} ms "
+            f"| {latency['p50']:.0f} ms | {latency['p95']:.0f} ms | {latency['p99']:.0f} ms "
+            f"| {report['errors']} |")
+    return '\n'.join(lines)
+
+
+async def main(args: argparse.Namespace) -> list[dict[str, Any]]:
+    """Run the benchmark for all numbers of workers."""
+    certificate_dir = tempfile.TemporaryDirectory()
+    certfile, keyfile = make_certificate(certificate_dir.name)
+    port = _free_port()
+    services_url = f'https://127.0.0.1:{port}'
+    services = subprocess.Popen([
+        sys.executable, os.path.join(BENCHMARKS_DIR, 'fake_services.py'), '--port', str(port),
+        '--certfile', certfile, '--keyfile', keyfile,
+        '--embedding-latency', str(args.embedding_latency),
+        '--search-latency', str(args.search_latency),
+        '--first-token-latency', str(args.first_token_latency),
+        '--tokens-per-second', str(args.tokens_per_second),
+        '--response-tokens', str(args.response_tokens),
+    ], stdout=subprocess.DEVNULL)
+    reports = []
+    try:
+        await _wait_ready(f'{services_url}/indexes', services, args.startup_timeout, cafile=certfile)
+        for workers in args.workers:
+            report = await benchmark_workers(args, services_url, certfile, workers)
+            reports.append(report)
+            for error in report['first_errors']:
+                print(f"workers={workers}: {error}", file=sys.stderr)
+    finally:
+        _stop(services)
+        certificate_dir.cleanup()
+    return reports
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the chat application against the fake Azure services.")
+    parser.add_argument('--workers', type=lambda value: [int(n) for n in value.split(',')], default=[1, 2, 4],
+                        help="The comma separated numbers of gunicorn workers to benchmark.")
+    parser.add_argument('--concurrency', type=int, default=32, help="The number of concurrent clients.")
+    parser.add_argument('--requests', type=int, default=500, help="The number of measured requests.")
+    parser.add_argument('--warmup', type=int, default=20, help="The number of requests before the measurement.")
+    parser.add_argument('--embedding-latency', type=float, default=0.02)
+    parser.add_argument('--search-latency', type=float, default=0.01)
+    parser.add_argument('--first-token-latency', type=float, default=0.3)
+    parser.add_argument('--tokens-per-second', type=float, default=50.)
+    parser.add_argument('--response-tokens', type=int, default=100)
+    parser.add_argument('--startup-timeout', type=float, default=60.)
+    parser.add_argument('--json', help="The file to write the reports to.")
+    parser.add_argument('--verbose', action='store_true', help="Show the output of the application.")
+    args = parser.parse_args()
+    reports = asyncio.run(main(args))
+    print(format_report(reports))
+    if args.json:
+        with open(args.json, 'w') as fp:
+            json.dump(reports, fp, indent=2)
@@ -0,0 +1,249 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+# See LICENSE file in the project root for full license information.
+import asyncio
+import math
+import time
+from collections import Counter, OrderedDict, deque
+from collections.abc import AsyncIterator
+from typing import Any, Optional, TypeVar
+
+from fastapi.responses import StreamingResponse
+from starlette.types import Receive, Scope, Send
+
+from .metrics import ADMISSION_QUEUE_DEPTH, ADMISSION_REJECTED, ADMISSION_WAIT_SECONDS
+
+T = TypeVar('T')
+
+
+class AdmissionRejected(Exception):
+    """
+    The request was not admitted.
+
+    :param reason: Either queue_full or timeout.
+    :param retry_after: The number of seconds after which the client may retry.
+    """
+
+    def __init__(self, reason: str, retry_after: int) -> None:
+        super().__init__(f"The request was rejected: {reason}.")
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class Admission:
+    """
+    The slot of the admitted request, which must be released when the request is complete.
+
+    :param controller: The controller, which has admitted the request.
+    :param client_id: The identity of the client.
+    """
+
+    def __init__(self, controller: 'AdmissionController', client_id: str) -> None:
+        """Constructor."""
+        self._controller = controller
+        self._client_id = client_id
+        self._start = time.monotonic()
+        self._released = False
+
+    def release(self) -> None:
+        """Release the slot. The repeated calls are ignored."""
+        if not self._released:
+            self._released = True
+            self._controller._release(self._client_id, time.monotonic() - self._start)
+
+
+class AdmissionController:
+    """
+    The limiter of the concurrent requests of one worker.
+
+    Up to max_concurrency requests are served at once, and each client is served up to
+    max_per_client of them. The other requests wait in the queue, up to max_queue requests
+    in total and up to max_per_client of each client. The released slots are given to the
+    clients in turn, so the client with many requests does not delay the others. The request,
+    which does not fit into the queue or has not been admitted in queue_timeout seconds,
+    is rejected with the time the client should wait before retrying.
+
+    :param max_concurrency: The maximal number of requests served at once.
+    :param max_per_client: The maximal number of requests of one client served at once.
+    :param max_queue: The maximal number of waiting requests.
+    :param queue_timeout: The maximal time in seconds a request waits in the queue.
+    :param trusted_proxies: The number of the proxies in front of the application, like the ingress
+                            of the container app, which append the address of the client to X-Forwarded-For.
+                            0 to identify the client by the address of the connection.
+    """
+
+    def __init__(
+            self,
+            max_concurrency: int = 32,
+            max_per_client: int = 4,
+            max_queue: int = 64,
+            queue_timeout: float = 10.,
+            trusted_proxies: int = 1,
+        ) -> None:
+        """Constructor."""
+        if max_concurrency <= 0 or max_per_client <= 0 or max_queue < 0:
+            raise ValueError("The max_concurrency and max_per_client must be positive and max_queue non negative.")
+        if trusted_proxies < 0:
+            raise ValueError("The trusted_proxies must not be negative.")
+        self._trusted_proxies = trusted_proxies
+        self._max_concurrency = max_concurrency
+        self._max_per_client = max_per_client
+        self._max_queue = max_queue
+        self._queue_timeout = queue_timeout
+        self._active = 0
+        self._active_by_client = Counter()
+        # The clients in the order of their turn, each with its own queue of waiting requests.
+        self._waiters: OrderedDict[str, deque[asyncio.Future]] = OrderedDict()
+        self._queued = 0
+        # The moving average of the time the slot is held, used to estimate Retry-After.
+        self._mean_hold_time = 1.
+
+    @property
+    def active(self) -> int:
+        """The number of the admitted requests."""
+        return self._active
+
+    @property
+    def queued(self) -> int:
+        """The number of the waiting requests."""
+        return self._queued
+
+    def client_id(self, forwarded_for: Optional[str], peer: str) -> str:
+        """
+        Return the address of the client, added to X-Forwarded-For by the trusted proxies.
+
+        Each proxy appends the address, from which it has received the request, to the header,
+        so only the trusted_proxies rightmost addresses were not set by the client. The client
+        can put any addresses before them, so the leftmost address is not used.
+
+        :param forwarded_for: The X-Forwarded-For header, or None if it is absent.
+        :param peer: The address of the connection.
+        :return: The address, added by the farthest trusted proxy, or the address of the connection.
+        """
+        if not forwarded_for or not self._trusted_proxies:
+            return peer
+        hops = [hop.strip() for hop in forwarded_for.split(",") if hop.strip()]
+        if not hops:
+            return peer
+        # With fewer addresses than the trusted proxies all of them were added by the proxies.
+        return hops[-min(self._trusted_proxies, len(hops))]
+
+    async def acquire(self, client_id: str) -> Admission:
+        """
+        Admit the request of the client, waiting in the queue if all slots are taken.
+
+        :param client_id: The identity of the client.
+        :return: The admission, which must be released when the request is complete.
+        :raises: AdmissionRejected if the queue is full or the request has waited for too long.
+        """
+        if self._active < self._max_concurrency and \
+                self._active_by_client[client_id] < self._max_per_client and client_id not in self._waiters:
+            self._take(client_id)
+            ADMISSION_WAIT_SECONDS.observe(0.)
+            return Admission(self, client_id)
+        if self._queued >= self._max_queue or len(self._waiters.get(client_id, ())) >= self._max_per_client:
+            ADMISSION_REJECTED.labels('queue_full').inc()
+            raise AdmissionRejected('queue_full', self._retry_after())
+
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(client_id, deque()).append(future)
+        self._queued += 1
+        ADMISSION_QUEUE_DEPTH.inc()
+        start = time.monotonic()
+        try:
+            done, _ = await asyncio.wait({future}, timeout=self._queue_timeout)
+        except asyncio.CancelledError:
+            self._abandon(client_id, future)
+            raise
+        if not done:
+            self._abandon(client_id, future)
+            ADMISSION_REJECTED.labels('timeout').inc()
+            raise AdmissionRejected('timeout', self._retry_after())
+        ADMISSION_WAIT_SECONDS.observe(time.monotonic() - start)
+        return Admission(self, client_id)
+
+    def _take(self, client_id: str) -> None:
+        """Take the slot for the client."""
+        self._active += 1
+        self._active_by_client[client_id] += 1
+
+    def _release(self, client_id: str, hold_time: float) -> None:
+        """Release the slot of the client and give the free slots to the waiting requests."""
+        self._active -= 1
+        self._active_by_client[client_id] -= 1
+        if self._active_by_client[client_id] <= 0:
+            del self._active_by_client[client_id]
+        self._mean_hold_time = 0.9 * self._mean_hold_time + 0.1 * hold_time
+        self._grant()
+
+    def _grant(self) -> None:
+        """Give the free slots to the first waiting requests of the clients in turn."""
+        while self._active < self._max_concurrency:
+            client_id = next(
+                (client for client in self._waiters if self._active_by_client[client] < self._max_per_client), None)
+            if client_id is None:
+                return
+            queue = self._waiters.pop(client_id)
+            future = queue.popleft()
+            if queue:
+                # The client goes to the end of the turn.
+                self._waiters[client_id] = queue
+            self._queued -= 1
+            ADMISSION_QUEUE_DEPTH.dec()
+            self._take(client_id)
+            future.set_result(None)
+
+    def _abandon(self, client_id: str, future: asyncio.Future) -> None:
+        """Remove the request, which has stopped waiting, from the queue."""
+        if future.done() and not future.cancelled():
+            # The slot was given after the request had stopped waiting.
+            self._release(client_id, 0.)
+            return
+        future.cancel()
+        queue = self._waiters.get(client_id)
+        if queue is not None and future in queue:
+            queue.remove(future)
+            self._queued -= 1
+            ADMISSION_QUEUE_DEPTH.dec()
+            if not queue:
+                del self._waiters[client_id]
+
+    def _retry_after(self) -> int:
+        """Estimate the time in seconds, after which the queue will have room."""
+        return max(1, math.ceil(self._mean_hold_time * (self._queued + 1) / self._max_concurrency))
+
+
+class AdmittedStreamingResponse(StreamingResponse):
+    """
+    The streaming response, which releases the admission when it has been sent, the client
+    has disconnected or the request was cancelled, even if the stream has not been started.
+
+    :param content: The response stream.
+    :param admission: The admission of the request.
+    """
+
+    def __init__(self, content: AsyncIterator[Any], admission: Admission, **kwargs: Any) -> None:
+        """Constructor."""
+        super().__init__(content, **kwargs)
+        self._admission = admission
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            self._admission.release()
+
+
+async def release_when_done(stream: AsyncIterator[T], admission: Admission) -> AsyncIterator[T]:
+    """
+    Release the admission when the stream is exhausted or closed.
+
+    :param stream: The response stream.
+    :param admission: The admission of the request.
+    :return: The stream with the same items.
+    """
+    try:
+        async for item in stream:
+            yield item
+    finally:
+        admission.release()
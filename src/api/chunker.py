@@ -0,0 +1,244 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+# See LICENSE file in the project root for full license information.
+import os
+import re
+from collections.abc import Sequence
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+
+from .util import estimate_tokens
+
+_HEADING = re.compile(r"^(#{1,6})\s+(.*)$")
+# The sentence ends with the punctuation, followed by the white space and the capital letter or digit.
+_SENTENCE_END = re.compile(r"(?<=[.!?])\s+(?=[\"'(\[]?[A-Z0-9])")
+
+
+class MarkdownChunker:
+    """
+    Split the markdown documents into the chunks of predictable size for embedding.
+
+    The document is split into sections by headings. Consecutive sections are packed
+    into one chunk while they fit into max_tokens, so the heading always stays together
+    with its content. The section, longer than max_tokens, is split by paragraphs and
+    sentences into several chunks, each prefixed with the section headings and starting
+    with up to overlap_tokens of the end of the previous chunk.
+
+    :param max_tokens: The target number of tokens in a chunk.
+    :param overlap_tokens: The number of tokens from the previous chunk, repeated when a section is split.
+    :param min_line_length: The lines shorter than this number of characters are skipped.
+    :param min_diff_characters_in_line: The lines with fewer different characters, like
+                                        table or horizontal rule separators, are skipped.
+    """
+
+    def __init__(
+            self,
+            max_tokens: int = 256,
+            overlap_tokens: int = 32,
+            min_line_length: int = 5,
+            min_diff_characters_in_line: int = 5,
+        ) -> None:
+        """Constructor."""
+        if max_tokens <= 0:
+            raise ValueError("The max_tokens must be positive.")
+        if not 0 <= overlap_tokens < max_tokens:
+            raise ValueError("The overlap_tokens must be non negative and less than max_tokens.")
+        self._max_tokens = max_tokens
+        self._overlap_tokens = overlap_tokens
+        self._min_line_length = min_line_length
+        self._min_diff_characters_in_line = min_diff_characters_in_line
+
+    def chunk_text(self, text: str) -> list[str]:
+        """
+        Split the markdown text into chunks.
+
+        :param text: The markdown text.
+        :return: The list of chunks.
+        """
+        chunks = []
+        current = []
+        current_tokens = 0
+        for headings, paragraphs in self._split_sections(text):
+            # The section, appended to the chunk, is preceded only by its own heading,
+            # while the chunk, starting with the section, gets the whole headings path.
+            tail = headings[-1:] + paragraphs
+            tail_tokens = sum(estimate_tokens(line) for line in tail)
+            if current and current_tokens + tail_tokens <= self._max_tokens:
+                current.extend(tail)
+                current_tokens += tail_tokens
+                continue
+            if current:
+                chunks.append('\n'.join(current))
+                current = []
+                current_tokens = 0
+            section = headings + paragraphs
+            section_tokens = sum(estimate_tokens(line) for line in section)
+            if section_tokens <= self._max_tokens:
+                current = section
+                current_tokens = section_tokens
+            else:
+                chunks.extend(self._split_section(headings, paragraphs))
+        if current:
+            chunks.append('\n'.join(current))
+        return chunks
+
+    def chunk_file(self, file_name: str) -> list[str]:
+        """
+        Split the markdown file into chunks.
+
+        :param file_name: The markdown file.
+        :return: The list of chunks.
+        """
+        with open(file_name, encoding='utf-8') as fp:
+            return self.chunk_text(fp.read())
+
+    def chunk_files(self, file_names: Sequence[str], max_workers: Optional[int] = None) -> list[str]:
+        """
+        Split the markdown files into chunks, using the pool of processes.
+
+        :param file_names: The markdown files.
+        :param max_workers: The number of processes. If it is 1, the files are processed in this process.
+        :return: The list of chunks of all files, in the order of files.
+        """
+        if max_workers == 1 or len(file_names) <= 1:
+            return [chunk for file_name in file_names for chunk in self.chunk_file(file_name)]
+        workers = max_workers or os.cpu_count() or 1
+        chunksize = max(1, len(file_names) // (4 * workers))
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            return [chunk for chunks in executor.map(self.chunk_file, file_names, chunksize=chunksize)
+                    for chunk in chunks]
+
+    def _is_informative(self, line: str) -> bool:
+        """Return False for the lines, which do not carry any information."""
+        return len(line) >= self._min_line_length and len(set(line)) >= self._min_diff_characters_in_line
+
+    def _split_sections(self, text: str) -> list[tuple[list[str], list[str]]]:
+        """
+        Split the text into sections.
+
+        :param text: The markdown text.
+        :return: The list of tuples with the headings path of the section and its paragraphs.
+        """
+        sections = []
+        headings: list[tuple[int, str]] = []
+        paragraphs: list[str] = []
+        paragraph: list[str] = []
+        in_code = False
+
+        def end_paragraph():
+            if paragraph:
+                paragraphs.append(' '.join(paragraph))
+                paragraph.clear()
+
+        def end_section():
+            end_paragraph()
+            if paragraphs:
+                sections.append(([heading for _, heading in headings], list(paragraphs)))
+                paragraphs.clear()
+
+        for line in text.splitlines():
+            if line.strip().startswith('```'):
+                in_code = not in_code
+                end_paragraph()
+                continue
+            if in_code:
+                # The code lines are kept as separate lines with their indentation,
+                # also the short ones like "}", which close the blocks.
+                if line.strip():
+                    paragraphs.append(line.rstrip())
+                continue
+            line = line.strip()
+            match = _HEADING.match(line)
+            if match:
+                end_section()
+                level = len(match.group(1))
+                while headings and headings[-1][0] >= level:
+                    headings.pop()
+                headings.append((level, line))
+                continue
+            if not line:
+                end_paragraph()
+            elif line.startswith(('- ', '* ', '|')):
+                # The list items and table rows are kept as separate lines.
+                end_paragraph()
+                if self._is_informative(line):
+                    paragraphs.append(line)
+            elif self._is_informative(line):
+                paragraph.append(line)
+        end_section()
+        return sections
+
+    def _split_section(self, headings: list[str], paragraphs: list[str]) -> list[str]:
+        """
+        Split the long section into the chunks, prefixed with the section headings.
+
+        :param headings: The headings path of the section.
+        :param paragraphs: The paragraphs of the section.
+        :return: The list of chunks.
+        """
+        prefix = '\n'.join(headings)
+        prefix_tokens = estimate_tokens(prefix)
+        budget = max(self._max_tokens - prefix_tokens, self._max_tokens // 2)
+        units = []
+        for paragraph in paragraphs:
+            if estimate_tokens(paragraph) <= budget:
+                units.append(paragraph)
+                continue
+            for sentence in _SENTENCE_END.split(paragraph):
+                units.extend(self._split_words(sentence, budget))
+
+        chunks = []
+        current: list[str] = []
+        current_tokens = 0
+        has_new_units = False
+        for unit in units:
+            unit_tokens = estimate_tokens(unit)
+            if current and current_tokens + unit_tokens > budget:
+                chunks.append(current)
+                # Start the next chunk with the end of the previous one.
+                overlap: list[str] = []
+                overlap_tokens = 0
+                for previous in reversed(current):
+                    previous_tokens = estimate_tokens(previous)
+                    if overlap_tokens + previous_tokens > self._overlap_tokens or \
+                            overlap_tokens + previous_tokens + unit_tokens > budget:
+                        break
+                    overlap.insert(0, previous)
+                    overlap_tokens += previous_tokens
+                current = overlap
+                current_tokens = overlap_tokens
+                has_new_units = False
+            current.append(unit)
+            current_tokens += unit_tokens
+            has_new_units = True
+        if current and has_new_units:
+            chunks.append(current)
+        return ['\n'.join(([prefix] if prefix else []) + chunk) for chunk in chunks]
+
+    @staticmethod
+    def _split_words(sentence: str, budget: int) -> list[str]:
+        """Split the sentence, longer than the budget, by words."""
+        if estimate_tokens(sentence) <= budget:
+            return [sentence]
+        pieces = []
+        piece: list[str] = []
+        piece_tokens = 0
+        for word in sentence.split():
+            word_tokens = estimate_tokens(word)
+            if word_tokens > budget:
+                # The very long word, like URL, is split by characters.
+                step = max(1, len(word) * budget // word_tokens)
+                parts = [word[i:i + step] for i in range(0, len(word), step)]
+            else:
+                parts = [word]
+            for part in parts:
+                part_tokens = estimate_tokens(part)
+                if piece and piece_tokens + part_tokens > budget:
+                    pieces.append(' '.join(piece))
+                    piece = []
+                    piece_tokens = 0
+                piece.append(part)
+                piece_tokens += part_tokens
+        if piece:
+            pieces.append(' '.join(piece))
+        return pieces
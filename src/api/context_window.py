@@ -0,0 +1,134 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+# See LICENSE file in the project root for full license information.
+import hashlib
+import logging
+from collections import OrderedDict
+from collections.abc import Mapping, Sequence
+from typing import Any, Optional
+
+from .util import MESSAGE_OVERHEAD_TOKENS, estimate_tokens
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_PROMPT = (
+    'Summarize the conversation between the user and the assistant for the assistant, '
+    'who will continue it. Keep the facts, names, numbers, decisions and open questions; '
+    'omit the greetings and the repetitions. If the summary of the earlier part of the '
+    'conversation is given, update it with the new messages.')
+SUMMARY_PREFIX = 'The summary of the earlier conversation:\n\n'
+
+
+def count_message_tokens(messages: Sequence[Mapping[str, Any]]) -> int:
+    """
+    Estimate the number of prompt tokens of the chat messages.
+
+    :param messages: The messages with the role and content.
+    :return: The estimated number of tokens.
+    """
+    return sum(MESSAGE_OVERHEAD_TOKENS + estimate_tokens(message['content'] or '') for message in messages)
+
+
+class ContextWindow:
+    """
+    The limiter of the conversation history sent to the model.
+
+    The system prompt with the retrieved context and the newest messages, which fit
+    into max_tokens together, are sent; the last message is always sent. If the chat
+    client is given, the older messages are replaced by their summary. The summaries
+    are cached by the hash of the summarized messages, and the summary of the longer
+    history is made from the cached summary of its beginning and the few messages
+    dropped since, so each turn of the long conversation summarizes only the new messages.
+
+    :param max_tokens: The maximal number of the prompt tokens.
+    :param chat_client: The chat client to summarize the older messages. If not set,
+                        the older messages are dropped.
+    :param model: The chat model deployment for the summaries.
+    :param summary_max_tokens: The maximal number of tokens of the summary.
+    :param cache_size: The maximal number of the summaries kept.
+    """
+
+    def __init__(
+            self,
+            max_tokens: int = 8000,
+            chat_client: Optional[Any] = None,
+            model: Optional[str] = None,
+            summary_max_tokens: int = 256,
+            cache_size: int = 256,
+        ) -> None:
+        """Constructor."""
+        if max_tokens <= 0 or summary_max_tokens <= 0 or cache_size <= 0:
+            raise ValueError("The max_tokens, summary_max_tokens and cache_size must be positive.")
+        self._max_tokens = max_tokens
+        self._chat_client = chat_client
+        self._model = model
+        self._summary_max_tokens = summary_max_tokens
+        self._cache_size = cache_size
+        self._summaries: OrderedDict[str, str] = OrderedDict()
+
+    async def fit(
+            self,
+            prompt_messages: list[dict[str, Any]],
+            messages: list[dict[str, Any]],
+        ) -> list[dict[str, Any]]:
+        """
+        Return the messages to send: the prompt, the summary of the older history and the newest history.
+
+        :param prompt_messages: The system prompt with the retrieved context.
+        :param messages: The conversation history, the last message being the user question.
+        :return: The messages for the chat completion.
+        """
+        budget = self._max_tokens - count_message_tokens(prompt_messages)
+        kept = self._newest(messages, budget)
+        if kept == len(messages):
+            return prompt_messages + messages
+        if self._chat_client is not None:
+            # Make room for the summary.
+            kept = self._newest(messages, budget - self._summary_max_tokens - MESSAGE_OVERHEAD_TOKENS)
+            dropped = messages[:len(messages) - kept]
+            try:
+                summary = await self._summarize(dropped)
+                summary_message = {'role': 'system', 'content': SUMMARY_PREFIX + summary}
+                return prompt_messages + [summary_message] + messages[len(messages) - kept:]
+            except Exception as e:
+                logger.error("Failed to summarize the conversation, error: %s", str(e))
+        logger.info("Sending %d of %d messages of the conversation.", kept, len(messages))
+        return prompt_messages + messages[len(messages) - kept:]
+
+    @staticmethod
+    def _newest(messages: list[dict[str, Any]], budget: int) -> int:
+        """Return the number of the newest messages, which fit into the budget, but at least one."""
+        kept = 0
+        for message in reversed(messages):
+            budget -= count_message_tokens([message])
+            if budget < 0 and kept:
+                break
+            kept += 1
+        return kept
+
+    async def _summarize(self, messages: list[dict[str, Any]]) -> str:
+        """Summarize the messages, starting from the cached summary of their longest beginning."""
+        # The hashes of all beginnings of the history, computed in one pass.
+        prefix_hash = hashlib.sha256()
+        keys = []
+        for message in messages:
+            prefix_hash.update(f"{message['role']}\x00{message['content']}\x00".encode())
+            keys.append(prefix_hash.hexdigest())
+        if keys[-1] in self._summaries:
+            self._summaries.move_to_end(keys[-1])
+            return self._summaries[keys[-1]]
+        summarized = next((i + 1 for i in range(len(keys) - 1, -1, -1) if keys[i] in self._summaries), 0)
+        text = '\n\n'.join(f"{message['role']}: {message['content']}" for message in messages[summarized:])
+        if summarized:
+            text = f"The summary of the earlier part:\n{self._summaries[keys[summarized - 1]]}\n\n" \
+                   f"The new messages:\n\n{text}"
+        response = await self._chat_client.complete(
+            model=self._model,
+            messages=[{'role': 'system', 'content': SUMMARY_PROMPT}, {'role': 'user', 'content': text}],
+            max_tokens=self._summary_max_tokens,
+        )
+        summary = response.choices[0].message.content or ''
+        self._summaries[keys[-1]] = summary
+        while len(self._summaries) > self._cache_size:
+            self._summaries.popitem(last=False)
+        return summary
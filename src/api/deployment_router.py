@@ -0,0 +1,286 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+# See LICENSE file in the project root for full license information.
+import asyncio
+import logging
+import random
+import time
+from collections.abc import AsyncIterator, Mapping, Sequence
+from typing import Any, Optional
+
+from azure.ai.inference.aio import ChatCompletionsClient
+from azure.core.exceptions import AzureError, HttpResponseError
+
+from .metrics import (
+    CHAT_DEPLOYMENT_FAILOVERS,
+    CHAT_DEPLOYMENT_REMAINING_TOKENS,
+    CHAT_DEPLOYMENT_REQUESTS,
+    CHAT_DEPLOYMENT_TIME_TO_FIRST_TOKEN,
+)
+from .token_budget import TokenBudget, TokenBudgetExceeded, estimate_request_tokens
+
+logger = logging.getLogger(__name__)
+
+# The results of the chat completion attempts.
+SUCCESS = 'success'
+THROTTLED = 'throttled'
+ERROR = 'error'
+BAD_REQUEST = 'bad_request'
+
+# The status codes, after which the request is sent to another deployment.
+RETRYABLE_STATUS_CODES = (408, 429, 500, 502, 503, 504)
+
+
+class ChatDeployment:
+    """
+    The chat model deployment with its client and the rolling statistics of its responses.
+
+    The time to first token and the error rate are the exponential moving averages of the
+    recent requests, and the error rate decays to zero with error_half_life seconds while
+    the deployment is not used, so the deployment, which has failed, is tried again.
+
+    :param name: The name of the deployment, sent as the model of the request.
+    :param client: The client of the inference endpoint of the deployment.
+    :param budget: The token budget of the deployment, which the client is paced by.
+    :param label: The name of the deployment in the metrics and the statistics, the name by default.
+    :param smoothing: The weight of the newest request in the moving averages.
+    :param error_half_life: The number of seconds, in which the error rate halves.
+    """
+
+    def __init__(
+            self,
+            name: str,
+            client: ChatCompletionsClient,
+            budget: Optional[TokenBudget] = None,
+            label: Optional[str] = None,
+            smoothing: float = 0.2,
+            error_half_life: float = 60.,
+        ) -> None:
+        """Constructor."""
+        if not 0 < smoothing <= 1 or error_half_life <= 0:
+            raise ValueError("The smoothing must be in (0, 1] and error_half_life must be positive.")
+        self.name = name
+        self.client = client
+        self.budget = budget
+        self.label = label or name
+        self._smoothing = smoothing
+        self._error_half_life = error_half_life
+        self._time_to_first_token: Optional[float] = None
+        self._error_rate = 0.
+        self._error_updated = time.monotonic()
+        self.in_flight = 0
+        self._results: dict[str, int] = {SUCCESS: 0, THROTTLED: 0, ERROR: 0, BAD_REQUEST: 0}
+
+    @property
+    def time_to_first_token(self) -> Optional[float]:
+        """The moving average of the time to first token, None before the first response."""
+        return self._time_to_first_token
+
+    @property
+    def error_rate(self) -> float:
+        """The moving average of the share of the failed requests."""
+        now = time.monotonic()
+        self._error_rate *= 0.5 ** ((now - self._error_updated) / self._error_half_life)
+        self._error_updated = now
+        return self._error_rate
+
+    def record_first_token(self, seconds: float) -> None:
+        """Add the time to first token of the response to the moving average."""
+        CHAT_DEPLOYMENT_TIME_TO_FIRST_TOKEN.labels(self.label).observe(seconds)
+        if self._time_to_first_token is None:
+            self._time_to_first_token = seconds
+        else:
+            self._time_to_first_token += self._smoothing * (seconds - self._time_to_first_token)
+
+    def record_result(self, result: str) -> None:
+        """
+        Count the result of the request.
+
+        :param result: One of success, throttled, error or bad_request. The bad requests
+                       are not counted in the error rate, since they fail on any deployment.
+        """
+        self._results[result] += 1
+        CHAT_DEPLOYMENT_REQUESTS.labels(self.label, result).inc()
+        if result != BAD_REQUEST:
+            failed = 1. if result != SUCCESS else 0.
+            self._error_rate = self.error_rate + self._smoothing * (failed - self.error_rate)
+        if self.budget is not None:
+            remaining_tokens, _ = self.budget.reported_remaining
+            if remaining_tokens is not None:
+                CHAT_DEPLOYMENT_REMAINING_TOKENS.labels(self.label).set(remaining_tokens)
+
+    def stats(self) -> dict[str, Any]:
+        """Return the statistics of the deployment."""
+        remaining_tokens, remaining_requests = \
+            self.budget.reported_remaining if self.budget is not None else (None, None)
+        return dict(
+            self._results,
+            time_to_first_token=self._time_to_first_token,
+            error_rate=round(self.error_rate, 4),
+            in_flight=self.in_flight,
+            remaining_tokens=remaining_tokens,
+            remaining_requests=remaining_requests,
+        )
+
+
+class DeploymentRouter:
+    """
+    The router of the chat completions across the deployments of the chat model.
+
+    Each request is sent to the deployment, chosen at random with the weight, which is
+    the share of the successful requests divided by the expected time to first token:
+    the moving average of the deployment plus the time the request would wait for its
+    token budget. The deployment, which has reported in the rate limit headers fewer
+    remaining tokens than quota_headroom requests of this size, or fewer than quota_headroom
+    remaining requests, gets the proportionally lower weight, and the deployment, whose
+    budget would reject the request, is not chosen while there are others. The deployment
+    without the responses yet is expected to be as fast as the others on average. If the
+    request is throttled or fails before the first token, it is sent to another deployment,
+    up to max_attempts deployments in total; after the first token it is not, since the
+    client has received a part of the answer.
+
+    :param deployments: The deployments of the chat model.
+    :param max_attempts: The maximal number of deployments tried for one request, all of them by default.
+    :param quota_headroom: The number of requests, for which the deployment must have the quota left
+                           to get the full weight.
+    :param default_time_to_first_token: The expected time to first token before any response.
+    :param default_completion_tokens: The number of completion tokens if the request does not set max_tokens.
+    """
+
+    def __init__(
+            self,
+            deployments: Sequence[ChatDeployment],
+            max_attempts: Optional[int] = None,
+            quota_headroom: float = 4.,
+            default_time_to_first_token: float = 1.,
+            default_completion_tokens: int = 512,
+        ) -> None:
+        """Constructor."""
+        if not deployments:
+            raise ValueError("At least one deployment is required.")
+        if len({deployment.label for deployment in deployments}) != len(deployments):
+            raise ValueError("The labels of the deployments must be unique.")
+        if max_attempts is not None and max_attempts <= 0:
+            raise ValueError("The max_attempts must be positive.")
+        if quota_headroom <= 0 or default_time_to_first_token <= 0:
+            raise ValueError("The quota_headroom and default_time_to_first_token must be positive.")
+        self._deployments = list(deployments)
+        self._max_attempts = max_attempts or len(self._deployments)
+        self._quota_headroom = quota_headroom
+        self._default_time_to_first_token = default_time_to_first_token
+        self._default_completion_tokens = default_completion_tokens
+
+    @property
+    def deployments(self) -> list[ChatDeployment]:
+        """The deployments of the chat model."""
+        return self._deployments
+
+    def choose(self, tokens: int, exclude: set[str] = frozenset()) -> Optional[ChatDeployment]:
+        """
+        Choose the deployment for the request.
+
+        :param tokens: The estimated number of tokens of the request.
+        :param exclude: The labels of the deployments, which must not be chosen.
+        :return: The deployment, or None if all of them are excluded.
+        """
+        deployments = [deployment for deployment in self._deployments if deployment.label not in exclude]
+        if not deployments:
+            return None
+        waits = [deployment.budget.wait_time(tokens) if deployment.budget is not None else 0.
+                 for deployment in deployments]
+        available = [(deployment, wait) for deployment, wait in zip(deployments, waits)
+                     if deployment.budget is None or wait <= deployment.budget.max_wait]
+        if not available:
+            # The budget rejects the request with the time after which it may be retried.
+            return deployments[waits.index(min(waits))]
+        known = [deployment.time_to_first_token for deployment, _ in available
+                 if deployment.time_to_first_token is not None]
+        default = sum(known) / len(known) if known else self._default_time_to_first_token
+        weights = [self._weight(deployment, wait, tokens, default) for deployment, wait in available]
+        return random.choices([deployment for deployment, _ in available], weights)[0]
+
+    def _weight(self, deployment: ChatDeployment, wait: float, tokens: int, default: float) -> float:
+        """Return the weight of the deployment in the random choice."""
+        time_to_first_token = deployment.time_to_first_token
+        if time_to_first_token is None:
+            time_to_first_token = default
+        weight = max(0.01, 1. - deployment.error_rate) / max(1e-3, time_to_first_token + wait)
+        if deployment.budget is not None:
+            remaining_tokens, remaining_requests = deployment.budget.reported_remaining
+            if remaining_tokens is not None and tokens > 0:
+                weight *= min(1., remaining_tokens / (self._quota_headroom * tokens))
+            if remaining_requests is not None:
+                weight *= min(1., remaining_requests / self._quota_headroom)
+        return max(weight, 1e-9)
+
+    async def stream(self, messages: list[Mapping[str, Any]], **kwargs: Any) -> AsyncIterator[str]:
+        """
+        Stream the content of the chat completion from the chosen deployment.
+
+        :param messages: The messages of the request.
+        :param kwargs: The other parameters of the chat completion.
+        :return: The iterator of the content deltas.
+        :raises: The error of the last tried deployment if none of them has answered.
+        """
+        tokens = estimate_request_tokens(
+            {'messages': messages, 'max_tokens': kwargs.get('max_tokens')}, self._default_completion_tokens)
+        tried: set[str] = set()
+        error: Optional[BaseException] = None
+        for _ in range(self._max_attempts):
+            deployment = self.choose(tokens, tried)
+            if deployment is None:
+                break
+            if error is not None:
+                logger.warning("The chat completion is sent to %s after the error: %s", deployment.label, error)
+            tried.add(deployment.label)
+            started = False
+            start = time.perf_counter()
+            deployment.in_flight += 1
+            response = None
+            try:
+                response = await deployment.client.complete(
+                    model=deployment.name, messages=messages, stream=True, **kwargs)
+                async for event in response:
+                    if event.choices and event.choices[0].delta.content:
+                        if not started:
+                            started = True
+                            deployment.record_first_token(time.perf_counter() - start)
+                        yield event.choices[0].delta.content
+                deployment.record_result(SUCCESS)
+                return
+            except Exception as e:
+                result = self._classify(e)
+                if not isinstance(e, TokenBudgetExceeded):
+                    # The requests, rejected by the budget, are counted by the budget itself.
+                    deployment.record_result(result)
+                if started or result == BAD_REQUEST:
+                    raise
+                CHAT_DEPLOYMENT_FAILOVERS.labels(deployment.label).inc()
+                error = e
+            finally:
+                deployment.in_flight -= 1
+                if response is not None:
+                    await response.aclose()
+        raise error
+
+    @staticmethod
+    def _classify(error: BaseException) -> str:
+        """Return the result of the failed request."""
+        if isinstance(error, TokenBudgetExceeded):
+            return THROTTLED
+        if isinstance(error, HttpResponseError) and error.status_code is not None:
+            if error.status_code == 429:
+                return THROTTLED
+            return ERROR if error.status_code in RETRYABLE_STATUS_CODES else BAD_REQUEST
+        if isinstance(error, (AzureError, asyncio.TimeoutError, OSError)):
+            return ERROR
+        return BAD_REQUEST
+
+    def stats(self) -> dict[str, dict[str, Any]]:
+        """Return the statistics of the deployments by their labels."""
+        return {deployment.label: deployment.stats() for deployment in self._deployments}
+
+    async def close(self) -> None:
+        """Close the clients of the deployments."""
+        for deployment in self._deployments:
+            await deployment.client.close()
@@ -0,0 +1,129 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+# See LICENSE file in the project root for full license information.
+import asyncio
+from collections import Counter
+from typing import Any, Optional
+
+from azure.ai.inference.aio import EmbeddingsClient
+
+from .metrics import EMBEDDING_BATCH_SIZE
+
+
+class EmbeddingBatcher:
+    """
+    The coalescer of the concurrent single input embedding requests.
+
+    The inputs arriving within max_wait seconds are sent to the service as one batched
+    embed call and each caller gets its own vector back. The object exposes the same
+    embed method as EmbeddingsClient, so it can be passed to SearchIndexManager instead
+    of the client. The requests with the list of inputs are sent to the client as is.
+
+    :param embeddings_client: The embedding client.
+    :param max_wait: The time in seconds to wait for the other inputs, before sending the batch.
+    :param max_batch_size: The maximal number of inputs in one batch. The batch is sent
+                           without waiting as soon as it is full.
+    """
+
+    def __init__(
+            self,
+            embeddings_client: EmbeddingsClient,
+            max_wait: float = 0.005,
+            max_batch_size: int = 16,
+        ) -> None:
+        """Constructor."""
+        if max_batch_size <= 0:
+            raise ValueError("The max_batch_size must be positive.")
+        self._embeddings_client = embeddings_client
+        self._max_wait = max_wait
+        self._max_batch_size = max_batch_size
+        self._pending: dict[tuple[Optional[str], Optional[int]], list[tuple[str, asyncio.Future]]] = {}
+        self._timers: dict[tuple[Optional[str], Optional[int]], asyncio.TimerHandle] = {}
+        self._tasks = set()
+        self.batch_sizes = Counter()
+
+    async def embed(
+            self,
+            input: Any,
+            dimensions: Optional[int] = None,
+            model: Optional[str] = None,
+            **kwargs: Any) -> Any:
+        """
+        Return the embedding of the input.
+
+        :param input: The text to embed. The list of texts is sent without batching.
+        :param dimensions: The number of dimensions in the embedding.
+        :param model: The embedding model.
+        :return: The dictionary with the data list, containing one embedding.
+        """
+        if not isinstance(input, str) or kwargs:
+            return await self._embeddings_client.embed(input=input, dimensions=dimensions, model=model, **kwargs)
+        key = (model, dimensions)
+        future = asyncio.get_running_loop().create_future()
+        pending = self._pending.setdefault(key, [])
+        pending.append((input, future))
+        if len(pending) >= self._max_batch_size:
+            self._flush(key)
+        elif len(pending) == 1:
+            self._timers[key] = asyncio.get_running_loop().call_later(self._max_wait, self._flush, key)
+        embedding = await future
+        return {'data': [{'embedding': embedding, 'index': 0}]}
+
+    def _flush(self, key: tuple[Optional[str], Optional[int]]) -> None:
+        """Send the pending inputs for the model and dimensions."""
+        timer = self._timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+        batch = self._pending.pop(key, None)
+        if not batch:
+            return
+        task = asyncio.get_running_loop().create_task(self._send(key, batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _send(
+            self,
+            key: tuple[Optional[str], Optional[int]],
+            batch: list[tuple[str, asyncio.Future]]) -> None:
+        """Embed the batch and resolve the futures of the callers."""
+        model, dimensions = key
+        # The same question, asked by several users at once, is embedded once.
+        texts = list(dict.fromkeys(text for text, _ in batch))
+        self.batch_sizes[len(texts)] += 1
+        EMBEDDING_BATCH_SIZE.observe(len(texts))
+        try:
+            response = await self._embeddings_client.embed(input=texts, dimensions=dimensions, model=model)
+            data = sorted(response['data'], key=lambda item: item['index'])
+            embeddings = {text: item['embedding'] for text, item in zip(texts, data)}
+            for text, future in batch:
+                if not future.done():
+                    future.set_result(embeddings[text])
+        except BaseException as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            if not isinstance(e, Exception):
+                raise
+
+    def stats(self) -> dict[str, Any]:
+        """
+        Return the batching statistics.
+
+        :return: The dictionary with the number of batches, the number of embedded inputs,
+                 the mean batch size and the histogram of batch sizes.
+        """
+        batches = sum(self.batch_sizes.values())
+        inputs = sum(size * count for size, count in self.batch_sizes.items())
+        return {
+            'batches': batches,
+            'inputs': inputs,
+            'mean_batch_size': inputs / batches if batches else 0.,
+            'batch_sizes': dict(sorted(self.batch_sizes.items())),
+        }
+
+    async def close(self) -> None:
+        """Send the pending inputs and wait for the batches in flight."""
+        for key in list(self._pending):
+            self._flush(key)
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
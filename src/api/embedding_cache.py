@@ -0,0 +1,239 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+# See LICENSE file in the project root for full license information.
+import array
+import asyncio
+import hashlib
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Optional, TypeVar
+
+from .metrics import EMBEDDING_CACHE_REQUESTS
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar('T')
+
+
+class EmbeddingCache:
+    """
+    The two tier cache of the query embeddings.
+
+    The first tier is the bounded in-process LRU dictionary. The second, optional tier
+    is the SQLite database, which is shared by all workers on the same host, so the
+    question embedded by one worker is not embedded again by the others. The database is
+    read in a thread and written in the background, so it does not block the event loop.
+
+    :param max_size: The maximal number of embeddings kept in memory.
+    :param ttl: The time in seconds after which the cached embedding expires.
+    :param disk_path: The path to the SQLite file. If not set, only the memory cache is used.
+    """
+
+    def __init__(
+            self,
+            max_size: int = 1024,
+            ttl: float = 3600,
+            disk_path: Optional[str] = None,
+        ) -> None:
+        """Constructor."""
+        if max_size <= 0:
+            raise ValueError("The max_size of the embedding cache must be positive.")
+        self._max_size = max_size
+        self._ttl = ttl
+        self._disk_path = disk_path
+        self._memory: OrderedDict[str, tuple[float, list[float]]] = OrderedDict()
+        # The connection is used by the threads, running the queries one at a time.
+        self._connection: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+        self._closed = False
+        self._writes: set[asyncio.Task[None]] = set()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        """
+        Normalize the text, so that the same questions share the cache entry.
+
+        :param text: The question.
+        :return: The text with collapsed white spaces in the lower case.
+        """
+        return ' '.join(text.split()).casefold()
+
+    @staticmethod
+    def make_key(text: str, model: str, dimensions: Optional[int]) -> str:
+        """
+        Return the cache key for the text, embedded by the model.
+
+        :param text: The question.
+        :param model: The embedding model.
+        :param dimensions: The number of dimensions in the embedding if any.
+        :return: The cache key.
+        """
+        key = f"{model}\0{dimensions}\0{EmbeddingCache.normalize(text)}"
+        return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+    async def get(
+            self,
+            text: str,
+            model: str,
+            dimensions: Optional[int],
+            record_stats: bool = True) -> Optional[list[float]]:
+        """
+        Return the cached embedding or None if it is absent or expired.
+
+        :param text: The question.
+        :param model: The embedding model.
+        :param dimensions: The number of dimensions in the embedding if any.
+        :param record_stats: If False, the hit and miss counters are not updated.
+        :return: The embedding or None.
+        """
+        key = EmbeddingCache.make_key(text, model, dimensions)
+        entry = self._memory.get(key)
+        if entry is not None:
+            created, embedding = entry
+            if time.time() - created < self._ttl:
+                self._memory.move_to_end(key)
+                if record_stats:
+                    self.memory_hits += 1
+                    EMBEDDING_CACHE_REQUESTS.labels('memory_hit').inc()
+                return embedding
+            del self._memory[key]
+        entry = None
+        if self._disk_path is not None:
+            entry = await asyncio.to_thread(self._locked, self._disk_get, key)
+        if entry is not None:
+            self._memory_put(key, *entry)
+            if record_stats:
+                self.disk_hits += 1
+                EMBEDDING_CACHE_REQUESTS.labels('disk_hit').inc()
+            return entry[1]
+        if record_stats:
+            self.misses += 1
+            EMBEDDING_CACHE_REQUESTS.labels('miss').inc()
+        return None
+
+    def put(self, text: str, model: str, dimensions: Optional[int], embedding: list[float]) -> None:
+        """
+        Add the embedding to the cache.
+
+        The embedding is written to the SQLite database in the background.
+        :param text: The question.
+        :param model: The embedding model.
+        :param dimensions: The number of dimensions in the embedding if any.
+        :param embedding: The embedding of the question.
+        """
+        key = EmbeddingCache.make_key(text, model, dimensions)
+        created = time.time()
+        self._memory_put(key, created, embedding)
+        if self._disk_path is not None:
+            task = asyncio.get_running_loop().create_task(
+                asyncio.to_thread(self._locked, self._disk_put, key, created, embedding))
+            self._writes.add(task)
+            task.add_done_callback(self._writes.discard)
+
+    def stats(self) -> dict[str, int]:
+        """
+        Return the cache counters.
+
+        :return: The dictionary with the numbers of hits, misses and cached entries.
+        """
+        return {
+            'memory_hits': self.memory_hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'size': len(self._memory),
+        }
+
+    def _memory_put(self, key: str, created: float, embedding: list[float]) -> None:
+        """Put the embedding to the LRU dictionary and evict the least recently used one."""
+        self._memory[key] = (created, embedding)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self._max_size:
+            self._memory.popitem(last=False)
+
+    def _locked(self, function: Callable[..., T], *args: Any) -> T:
+        """Call the function, holding the lock of the connection."""
+        with self._lock:
+            return function(*args)
+
+    def _get_connection(self) -> Optional[sqlite3.Connection]:
+        """Open the SQLite database if it was configured."""
+        if self._disk_path is None or self._closed:
+            return None
+        if self._connection is None:
+            self._connection = sqlite3.connect(
+                self._disk_path, timeout=5, isolation_level=None, check_same_thread=False)
+            # The write ahead log lets the workers read while the other one writes.
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings "
+                "(key TEXT PRIMARY KEY, created REAL NOT NULL, embedding BLOB NOT NULL)")
+        return self._connection
+
+    def _disk_get(self, key: str) -> Optional[tuple[float, list[float]]]:
+        """Read the embedding from the SQLite database."""
+        connection = self._get_connection()
+        if connection is None:
+            return None
+        row = connection.execute(
+            "SELECT created, embedding FROM embeddings WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        created, blob = row
+        if time.time() - created >= self._ttl:
+            connection.execute("DELETE FROM embeddings WHERE key = ?", (key,))
+            return None
+        return created, array.array('f', blob).tolist()
+
+    def _disk_put(self, key: str, created: float, embedding: list[float]) -> None:
+        """Write the embedding to the SQLite database."""
+        connection = self._get_connection()
+        if connection is None:
+            return
+        try:
+            connection.execute(
+                "INSERT OR REPLACE INTO embeddings (key, created, embedding) VALUES (?, ?, ?)",
+                (key, created, array.array('f', embedding).tobytes()))
+        except sqlite3.Error as e:
+            # Nobody waits for the write, so the embedding is only lost for the other workers.
+            logger.warning("Failed to write the embedding to %s, error: %s", self._disk_path, str(e))
+
+    async def close(self) -> None:
+        """Finish the pending writes and close the SQLite database."""
+        await asyncio.gather(*self._writes, return_exceptions=True)
+        if self._disk_path is not None:
+            await asyncio.to_thread(self._locked, self._close)
+
+    def _close(self) -> None:
+        self._closed = True
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+
+def read_questions(questions_file: str) -> list[str]:
+    """
+    Read the questions to warm up the embedding cache.
+
+    In the markdown file, like docs/sample_questions.md, only the list items are
+    treated as questions. In the other files each non empty line is the question.
+    :param questions_file: The file with questions.
+    :return: The list of questions.
+    """
+    is_markdown = questions_file.endswith('.md')
+    questions = []
+    with open(questions_file, encoding='utf-8') as fp:
+        for line in fp:
+            line = line.strip()
+            if is_markdown:
+                if not line.startswith(('- ', '* ')):
+                    continue
+                line = line[2:].strip()
+            if line:
+                questions.append(line)
+    return questions
@@ -0,0 +1,220 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+# See LICENSE file in the project root for full license information.
+"""
+Readers and writers of the embeddings files.
+
+Besides the csv file, generated by SearchIndexManager.build_embeddings_file, the embeddings
+can be stored in the binary format, which consists of three files sharing the same prefix:
+
+- ``<prefix>.npy``: the float32 matrix of embeddings, one row per token.
+- ``<prefix>.tokens``: the UTF-8 encoded tokens, concatenated together.
+- ``<prefix>.offsets.npy``: the int64 array of n + 1 offsets of tokens in the ``.tokens`` file.
+
+All three files are memory mapped on load, so the gunicorn workers share one copy
+of the data in the page cache and nothing is parsed at startup.
+"""
+import argparse
+import csv
+import json
+import os
+from collections.abc import Iterator, Sequence
+from typing import Callable, Optional, Union
+
+import numpy as np
+
+BINARY_SUFFIX = '.npy'
+TOKENS_SUFFIX = '.tokens'
+OFFSETS_SUFFIX = '.offsets.npy'
+
+
+class TokenStore(Sequence[str]):
+    """
+    The read only sequence of tokens, decoded from the memory mapped buffer on access.
+
+    :param data: The buffer with the concatenated UTF-8 encoded tokens.
+    :param offsets: The array of n + 1 offsets of the tokens in data.
+    """
+
+    def __init__(self, data: Union[bytes, np.ndarray], offsets: np.ndarray) -> None:
+        """Constructor."""
+        self._data = data
+        self._offsets = offsets
+
+    def __len__(self) -> int:
+        return len(self._offsets) - 1
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("Token index out of range.")
+        start, end = int(self._offsets[index]), int(self._offsets[index + 1])
+        return bytes(self._data[start:end]).decode('utf-8')
+
+
+def _binary_paths(embeddings_file: str) -> tuple[str, str, str]:
+    """Return the paths of the vectors, tokens and offsets files."""
+    prefix = embeddings_file[:-len(BINARY_SUFFIX)] if embeddings_file.endswith(BINARY_SUFFIX) else embeddings_file
+    return prefix + BINARY_SUFFIX, prefix + TOKENS_SUFFIX, prefix + OFFSETS_SUFFIX
+
+
+def is_binary(embeddings_file: str) -> bool:
+    """
+    Return True if the file is in the binary format.
+
+    :param embeddings_file: The embeddings file.
+    :return: True if the file has the .npy extension.
+    """
+    return embeddings_file.endswith(BINARY_SUFFIX)
+
+
+def read_csv(
+        embeddings_file: str,
+        token_filter: Optional[Callable[[str], bool]] = None) -> Iterator[tuple[str, list[float]]]:
+    """
+    Read the csv embeddings file row by row.
+
+    :param embeddings_file: The csv file with the token and embedding columns.
+    :param token_filter: The function, returning False for the tokens to skip. The embeddings
+                         of the skipped tokens are not parsed.
+    :return: The iterator over the tuples of token and embedding.
+    """
+    with open(embeddings_file, newline='') as fp:
+        reader = csv.DictReader(fp)
+        for row in reader:
+            if token_filter is None or token_filter(row['token']):
+                yield row['token'], json.loads(row['embedding'])
+
+
+def iter_tokens(embeddings_file: str) -> Iterator[str]:
+    """
+    Iterate over the tokens of the csv or binary file without reading the embeddings.
+
+    :param embeddings_file: The csv file or the .npy file in the binary format.
+    :return: The iterator over the tokens.
+    """
+    if not is_binary(embeddings_file):
+        with open(embeddings_file, newline='') as fp:
+            for row in csv.DictReader(fp):
+                yield row['token']
+        return
+    yield from load_embeddings(embeddings_file)[0]
+
+
+def write_binary(embeddings_file: str, tokens: Sequence[str], vectors: np.ndarray) -> None:
+    """
+    Write the tokens and embeddings in the binary format.
+
+    The files are written next to the destination first and then moved in place,
+    so that the running workers never see the partially written files.
+    :param embeddings_file: The path to the .npy file to be written.
+    :param tokens: The tokens.
+    :param vectors: The embeddings, one row per token.
+    """
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    if vectors.ndim != 2 or vectors.shape[0] != len(tokens):
+        raise ValueError("The vectors must be a two dimensional array with one row per token.")
+    vectors_path, tokens_path, offsets_path = _binary_paths(embeddings_file)
+    encoded = [token.encode('utf-8') for token in tokens]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(token) for token in encoded], out=offsets[1:])
+
+    with open(tokens_path + '.tmp', 'wb') as fp:
+        for token in encoded:
+            fp.write(token)
+    with open(offsets_path + '.tmp', 'wb') as fp:
+        np.save(fp, offsets)
+    with open(vectors_path + '.tmp', 'wb') as fp:
+        np.save(fp, vectors)
+    # The vectors file is moved last, because its presence marks the complete data set.
+    os.replace(tokens_path + '.tmp', tokens_path)
+    os.replace(offsets_path + '.tmp', offsets_path)
+    os.replace(vectors_path + '.tmp', vectors_path)
+
+
+def convert_csv_to_binary(csv_file: str, embeddings_file: str) -> int:
+    """
+    Convert the csv embeddings file to the binary format.
+
+    :param csv_file: The csv file with the token and embedding columns.
+    :param embeddings_file: The path to the .npy file to be written.
+    :return: The number of converted rows.
+    """
+    tokens = []
+    vectors = []
+    for token, vector in read_csv(csv_file):
+        tokens.append(token)
+        vectors.append(vector)
+    if not vectors:
+        raise ValueError(f"The embeddings file {csv_file} is empty.")
+    write_binary(embeddings_file, tokens, np.array(vectors, dtype=np.float32))
+    return len(tokens)
+
+
+def load_embeddings(embeddings_file: str, mmap: bool = True) -> tuple[Sequence[str], np.ndarray]:
+    """
+    Load the tokens and embeddings from the csv or binary file.
+
+    :param embeddings_file: The csv file or the .npy file in the binary format.
+    :param mmap: If True, the binary files are memory mapped instead of being read into memory.
+    :return: The tuple of tokens and the float32 matrix of embeddings.
+    """
+    if not is_binary(embeddings_file):
+        tokens = []
+        vectors = []
+        for token, vector in read_csv(embeddings_file):
+            tokens.append(token)
+            vectors.append(vector)
+        if not vectors:
+            raise ValueError(f"The embeddings file {embeddings_file} is empty.")
+        return tokens, np.array(vectors, dtype=np.float32)
+
+    vectors_path, tokens_path, offsets_path = _binary_paths(embeddings_file)
+    mmap_mode = 'r' if mmap else None
+    vectors = np.load(vectors_path, mmap_mode=mmap_mode)
+    offsets = np.load(offsets_path, mmap_mode=mmap_mode)
+    if vectors.dtype != np.float32 or vectors.ndim != 2:
+        raise ValueError(f"The embeddings file {embeddings_file} must contain the two dimensional float32 array.")
+    if len(offsets) != vectors.shape[0] + 1:
+        raise ValueError(f"The tokens of {embeddings_file} do not match the embeddings.")
+    if offsets[-1] == 0:
+        # The empty file cannot be memory mapped.
+        data = b''
+    elif mmap:
+        data = np.memmap(tokens_path, dtype=np.uint8, mode='r')
+    else:
+        with open(tokens_path, 'rb') as fp:
+            data = fp.read()
+    return TokenStore(data, offsets), vectors
+
+
+def iter_embeddings(
+        embeddings_file: str,
+        token_filter: Optional[Callable[[str], bool]] = None) -> Iterator[tuple[str, list[float]]]:
+    """
+    Iterate over the tokens and embeddings of the csv or binary file.
+
+    :param embeddings_file: The csv file or the .npy file in the binary format.
+    :param token_filter: The function, returning False for the tokens to skip.
+    :return: The iterator over the tuples of token and embedding.
+    """
+    if not is_binary(embeddings_file):
+        yield from read_csv(embeddings_file, token_filter)
+        return
+    tokens, vectors = load_embeddings(embeddings_file)
+    for i in range(len(tokens)):
+        token = tokens[i]
+        if token_filter is None or token_filter(token):
+            yield token, vectors[i].tolist()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert the csv embeddings file to the binary format.")
+    parser.add_argument('csv_file', help="The csv file with the token and embedding columns.")
+    parser.add_argument('embeddings_file', help="The .npy file to be written.")
+    args = parser.parse_args()
+    rows = convert_csv_to_binary(args.csv_file, args.embeddings_file)
+    print(f"Converted {rows} rows to {args.embeddings_file}.")
@@ -0,0 +1,184 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+# See LICENSE file in the project root for full license information.
+import asyncio
+import logging
+import time
+from collections.abc import Iterable
+from types import SimpleNamespace
+from typing import Optional
+from urllib.parse import urlparse
+
+import aiohttp
+from azure.core.pipeline.transport import AioHttpTransport
+
+from .metrics import (
+    HTTP_POOL_CONNECT_SECONDS,
+    HTTP_POOL_CONNECTIONS,
+    HTTP_POOL_QUEUE_SECONDS,
+    HTTP_POOL_REQUESTS,
+)
+
+logger = logging.getLogger(__name__)
+
+
+class HttpPool:
+    """
+    The HTTP connection pool of the worker, shared by the Azure clients.
+
+    All clients send their requests through one aiohttp session, so the connections to
+    the same host, once opened, are reused by all of them while they are idle for less
+    than keepalive_timeout seconds, and the resolved addresses are cached for dns_ttl
+    seconds. The pool can be warmed up by opening the connections to the service hosts
+    before the worker takes the traffic, so the first requests do not wait for the DNS
+    lookup and the TLS handshake. The time to open the connections, to wait for the free
+    connection and the number of the new and reused connections are reported by the
+    metrics, and the number of the connections in use and idle is sampled every
+    metrics_interval seconds.
+
+    :param limit: The maximal number of the connections, 0 for no limit.
+    :param limit_per_host: The maximal number of the connections to one host, 0 for no limit.
+    :param keepalive_timeout: The number of seconds to keep the idle connection open.
+    :param connect_timeout: The number of seconds to open the connection.
+    :param read_timeout: The number of seconds to wait for the data from the open connection.
+    :param dns_ttl: The number of seconds to cache the resolved addresses.
+    :param metrics_interval: The number of seconds between the samples of the connections.
+    """
+
+    def __init__(
+            self,
+            limit: int = 100,
+            limit_per_host: int = 0,
+            keepalive_timeout: float = 120.,
+            connect_timeout: float = 10.,
+            read_timeout: float = 300.,
+            dns_ttl: int = 300,
+            metrics_interval: float = 1.,
+        ) -> None:
+        """Constructor."""
+        if limit < 0 or limit_per_host < 0:
+            raise ValueError("The limit and limit_per_host must not be negative.")
+        if keepalive_timeout <= 0 or connect_timeout <= 0 or read_timeout <= 0 or metrics_interval <= 0:
+            raise ValueError("The timeouts and metrics_interval must be positive.")
+        self._limit = limit
+        self._limit_per_host = limit_per_host
+        self._keepalive_timeout = keepalive_timeout
+        self._connect_timeout = connect_timeout
+        self._read_timeout = read_timeout
+        self._dns_ttl = dns_ttl
+        self._metrics_interval = metrics_interval
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._transport: Optional[AioHttpTransport] = None
+        self._metrics_task: Optional[asyncio.Task] = None
+
+    @property
+    def transport(self) -> AioHttpTransport:
+        """
+        The transport of the Azure clients, which sends the requests through the pool.
+
+        The clients do not own the transport, so closing them does not close the pool.
+        It must be first accessed in the running event loop.
+        """
+        if self._transport is None:
+            self._open()
+        return self._transport
+
+    def _open(self) -> None:
+        """Create the session with the connector and the transport."""
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_connection_queued_start.append(self._on_start)
+        trace_config.on_connection_queued_end.append(self._on_queued_end)
+        trace_config.on_connection_create_start.append(self._on_start)
+        trace_config.on_connection_create_end.append(self._on_create_end)
+        trace_config.on_connection_reuseconn.append(self._on_reuse)
+        connector = aiohttp.TCPConnector(
+            limit=self._limit,
+            limit_per_host=self._limit_per_host,
+            keepalive_timeout=self._keepalive_timeout,
+            ttl_dns_cache=self._dns_ttl,
+        )
+        # The same options as those of the session, created by the transport itself.
+        self._session = aiohttp.ClientSession(
+            connector=connector,
+            trust_env=True,
+            cookie_jar=aiohttp.DummyCookieJar(),
+            auto_decompress=False,
+            trace_configs=[trace_config],
+        )
+        self._transport = AioHttpTransport(
+            session=self._session,
+            session_owner=False,
+            connection_timeout=self._connect_timeout,
+            read_timeout=self._read_timeout,
+        )
+        self._metrics_task = asyncio.get_running_loop().create_task(self._sample_connections())
+
+    async def warm_up(self, urls: Iterable[str], connections: int = 2) -> int:
+        """
+        Open the connections to the hosts of the URLs and leave them in the pool.
+
+        Each host is requested by the HEAD requests, which open the connections concurrently;
+        the status of the responses does not matter.
+
+        :param urls: The URLs of the services.
+        :param connections: The number of the connections to open to each host.
+        :return: The number of the opened connections.
+        """
+        if self._transport is None:
+            self._open()
+        origins = {f"{url.scheme}://{url.netloc}/" for url in map(urlparse, urls) if url.netloc}
+        timeout = aiohttp.ClientTimeout(total=self._connect_timeout)
+
+        async def open_connection(origin: str) -> bool:
+            try:
+                async with self._session.head(origin, timeout=timeout, allow_redirects=False):
+                    return True
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                logger.warning("Failed to open the connection to %s: %s", origin, e)
+                return False
+
+        opened = await asyncio.gather(*(open_connection(origin) for origin in origins for _ in range(connections)))
+        return sum(opened)
+
+    def stats(self) -> dict[str, int]:
+        """Return the number of the connections in use and idle."""
+        connector = self._session.connector if self._session is not None else None
+        if connector is None:
+            return {'in_use': 0, 'idle': 0}
+        # aiohttp has no public counters of the connections.
+        return {
+            'in_use': len(getattr(connector, '_acquired', ())),
+            'idle': sum(len(connections) for connections in getattr(connector, '_conns', {}).values()),
+        }
+
+    async def _sample_connections(self) -> None:
+        while True:
+            for state, count in self.stats().items():
+                HTTP_POOL_CONNECTIONS.labels(state).set(count)
+            await asyncio.sleep(self._metrics_interval)
+
+    @staticmethod
+    async def _on_start(session: aiohttp.ClientSession, context: SimpleNamespace, params: object) -> None:
+        context.start = time.perf_counter()
+
+    @staticmethod
+    async def _on_queued_end(session: aiohttp.ClientSession, context: SimpleNamespace, params: object) -> None:
+        HTTP_POOL_QUEUE_SECONDS.observe(time.perf_counter() - context.start)
+
+    @staticmethod
+    async def _on_create_end(session: aiohttp.ClientSession, context: SimpleNamespace, params: object) -> None:
+        HTTP_POOL_CONNECT_SECONDS.observe(time.perf_counter() - context.start)
+        HTTP_POOL_REQUESTS.labels('new').inc()
+
+    @staticmethod
+    async def _on_reuse(session: aiohttp.ClientSession, context: SimpleNamespace, params: object) -> None:
+        HTTP_POOL_REQUESTS.labels('reused').inc()
+
+    async def close(self) -> None:
+        """Close the connections."""
+        if self._metrics_task is not None:
+            self._metrics_task.cancel()
+        if self._session is not None:
+            await self._session.close()
+        for state in ('in_use', 'idle'):
+            HTTP_POOL_CONNECTIONS.labels(state).set(0)
@@ -0,0 +1,154 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+# See LICENSE file in the project root for full license information.
+import math
+import re
+from collections.abc import Iterable, Sequence
+from typing import NamedTuple
+
+import numpy as np
+
+from .embeddings_file import iter_tokens
+
+_WORD_PATTERN = re.compile(r"\w+")
+# The words of the questions, which are rare in the documents, but do not name what is asked about.
+_STOP_WORDS = frozenset(
+    "a about an and are be can could did do does for from had has have how i if in is it its me much my "
+    "of on or please should tell that the their there these this to us was we were what when where "
+    "which who why will with would you your".split())
+
+
+def tokenize(text: str) -> list[str]:
+    """
+    Split the text to the lower case words for the keyword search.
+
+    :param text: The text.
+    :return: The words.
+    """
+    return _WORD_PATTERN.findall(text.casefold())
+
+
+def reciprocal_rank_fusion(
+        rankings: Iterable[Sequence[tuple[str, float]]],
+        k: int = 60) -> list[tuple[str, float]]:
+    """
+    Merge the rankings of the chunks by the reciprocal rank fusion.
+
+    :param rankings: The lists of chunks with their scores, the best match first.
+    :param k: The constant, which lowers the weight of the first ranks.
+    :return: The chunks with the sum of 1 / (k + rank) over the rankings, the best first.
+    """
+    scores: dict[str, float] = {}
+    for ranking in rankings:
+        for rank, (token, _) in enumerate(ranking, start=1):
+            scores[token] = scores.get(token, 0.) + 1. / (k + rank)
+    return sorted(scores.items(), key=lambda item: item[1], reverse=True)
+
+
+class KeywordSearchResult(NamedTuple):
+    """The result of the keyword search."""
+    # The chunks with their BM25 scores, the best match first.
+    results: list[tuple[str, float]]
+    # The number of the rare words of the question, found in the index.
+    rare_words: int
+    # The number of these words, found in the best chunk.
+    rare_words_in_best: int
+
+
+class KeywordIndex:
+    """
+    The in-process BM25 index of the text chunks.
+
+    The postings of all words are kept in flat numpy arrays with their BM25 weights,
+    precomputed at build time, so the query is scored by adding up the weights of its
+    words. Besides the results, the search returns how many rare words of the question,
+    found in at most rare_fraction of the chunks or in none of them, the best chunk
+    contains. The exact product names and item numbers are such words, so the chunk, which
+    contains all of them, is likely the answer to the question about the product.
+
+    :param tokens: The text chunks.
+    :param k1: The BM25 saturation of the term frequency.
+    :param b: The BM25 normalization by the chunk length.
+    :param rare_fraction: The maximal share of the chunks, containing the rare word.
+    """
+
+    def __init__(
+            self,
+            tokens: Sequence[str],
+            k1: float = 1.5,
+            b: float = 0.75,
+            rare_fraction: float = 0.02,
+        ) -> None:
+        """Constructor."""
+        self._tokens = tokens
+        self._vocabulary: dict[str, int] = {}
+        postings: list[dict[int, int]] = []
+        lengths = np.zeros(len(tokens), dtype=np.float32)
+        for doc, text in enumerate(tokens):
+            words = tokenize(text)
+            lengths[doc] = len(words)
+            for word in words:
+                term = self._vocabulary.setdefault(word, len(self._vocabulary))
+                if term == len(postings):
+                    postings.append({})
+                postings[term][doc] = postings[term].get(doc, 0) + 1
+        count = len(tokens)
+        average_length = float(lengths.mean()) if count and lengths.any() else 1.
+        self._idf = np.array(
+            [math.log(1 + (count - len(p) + 0.5) / (len(p) + 0.5)) for p in postings], dtype=np.float32)
+        self._max_rare_count = max(1, int(rare_fraction * count))
+        self._offsets = np.zeros(len(postings) + 1, dtype=np.int64)
+        self._offsets[1:] = np.cumsum([len(p) for p in postings])
+        self._docs = np.fromiter((doc for p in postings for doc in p), dtype=np.int32, count=self._offsets[-1])
+        frequencies = np.fromiter(
+            (tf for p in postings for tf in p.values()), dtype=np.float32, count=self._offsets[-1])
+        norms = k1 * (1 - b + b * lengths[self._docs] / average_length)
+        idf = np.repeat(self._idf, np.diff(self._offsets))
+        self._weights = idf * frequencies * (k1 + 1) / (frequencies + norms)
+
+    def __len__(self) -> int:
+        return len(self._tokens)
+
+    def search(self, query: str, top_k: int = 5) -> KeywordSearchResult:
+        """
+        Return the chunks with the highest BM25 scores.
+
+        :param query: The question.
+        :param top_k: The number of chunks to return.
+        :return: The chunks and the number of the rare words of the question in the best of them.
+        """
+        words = set(tokenize(query))
+        known = {word: self._vocabulary[word] for word in words if word in self._vocabulary}
+        terms = list(known.values())
+        if not terms or top_k <= 0:
+            return KeywordSearchResult([], 0, 0)
+        scores = np.zeros(len(self._tokens), dtype=np.float32)
+        for term in terms:
+            start, end = self._offsets[term], self._offsets[term + 1]
+            # Each chunk occurs in the postings of the word once.
+            scores[self._docs[start:end]] += self._weights[start:end]
+        matched = int(np.count_nonzero(scores))
+        top_k = min(top_k, matched)
+        candidates = np.argpartition(-scores, top_k - 1)[:top_k]
+        order = candidates[np.argsort(-scores[candidates], kind='stable')]
+        best = int(order[0])
+        rare_terms = [term for word, term in known.items() if word not in _STOP_WORDS and
+                      self._offsets[term + 1] - self._offsets[term] <= self._max_rare_count]
+        rare_terms_in_best = sum(
+            1 for term in rare_terms if best in self._docs[self._offsets[term]:self._offsets[term + 1]])
+        # The words, absent in the index, are the rarest ones, which no chunk contains.
+        unknown_words = sum(1 for word in words if word not in known and word not in _STOP_WORDS)
+        return KeywordSearchResult(
+            [(self._tokens[i], float(scores[i])) for i in order],
+            len(rare_terms) + unknown_words,
+            rare_terms_in_best)
+
+    @staticmethod
+    def from_file(embeddings_file: str) -> 'KeywordIndex':
+        """
+        Build the index of the chunks of the embeddings file.
+
+        :param embeddings_file: The csv file or the .npy file in the binary format.
+        :return: The index.
+        """
+        return KeywordIndex(list(iter_tokens(embeddings_file)))
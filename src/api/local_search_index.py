@@ -0,0 +1,212 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+# See LICENSE file in the project root for full license information.
+from collections.abc import Sequence
+from typing import Optional
+
+import numpy as np
+
+from .embeddings_file import load_embeddings
+from .quantization import QuantizedVectors
+
+
+class LocalSearchIndex:
+    """
+    The in-process vector index, used instead of Azure AI Search for small corpora.
+
+    The embeddings are kept in one contiguous float32 matrix and the cosine similarity
+    is computed with a single matrix product, so no network round trip is needed.
+    If the quantized codes of the embeddings are given, the chunks are scored on the
+    codes instead, and rescore_factor times top_k best of them are rescored with the
+    embeddings, so only these rows of the memory mapped matrix are read.
+
+    :param tokens: The text chunks, one per row of vectors.
+    :param vectors: The two dimensional array of embeddings.
+    :param quantized: The quantized codes of the embeddings.
+    :param rescore_factor: The number of the candidates, rescored exactly, per returned chunk.
+    """
+
+    def __init__(
+            self,
+            tokens: Sequence[str],
+            vectors: np.ndarray,
+            quantized: Optional[QuantizedVectors] = None,
+            rescore_factor: int = 10,
+        ) -> None:
+        """Constructor."""
+        if rescore_factor <= 0:
+            raise ValueError("The rescore_factor must be positive.")
+        matrix = np.asarray(vectors, dtype=np.float32)
+        if matrix.ndim != 2:
+            raise ValueError("The vectors must be a two dimensional array.")
+        if matrix.shape[0] != len(tokens):
+            raise ValueError(
+                f"The number of tokens ({len(tokens)}) is different "
+                f"from the number of vectors ({matrix.shape[0]}).")
+        if quantized is not None and len(quantized) != matrix.shape[0]:
+            raise ValueError("The quantized codes do not match the vectors.")
+        self._tokens = tokens
+        self._matrix = np.ascontiguousarray(matrix)
+        self._quantized = quantized
+        self._rescore_factor = rescore_factor
+        self._rows: Optional[dict[str, int]] = None
+        if quantized is None:
+            # Keep the inverse norms aside instead of normalizing the matrix in place,
+            # so that a read only matrix can be used without copying it.
+            self._inv_norms = self._inverse_norms(self._matrix)
+
+    @staticmethod
+    def _inverse_norms(matrix: np.ndarray) -> np.ndarray:
+        norms = np.linalg.norm(matrix, axis=1)
+        norms[norms == 0] = 1.0
+        return (1.0 / norms).astype(np.float32)
+
+    @property
+    def nbytes(self) -> int:
+        """The size of the data, scanned by each search, in bytes."""
+        if self._quantized is not None:
+            return self._quantized.nbytes
+        return self._matrix.nbytes
+
+    @property
+    def dimensions(self) -> int:
+        """The number of dimensions in the embeddings."""
+        return self._matrix.shape[1]
+
+    def __len__(self) -> int:
+        return self._matrix.shape[0]
+
+    def search(self, vector: Sequence[float], top_k: int = 5) -> list[tuple[str, float]]:
+        """
+        Return the chunks, closest to the vector.
+
+        :param vector: The embedding of the question.
+        :param top_k: The number of chunks to return.
+        :return: The list of tuples with the chunk and its cosine similarity, the best match first.
+        """
+        return self.search_batch([vector], top_k=top_k)[0]
+
+    def search_batch(
+            self,
+            vectors: Sequence[Sequence[float]],
+            top_k: int = 5) -> list[list[tuple[str, float]]]:
+        """
+        Return the closest chunks for several vectors at once.
+
+        :param vectors: The embeddings of the questions.
+        :param top_k: The number of chunks to return for each question.
+        :return: The list of results, one per vector, in the same order.
+        """
+        scores, orders = self._search_indices(vectors, top_k)
+        return [[(self._tokens[i], float(row[i])) for i in order] for row, order in zip(scores, orders)]
+
+    def search_with_vectors(
+            self,
+            vector: Sequence[float],
+            top_k: int = 5) -> tuple[list[tuple[str, float]], np.ndarray]:
+        """
+        Return the chunks, closest to the vector, with their embeddings.
+
+        :param vector: The embedding of the question.
+        :param top_k: The number of chunks to return.
+        :return: The tuple of the list of chunks with their cosine similarity, the best match first,
+                 and the matrix of their embeddings.
+        """
+        scores, orders = self._search_indices([vector], top_k)
+        order = orders[0]
+        return [(self._tokens[i], float(scores[0][i])) for i in order], self._matrix[order]
+
+    def score(
+            self,
+            vector: Sequence[float],
+            tokens: Sequence[str]) -> tuple[list[tuple[str, float]], np.ndarray]:
+        """
+        Return the cosine similarity of the given chunks to the vector, with their embeddings.
+
+        :param vector: The embedding of the question.
+        :param tokens: The chunks, the ones absent in the index are skipped.
+        :return: The tuple of the list of chunks with their cosine similarity, in the order of tokens,
+                 and the matrix of their embeddings.
+        """
+        if self._rows is None:
+            self._rows = {token: i for i, token in enumerate(self._tokens)}
+        found = [token for token in tokens if token in self._rows]
+        query = np.asarray(vector, dtype=np.float32)
+        if query.shape != (self.dimensions,):
+            raise ValueError(f"The query vector must have {self.dimensions} dimensions.")
+        query_norm = float(np.linalg.norm(query)) or 1.0
+        rows = self._matrix[[self._rows[token] for token in found]]
+        scores = rows @ query * self._inverse_norms(rows) / query_norm
+        return [(token, float(score)) for token, score in zip(found, scores)], rows
+
+    def _search_indices(
+            self,
+            vectors: Sequence[Sequence[float]],
+            top_k: int) -> tuple[np.ndarray, list[np.ndarray]]:
+        """Return the similarity matrix and the indices of the closest chunks for each vector."""
+        queries = np.asarray(vectors, dtype=np.float32)
+        if queries.ndim != 2 or queries.shape[1] != self.dimensions:
+            raise ValueError(
+                f"The query vectors must have {self.dimensions} dimensions.")
+        if len(self) == 0 or top_k <= 0:
+            return np.zeros((queries.shape[0], 0), dtype=np.float32), \
+                [np.zeros(0, dtype=np.int64) for _ in range(queries.shape[0])]
+        query_norms = np.linalg.norm(queries, axis=1, keepdims=True)
+        query_norms[query_norms == 0] = 1.0
+        if self._quantized is not None:
+            return self._search_quantized(queries / query_norms, top_k)
+        scores = (queries @ self._matrix.T) * self._inv_norms / query_norms
+        top_k = min(top_k, len(self))
+        if top_k < len(self):
+            candidates = np.argpartition(-scores, top_k - 1, axis=1)[:, :top_k]
+        else:
+            candidates = np.tile(np.arange(len(self)), (queries.shape[0], 1))
+        orders = [row_candidates[np.argsort(-row[row_candidates], kind='stable')]
+                  for row, row_candidates in zip(scores, candidates)]
+        return scores, orders
+
+    def _search_quantized(self, queries: np.ndarray, top_k: int) -> tuple[np.ndarray, list[np.ndarray]]:
+        """Score the chunks on the codes and rescore the best candidates with the embeddings."""
+        scores = self._quantized.scores(queries)
+        top_k = min(top_k, len(self))
+        candidates_count = min(top_k * self._rescore_factor, len(self))
+        if candidates_count < len(self):
+            candidates = np.argpartition(-scores, candidates_count - 1, axis=1)[:, :candidates_count]
+        else:
+            candidates = np.tile(np.arange(len(self)), (queries.shape[0], 1))
+        orders = []
+        for row, query, row_candidates in zip(scores, queries, candidates):
+            # The sorted rows are read from the memory mapped file sequentially.
+            row_candidates = np.sort(row_candidates)
+            rows = self._matrix[row_candidates]
+            row[row_candidates] = rows @ query * self._inverse_norms(rows)
+            orders.append(row_candidates[np.argsort(-row[row_candidates], kind='stable')[:top_k]])
+        return scores, orders
+
+    @staticmethod
+    def from_file(
+            embeddings_file: str,
+            mmap: bool = True,
+            quantization: Optional[str] = None,
+            subvectors: Optional[int] = None,
+            rescore_factor: int = 10,
+        ) -> 'LocalSearchIndex':
+        """
+        Load the index from the embeddings file.
+
+        :param embeddings_file: The csv file, generated by build_embeddings_file,
+                                or the .npy file in the binary format.
+        :param mmap: If True, the binary file is memory mapped and shared between the processes.
+        :param quantization: The quantization method of the embeddings, int8 or pq, or None to search them exactly.
+                             The codes, written next to the binary file, are loaded; otherwise they are built.
+        :param subvectors: The number of the groups of dimensions of pq, if the codes are built.
+        :param rescore_factor: The number of the candidates, rescored exactly, per returned chunk.
+        :return: The loaded index.
+        """
+        tokens, vectors = load_embeddings(embeddings_file, mmap=mmap)
+        quantized = None
+        if quantization:
+            quantized = QuantizedVectors.load(embeddings_file, quantization, mmap=mmap)
+            if quantized is None or len(quantized) != len(tokens):
+                quantized = QuantizedVectors.build(vectors, quantization, subvectors)
+        return LocalSearchIndex(tokens, vectors, quantized=quantized, rescore_factor=rescore_factor)
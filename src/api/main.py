@@ -10,12 +10,29 @@ from urllib.parse import urlparse
 import fastapi
 from azure.ai.projects.aio import AIProjectClient
 from azure.ai.inference.aio import ChatCompletionsClient, EmbeddingsClient
+from azure.core.credentials import AzureKeyCredential
 from azure.identity import AzureDeveloperCliCredential, ManagedIdentityCredential
 from dotenv import load_dotenv
 from fastapi.staticfiles import StaticFiles
 
+from .admission import AdmissionController
+from .context_window import ContextWindow
+from .deployment_router import ChatDeployment, DeploymentRouter
+from .embedding_batcher import EmbeddingBatcher
+from .embedding_cache import EmbeddingCache, read_questions
+from .http_pool import HttpPool
+from .keyword_index import KeywordIndex
+from .local_search_index import LocalSearchIndex
+from .prompt_builder import PromptBuilder
+from .resilience import CircuitBreaker, ResilientCaller
+from .retrieval_gate import GateClassifier, RetrievalGate
+from .retrieval_policy import RetrievalPolicy
 from .search_index_manager import SearchIndexManager
-from .util import get_logger
+from .session_store import SessionStore
+from .stream_replay import StreamReplayStore
+from .token_budget import TokenBudget, TokenBudgetExceeded, TokenBudgetPolicy
+from .token_cache import CachingTokenCredential
+from .util import get_default_embeddings_file, get_logger
 
 logger = None
 enable_trace = False
@@ -35,10 +52,16 @@ async def lifespan(app: fastapi.FastAPI):
         user_identity_client_id = os.getenv("AZURE_CLIENT_ID")
         logger.info("Using ManagedIdentityCredential with client_id %s", user_identity_client_id)
         azure_credential = ManagedIdentityCredential(client_id=user_identity_client_id)
+    # All clients share the tokens, which are refreshed in the background before they expire,
+    # so the requests do not wait for the identity endpoint.
+    token_credential = CachingTokenCredential(
+        azure_credential,
+        refresh_margin=float(os.getenv('AZURE_TOKEN_REFRESH_MARGIN', '600')),
+    )
 
     endpoint = os.environ["AZURE_EXISTING_AIPROJECT_ENDPOINT"]
     project = AIProjectClient(
-        credential=azure_credential,
+        credential=token_credential,
         endpoint=endpoint,
     )
 
@@ -61,18 +84,76 @@ async def lifespan(app: fastapi.FastAPI):
     # Project endpoint has the form:   https://your-ai-services-account-name.services.ai.azure.com/api/projects/your-project-name
     # Inference endpoint has the form: https://your-ai-services-account-name.services.ai.azure.com/models
     # Strip the "/api/projects/your-project-name" part and replace with "/models":
-    inference_endpoint = f"https://{urlparse(endpoint).netloc}/models"
+    inference_endpoint = os.getenv('AZURE_AI_INFERENCE_ENDPOINT') or f"https://{urlparse(endpoint).netloc}/models"
 
-    chat =  ChatCompletionsClient(
-        endpoint=inference_endpoint,
-        credential=azure_credential,
-        credential_scopes=["https://ai.azure.com/.default"],
+    # The API keys are used instead of Entra ID only if they are set, for example,
+    # to run against the local stand-ins of the services in benchmarks.
+    if inference_key := os.getenv('AZURE_AI_INFERENCE_KEY'):
+        inference_credentials = dict(credential=AzureKeyCredential(inference_key))
+    else:
+        inference_credentials = dict(credential=token_credential, credential_scopes=["https://ai.azure.com/.default"])
+
+    # Pace the model requests to stay within the tokens and requests per minute quota of the deployments.
+    budget_max_wait = float(os.getenv('MODEL_BUDGET_MAX_WAIT', '10'))
+    chat_completion_tokens = int(os.getenv('AZURE_AI_CHAT_COMPLETION_TOKENS', '512'))
+    embed_budget = TokenBudget(
+        'embeddings',
+        tokens_per_minute=int(os.getenv('AZURE_AI_EMBED_TOKENS_PER_MINUTE', '0')),
+        requests_per_minute=int(os.getenv('AZURE_AI_EMBED_REQUESTS_PER_MINUTE', '0')),
+        max_wait=budget_max_wait,
+    )
+    # The model and search clients share one connection pool.
+    http_pool = HttpPool(
+        limit=int(os.getenv('HTTP_POOL_LIMIT', '100')),
+        limit_per_host=int(os.getenv('HTTP_POOL_LIMIT_PER_HOST', '0')),
+        keepalive_timeout=float(os.getenv('HTTP_POOL_KEEPALIVE_TIMEOUT', '120')),
+        connect_timeout=float(os.getenv('HTTP_POOL_CONNECT_TIMEOUT', '10')),
+        read_timeout=float(os.getenv('HTTP_POOL_READ_TIMEOUT', '300')),
+        dns_ttl=int(os.getenv('HTTP_POOL_DNS_TTL', '300')),
     )
+    # The chat completions are routed across the deployments, listed as deployment[@endpoint],
+    # each of them with its own token budget.
+    chat_deployment_specs = [spec.strip() for spec in os.getenv('AZURE_AI_CHAT_DEPLOYMENTS', '').split(',')
+                             if spec.strip()] or [os.environ["AZURE_AI_CHAT_DEPLOYMENT_NAME"]]
+    chat_deployment_names = [spec.partition('@')[0] for spec in chat_deployment_specs]
+    chat_endpoints = []
+    chat_deployments = []
+    for spec, name in zip(chat_deployment_specs, chat_deployment_names):
+        deployment_endpoint = spec.partition('@')[2] or inference_endpoint
+        label = name if chat_deployment_names.count(name) == 1 else f"{name}@{urlparse(deployment_endpoint).netloc}"
+        chat_budget = TokenBudget(
+            'chat' if len(chat_deployment_specs) == 1 else f'chat {label}',
+            tokens_per_minute=int(os.getenv('AZURE_AI_CHAT_TOKENS_PER_MINUTE', '0')),
+            requests_per_minute=int(os.getenv('AZURE_AI_CHAT_REQUESTS_PER_MINUTE', '0')),
+            max_wait=budget_max_wait,
+            default_completion_tokens=chat_completion_tokens,
+        )
+        chat_client = ChatCompletionsClient(
+            endpoint=deployment_endpoint,
+            per_retry_policies=[TokenBudgetPolicy(chat_budget)],
+            transport=http_pool.transport,
+            # The throttled requests are sent to the other deployments instead of being retried.
+            **(dict(retry_status=0) if len(chat_deployment_specs) > 1 else {}),
+            **inference_credentials,
+        )
+        chat_endpoints.append(deployment_endpoint)
+        chat_deployments.append(ChatDeployment(name, chat_client, chat_budget, label=label))
+    chat_router = DeploymentRouter(
+        chat_deployments,
+        max_attempts=int(os.getenv('CHAT_ROUTER_MAX_ATTEMPTS', '0')) or None,
+        default_completion_tokens=chat_completion_tokens,
+    )
+    # The history is summarized by the first deployment.
+    chat = chat_deployments[0].client
     embed =  EmbeddingsClient(
         endpoint=inference_endpoint,
-        credential=azure_credential,
-        credential_scopes=["https://ai.azure.com/.default"],
+        per_retry_policies=[TokenBudgetPolicy(embed_budget)],
+        transport=http_pool.transport,
+        **inference_credentials,
     )
+    search_credential = token_credential
+    if search_key := os.getenv('AZURE_AI_SEARCH_KEY'):
+        search_credential = AzureKeyCredential(search_key)
 
     endpoint = os.environ.get('AZURE_AI_SEARCH_ENDPOINT')
     search_index_manager = None
@@ -80,14 +161,107 @@ async def lifespan(app: fastapi.FastAPI):
     if os.getenv('AZURE_AI_EMBED_DIMENSIONS'):
         embed_dimensions = int(os.getenv('AZURE_AI_EMBED_DIMENSIONS'))
         
-    if endpoint and os.getenv('AZURE_AI_SEARCH_INDEX_NAME') and os.getenv('AZURE_AI_EMBED_DEPLOYMENT_NAME'):
+    search_backend = os.getenv('SEARCH_BACKEND', 'azure').lower()
+    if search_backend not in ('azure', 'local'):
+        raise ValueError(f"Unknown SEARCH_BACKEND {search_backend}, it must be either azure or local.")
+
+    embedding_cache = None
+    embedding_cache_size = int(os.getenv('EMBEDDING_CACHE_SIZE', '1024'))
+    if embedding_cache_size > 0:
+        embedding_cache = EmbeddingCache(
+            max_size=embedding_cache_size,
+            ttl=float(os.getenv('EMBEDDING_CACHE_TTL', '3600')),
+            disk_path=os.getenv('EMBEDDING_CACHE_FILE') or None,
+        )
+
+    # Coalesce the concurrent query embeddings into batched requests.
+    search_embeddings_client = embed
+    embedding_batcher = None
+    embedding_batch_window_ms = float(os.getenv('EMBEDDING_BATCH_WINDOW_MS', '0'))
+    if embedding_batch_window_ms > 0:
+        embedding_batcher = EmbeddingBatcher(
+            embed,
+            max_wait=embedding_batch_window_ms / 1000,
+            max_batch_size=int(os.getenv('EMBEDDING_BATCH_MAX_SIZE', '16')),
+        )
+        search_embeddings_client = embedding_batcher
+
+    # Hedge the slow query embeddings and searches, and stop calling the failing services.
+    rag_timeout = float(os.getenv('RAG_TIMEOUT', '10'))
+    rag_callers = {}
+    for dependency in ('embeddings', 'search'):
+        rag_callers[dependency] = ResilientCaller(
+            CircuitBreaker(
+                dependency,
+                failure_threshold=int(os.getenv('RAG_BREAKER_FAILURES', '5')),
+                reset_timeout=float(os.getenv('RAG_BREAKER_RESET_TIMEOUT', '30')),
+            ),
+            hedge_percentile=float(os.getenv('RAG_HEDGE_PERCENTILE', '95')),
+            min_hedge_delay=float(os.getenv('RAG_HEDGE_MIN_DELAY_MS', '50')) / 1000,
+            max_hedge_delay=float(os.getenv('RAG_HEDGE_MAX_DELAY_MS', '2000')) / 1000,
+            hedge_ratio=float(os.getenv('RAG_HEDGE_RATIO', '0.1')),
+            timeout=rag_timeout if rag_timeout > 0 else None,
+            excluded=(TokenBudgetExceeded,),
+        )
+
+    retrieval_min_score = os.getenv('RETRIEVAL_MIN_SCORE')
+    retrieval_policy = RetrievalPolicy(
+        top_k=int(os.getenv('RETRIEVAL_TOP_K', '5')),
+        min_score=float(retrieval_min_score) if retrieval_min_score else None,
+        score_gap=float(os.getenv('RETRIEVAL_SCORE_GAP', '0')),
+        mmr_lambda=float(os.getenv('RETRIEVAL_MMR_LAMBDA', '1')),
+    )
+
+    embeddings_path = os.getenv('SEARCH_EMBEDDINGS_FILE') or get_default_embeddings_file()
+    keyword_index = None
+    if os.getenv('KEYWORD_SEARCH', '').lower() == 'true':
+        logger.info(f"Building the keyword index of {embeddings_path}.")
+        keyword_index = KeywordIndex.from_file(embeddings_path)
+    keyword_fast_path_words = int(os.getenv('KEYWORD_FAST_PATH_MIN_WORDS', '2'))
+
+    if search_backend == 'local' and os.getenv('AZURE_AI_EMBED_DEPLOYMENT_NAME'):
+        logger.info(f"Loading the local search index from {embeddings_path}.")
+        local_index = LocalSearchIndex.from_file(
+            embeddings_path,
+            quantization=os.getenv('LOCAL_SEARCH_QUANTIZATION') or None,
+            subvectors=int(os.getenv('LOCAL_SEARCH_PQ_SUBVECTORS', '0')) or None,
+            rescore_factor=int(os.getenv('LOCAL_SEARCH_RESCORE_FACTOR', '10')),
+        )
+        logger.info(f"The local search index of {len(local_index)} chunks scans {local_index.nbytes} bytes.")
         search_index_manager = SearchIndexManager(
             endpoint = endpoint,
-            credential = azure_credential,
+            credential = search_credential,
             index_name = os.getenv('AZURE_AI_SEARCH_INDEX_NAME'),
             dimensions = embed_dimensions,
             model = os.getenv('AZURE_AI_EMBED_DEPLOYMENT_NAME'),
-            embeddings_client=embed
+            embeddings_client=search_embeddings_client,
+            local_index=local_index,
+            embedding_cache=embedding_cache,
+            retrieval_policy=retrieval_policy,
+            keyword_index=keyword_index,
+            keyword_fast_path_words=keyword_fast_path_words,
+            transport=http_pool.transport,
+            embeddings_caller=rag_callers['embeddings'],
+            search_caller=rag_callers['search'],
+        )
+    elif endpoint and os.getenv('AZURE_AI_SEARCH_INDEX_NAME') and os.getenv('AZURE_AI_EMBED_DEPLOYMENT_NAME'):
+        # The keyword matches are scored by their cosine similarity with the embeddings of the file.
+        chunk_vectors = LocalSearchIndex.from_file(embeddings_path) if keyword_index is not None else None
+        search_index_manager = SearchIndexManager(
+            endpoint = endpoint,
+            credential = search_credential,
+            index_name = os.getenv('AZURE_AI_SEARCH_INDEX_NAME'),
+            dimensions = embed_dimensions,
+            model = os.getenv('AZURE_AI_EMBED_DEPLOYMENT_NAME'),
+            embeddings_client=search_embeddings_client,
+            embedding_cache=embedding_cache,
+            retrieval_policy=retrieval_policy,
+            keyword_index=keyword_index,
+            keyword_fast_path_words=keyword_fast_path_words,
+            transport=http_pool.transport,
+            embeddings_caller=rag_callers['embeddings'],
+            search_caller=rag_callers['search'],
+            chunk_vectors=chunk_vectors,
         )
         # Create index and upload the documents only if index does not exist.
         logger.info(f"Creating index {os.getenv('AZURE_AI_SEARCH_INDEX_NAME')}.")
@@ -96,15 +270,116 @@ async def lifespan(app: fastapi.FastAPI):
     else:
         logger.info("The RAG search will not be used.")
 
+    # Open the connections to the services before the worker takes the traffic.
+    http_pool_warm_connections = int(os.getenv('HTTP_POOL_WARM_CONNECTIONS', '2'))
+    if http_pool_warm_connections > 0:
+        warm_urls = list(dict.fromkeys([inference_endpoint, *chat_endpoints]))
+        if search_index_manager is not None and search_backend == 'azure':
+            warm_urls.append(endpoint)
+        opened = await http_pool.warm_up(warm_urls, connections=http_pool_warm_connections)
+        logger.info("Opened %d connections to %s.", opened, warm_urls)
+
+    warmup_file = os.getenv('EMBEDDING_CACHE_WARMUP_FILE')
+    if search_index_manager is not None and warmup_file:
+        try:
+            warmed = await search_index_manager.warm_up_embedding_cache(read_questions(warmup_file))
+            logger.info("Added %d questions from %s to the embedding cache.", warmed, warmup_file)
+        except Exception as e:
+            logger.error("Failed to warm up the embedding cache, error: %s", str(e))
+
+    stream_replay_store = None
+    stream_replay_ttl = float(os.getenv('CHAT_STREAM_REPLAY_TTL', '0'))
+    if stream_replay_ttl > 0:
+        stream_replay_store = StreamReplayStore(
+            ttl=stream_replay_ttl,
+            max_streams=int(os.getenv('CHAT_STREAM_REPLAY_MAX_STREAMS', '1000')),
+            disk_path=os.getenv('CHAT_STREAM_REPLAY_FILE') or None,
+        )
+
+    # Skip the retrieval for the turns, which do not need it.
+    retrieval_gate = None
+    retrieval_gate_mode = os.getenv('RETRIEVAL_GATE', 'rules').lower()
+    if search_index_manager is not None and retrieval_gate_mode != 'off':
+        classifier = None
+        if retrieval_gate_mode == 'classifier':
+            examples_file = os.getenv('RETRIEVAL_GATE_EXAMPLES_FILE') or os.path.join(
+                os.path.dirname(__file__), 'data', 'retrieval_gate_examples.csv')
+            logger.info(f"Training the retrieval gate classifier on {examples_file}.")
+            classifier = GateClassifier.from_file(examples_file)
+        elif retrieval_gate_mode != 'rules':
+            raise ValueError(f"Unknown RETRIEVAL_GATE {retrieval_gate_mode}, expected rules, classifier or off.")
+        retrieval_gate = RetrievalGate(
+            classifier=classifier,
+            min_confidence=float(os.getenv('RETRIEVAL_GATE_MIN_CONFIDENCE', '0.8')),
+        )
+
+    prompt_builder = PromptBuilder(
+        max_context_tokens=int(os.getenv('CHAT_CONTEXT_MAX_TOKENS', '2000')),
+        duplicate_threshold=float(os.getenv('CHAT_CONTEXT_DUPLICATE_THRESHOLD', '0.8')),
+    )
+
+    session_store = None
+    chat_session_ttl = float(os.getenv('CHAT_SESSION_TTL', '3600'))
+    if chat_session_ttl > 0:
+        session_store = SessionStore(
+            ttl=chat_session_ttl,
+            max_sessions=int(os.getenv('CHAT_SESSION_MAX_SESSIONS', '10000')),
+            max_messages=int(os.getenv('CHAT_SESSION_MAX_MESSAGES', '200')),
+            disk_path=os.getenv('CHAT_SESSION_FILE') or None,
+        )
+
+    context_window = None
+    chat_prompt_max_tokens = int(os.getenv('CHAT_PROMPT_MAX_TOKENS', '8000'))
+    if chat_prompt_max_tokens > 0:
+        summarize = os.getenv('CHAT_HISTORY_SUMMARY', '').lower() == 'true'
+        context_window = ContextWindow(
+            max_tokens=chat_prompt_max_tokens,
+            chat_client=chat if summarize else None,
+            model=chat_deployments[0].name,
+            summary_max_tokens=int(os.getenv('CHAT_HISTORY_SUMMARY_MAX_TOKENS', '256')),
+        )
+
+    admission_controller = None
+    admission_max_concurrency = int(os.getenv('ADMISSION_MAX_CONCURRENCY', '0'))
+    if admission_max_concurrency > 0:
+        admission_controller = AdmissionController(
+            max_concurrency=admission_max_concurrency,
+            max_per_client=int(os.getenv('ADMISSION_MAX_PER_CLIENT', '4')),
+            max_queue=int(os.getenv('ADMISSION_MAX_QUEUE', '64')),
+            queue_timeout=float(os.getenv('ADMISSION_QUEUE_TIMEOUT', '10')),
+            trusted_proxies=int(os.getenv('ADMISSION_TRUSTED_PROXIES', '1')),
+        )
+
     app.state.chat = chat
+    app.state.chat_router = chat_router
     app.state.search_index_manager = search_index_manager
-    app.state.chat_model = os.environ["AZURE_AI_CHAT_DEPLOYMENT_NAME"]
+    app.state.retrieval_gate = retrieval_gate
+    app.state.prompt_builder = prompt_builder
+    app.state.context_window = context_window
+    app.state.session_store = session_store
+    app.state.admission_controller = admission_controller
+    app.state.stream_replay_store = stream_replay_store
+    app.state.embedding_batcher = embedding_batcher
+    app.state.chat_model = chat_deployments[0].name
     yield
 
+    # The recording streams use the chat deployments, so they are stopped first.
+    if stream_replay_store is not None:
+        await stream_replay_store.close()
     await project.close()
-    await chat.close()
+    await chat_router.close()
+    logger.info("Chat deployment statistics: %s", chat_router.stats())
     if search_index_manager is not None:
         await search_index_manager.close()
+    if embedding_batcher is not None:
+        await embedding_batcher.close()
+        logger.info("Embedding batching statistics: %s", embedding_batcher.stats())
+    if retrieval_gate is not None:
+        logger.info("Retrieval gate statistics: %s", retrieval_gate.stats())
+    if session_store is not None:
+        await session_store.close()
+    await http_pool.close()
+    await token_credential.close()
 
 
 def create_app():
@@ -0,0 +1,220 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+# See LICENSE file in the project root for full license information.
+"""
+Prometheus metrics of the chat application.
+
+When the PROMETHEUS_MULTIPROC_DIR environment variable is set before this module is imported,
+which gunicorn.conf.py does, each worker writes its metrics to the files in that directory
+and the /metrics endpoint of any worker returns the values aggregated over all workers.
+"""
+import os
+from collections.abc import AsyncIterator
+from typing import TypeVar
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+
+T = TypeVar('T')
+
+# The phases of the chat request.
+QUERY_EMBEDDING = 'query_embedding'
+KEYWORD_SEARCH = 'keyword_search'
+VECTOR_SEARCH = 'vector_search'
+PROMPT_ASSEMBLY = 'prompt_assembly'
+TIME_TO_FIRST_TOKEN = 'time_to_first_token'
+GENERATION = 'generation'
+TOTAL = 'total'
+
+LATENCY_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1., 2.5, 5., 10., 20., 30., 60., 120.)
+TOKENS_PER_SECOND_BUCKETS = (1., 5., 10., 20., 30., 40., 50., 75., 100., 150., 200., 300., 500.)
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128)
+CHUNKS_BUCKETS = (0, 1, 2, 3, 4, 5, 7, 10, 15, 20, 50)
+SCORE_BUCKETS = (0., 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.75, 0.8, 0.85, 0.9, 0.95, 1.)
+
+PHASE_SECONDS = Histogram(
+    'chat_phase_seconds',
+    'The time spent in each phase of the chat request.',
+    ['phase'],
+    buckets=LATENCY_BUCKETS,
+)
+GENERATION_TOKENS_PER_SECOND = Histogram(
+    'chat_generation_tokens_per_second',
+    'The estimated number of generated tokens per second after the first token.',
+    buckets=TOKENS_PER_SECOND_BUCKETS,
+)
+GENERATED_TOKENS = Counter(
+    'chat_generated_tokens',
+    'The estimated number of generated tokens.',
+)
+STREAMS_IN_FLIGHT = Gauge(
+    'chat_streams_in_flight',
+    'The number of chat responses being streamed.',
+    multiprocess_mode='livesum',
+)
+ADMISSION_QUEUE_DEPTH = Gauge(
+    'chat_admission_queue_depth',
+    'The number of chat requests waiting for admission.',
+    multiprocess_mode='livesum',
+)
+ADMISSION_WAIT_SECONDS = Histogram(
+    'chat_admission_wait_seconds',
+    'The time the admitted chat requests have waited in the queue.',
+    buckets=LATENCY_BUCKETS,
+)
+ADMISSION_REJECTED = Counter(
+    'chat_admission_rejected',
+    'The number of chat requests rejected by the admission control by reason.',
+    ['reason'],
+)
+MODEL_BUDGET_WAIT_SECONDS = Histogram(
+    'model_budget_wait_seconds',
+    'The time the model requests have waited for the tokens per minute budget by client.',
+    ['client'],
+    buckets=LATENCY_BUCKETS,
+)
+MODEL_BUDGET_REJECTED = Counter(
+    'model_budget_rejected',
+    'The number of model requests rejected by the tokens per minute budget by client.',
+    ['client'],
+)
+CHAT_DEPLOYMENT_REQUESTS = Counter(
+    'chat_deployment_requests',
+    'The number of chat completion attempts by deployment and result: success, throttled, error or bad_request.',
+    ['deployment', 'result'],
+)
+CHAT_DEPLOYMENT_FAILOVERS = Counter(
+    'chat_deployment_failovers',
+    'The number of chat completions, moved to another deployment before the first token, by deployment.',
+    ['deployment'],
+)
+CHAT_DEPLOYMENT_TIME_TO_FIRST_TOKEN = Histogram(
+    'chat_deployment_time_to_first_token_seconds',
+    'The time to the first token of the chat completion by deployment.',
+    ['deployment'],
+    buckets=LATENCY_BUCKETS,
+)
+CHAT_DEPLOYMENT_REMAINING_TOKENS = Gauge(
+    'chat_deployment_remaining_tokens',
+    'The lowest remaining tokens per minute of the deployment, reported by the service to any worker.',
+    ['deployment'],
+    multiprocess_mode='livemin',
+)
+HTTP_POOL_CONNECTIONS = Gauge(
+    'http_pool_connections',
+    'The number of the connections of the shared HTTP pool by state: in_use or idle.',
+    ['state'],
+    multiprocess_mode='livesum',
+)
+HTTP_POOL_REQUESTS = Counter(
+    'http_pool_requests',
+    'The number of the requests of the Azure clients by connection: new or reused.',
+    ['connection'],
+)
+HTTP_POOL_CONNECT_SECONDS = Histogram(
+    'http_pool_connect_seconds',
+    'The time to open the connection, including the DNS lookup and the TLS handshake.',
+    buckets=LATENCY_BUCKETS,
+)
+HTTP_POOL_QUEUE_SECONDS = Histogram(
+    'http_pool_queue_seconds',
+    'The time the requests have waited for the free connection at the limits of the pool.',
+    buckets=LATENCY_BUCKETS,
+)
+TOKEN_ACQUISITION_SECONDS = Histogram(
+    'credential_token_acquisition_seconds',
+    'The time to acquire the access token by mode: in the background or while the request waits.',
+    ['mode'],
+    buckets=LATENCY_BUCKETS,
+)
+TOKEN_CACHE_REQUESTS = Counter(
+    'credential_token_cache_requests',
+    'The number of the access token requests of the clients by result: hit, miss or claims.',
+    ['result'],
+)
+HEDGED_REQUESTS = Counter(
+    'hedged_requests',
+    'The number of the hedged calls by dependency and result: won, if the hedge answered first, or lost.',
+    ['dependency', 'result'],
+)
+CIRCUIT_BREAKER_OPEN = Gauge(
+    'circuit_breaker_open',
+    'Whether the circuit breaker of the dependency is open in any worker.',
+    ['dependency'],
+    multiprocess_mode='livemax',
+)
+CIRCUIT_BREAKER_REJECTED = Counter(
+    'circuit_breaker_rejected',
+    'The number of the calls not made, because the circuit breaker of the dependency was open.',
+    ['dependency'],
+)
+RETRIEVED_CHUNKS = Histogram(
+    'retrieved_chunks',
+    'The number of chunks, selected by the retrieval policy for the context.',
+    buckets=CHUNKS_BUCKETS,
+)
+KEYWORD_FAST_PATH = Counter(
+    'retrieval_keyword_fast_path',
+    'The number of questions answered from the keyword index without the query embedding.',
+)
+RETRIEVAL_SCORE = Histogram(
+    'retrieval_score',
+    'The cosine similarity of the selected chunks to the question.',
+    buckets=SCORE_BUCKETS,
+)
+RETRIEVAL_GATE_DECISIONS = Counter(
+    'retrieval_gate_decisions',
+    'The number of the turns by the decision of the retrieval gate: retrieve, skip or reuse the previous context.',
+    ['decision'],
+)
+RETRIEVAL_GATE_SAVED_SECONDS = Counter(
+    'retrieval_gate_saved_seconds',
+    'The estimated retrieval time saved by the skipped and reused retrievals.',
+)
+EMBEDDING_CACHE_REQUESTS = Counter(
+    'embedding_cache_requests',
+    'The number of the query embedding cache lookups by result.',
+    ['result'],
+)
+EMBEDDING_BATCH_SIZE = Histogram(
+    'embedding_batch_size',
+    'The number of distinct inputs in the batched embedding requests.',
+    buckets=BATCH_SIZE_BUCKETS,
+)
+
+
+async def track_stream(stream: AsyncIterator[T]) -> AsyncIterator[T]:
+    """
+    Count the stream as in flight until it is exhausted or closed.
+
+    :param stream: The response stream.
+    :return: The stream with the same items.
+    """
+    STREAMS_IN_FLIGHT.inc()
+    try:
+        async for item in stream:
+            yield item
+    finally:
+        STREAMS_IN_FLIGHT.dec()
+
+
+def render_metrics() -> tuple[bytes, str]:
+    """
+    Render the metrics in the Prometheus text format.
+
+    :return: The tuple of the rendered metrics and their content type.
+    """
+    registry = REGISTRY
+    if os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    return generate_latest(registry), CONTENT_TYPE_LATEST
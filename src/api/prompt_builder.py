@@ -0,0 +1,105 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+# See LICENSE file in the project root for full license information.
+from collections.abc import Sequence
+
+from azure.ai.inference.prompts import PromptTemplate
+
+from .util import estimate_tokens
+
+SYSTEM_PROMPT = 'You are a helpful assistant'
+RAG_PROMPT = (
+    'You are a helpful assistant that answers some questions '
+    'with the help of some context data.\n\nHere is '
+    'the context data:\n\n{{context}}')
+CONTEXT_SEPARATOR = '\n------\n'
+
+# The placeholder, rendered into the template once, to split it around the context.
+_CONTEXT_PLACEHOLDER = '\x00context\x00'
+# The number of words in the shingles, compared to find the near duplicate chunks.
+_SHINGLE_WORDS = 3
+
+
+def _compile(template: str) -> list[tuple[str, str, list[str]]]:
+    """Render the template once and split its messages around the context placeholder."""
+    messages = PromptTemplate.from_string(template).create_messages(data=dict(context=_CONTEXT_PLACEHOLDER))
+    return [(message['role'], message['content'], message['content'].split(_CONTEXT_PLACEHOLDER))
+            for message in messages]
+
+
+def _shingles(text: str) -> frozenset[tuple[str, ...]]:
+    """Return the set of the word shingles of the text."""
+    words = text.casefold().split()
+    if len(words) <= _SHINGLE_WORDS:
+        return frozenset([tuple(words)])
+    return frozenset(tuple(words[i:i + _SHINGLE_WORDS]) for i in range(len(words) - _SHINGLE_WORDS + 1))
+
+
+class PromptBuilder:
+    """
+    The builder of the system prompt with the retrieved context.
+
+    The templates are rendered once, when the builder is created, and each prompt is made
+    by joining the rendered parts with the context. The retrieved chunks are added to the
+    context in the score order while they fit into max_context_tokens, and the chunks,
+    which repeat the chunks already added, are skipped. The chunks are near duplicates if
+    the Jaccard similarity of their three word shingles is at least duplicate_threshold.
+
+    :param max_context_tokens: The maximal number of tokens of the context, 0 if it is not limited.
+    :param duplicate_threshold: The similarity, at which the chunk is considered a duplicate.
+    """
+
+    def __init__(self, max_context_tokens: int = 2000, duplicate_threshold: float = 0.8) -> None:
+        """Constructor."""
+        if max_context_tokens < 0 or not 0 < duplicate_threshold <= 1:
+            raise ValueError("The max_context_tokens must not be negative and duplicate_threshold must be in (0, 1].")
+        self._max_context_tokens = max_context_tokens
+        self._duplicate_threshold = duplicate_threshold
+        self._system_messages = [{'role': role, 'content': content} for role, content, _ in _compile(SYSTEM_PROMPT)]
+        self._rag_messages = _compile(RAG_PROMPT)
+
+    def pack_context(self, chunks: Sequence[str]) -> list[str]:
+        """
+        Select the chunks for the context.
+
+        :param chunks: The retrieved chunks, the best match first.
+        :return: The chunks, which fit into the token budget, without duplicates.
+        """
+        selected = []
+        selected_shingles = []
+        tokens = 0
+        for chunk in chunks:
+            if not chunk.strip():
+                continue
+            chunk_tokens = estimate_tokens(chunk + CONTEXT_SEPARATOR)
+            if self._max_context_tokens and tokens + chunk_tokens > self._max_context_tokens:
+                # The smaller chunks with the lower scores may still fit.
+                continue
+            shingles = _shingles(chunk)
+            if any(self._similarity(shingles, other) >= self._duplicate_threshold for other in selected_shingles):
+                continue
+            selected.append(chunk)
+            selected_shingles.append(shingles)
+            tokens += chunk_tokens
+        return selected
+
+    def build(self, chunks: Sequence[str]) -> tuple[list[dict[str, str]], str]:
+        """
+        Make the system prompt with the context from the retrieved chunks.
+
+        :param chunks: The retrieved chunks, the best match first.
+        :return: The tuple of the prompt messages and the context, empty if no chunks were given.
+        """
+        context = CONTEXT_SEPARATOR.join(self.pack_context(chunks))
+        if not context:
+            return [dict(message) for message in self._system_messages], context
+        messages = [{'role': role, 'content': context.join(parts) if len(parts) > 1 else content}
+                    for role, content, parts in self._rag_messages]
+        return messages, context
+
+    @staticmethod
+    def _similarity(first: frozenset, second: frozenset) -> float:
+        """Return the Jaccard similarity of the shingle sets."""
+        if not first or not second:
+            return 0.
+        return len(first & second) / len(first | second)
@@ -0,0 +1,371 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+# See LICENSE file in the project root for full license information.
+"""
+Compressed codes of the embeddings for the local search of the large corpora.
+
+The unit length embeddings are encoded either by the int8 scalar quantization, one byte
+per dimension, or by the product quantization, one byte per group of dimensions. The
+candidates are scored on the codes, and LocalSearchIndex rescores the best of them with
+the float32 embeddings, which stay memory mapped and are read only for these rows.
+
+The codes can be written next to the binary embeddings file, so that the gunicorn
+workers memory map one copy of them instead of encoding the embeddings at startup:
+
+- ``<prefix>.<method>.npy``: the codes, one row per token.
+- ``<prefix>.<method>.params.npy``: the parameters of the quantizer.
+
+Run this module to write the codes and to compare the memory and recall of the methods.
+"""
+import argparse
+import os
+import time
+from typing import Optional
+
+import numpy as np
+
+from .embeddings_file import BINARY_SUFFIX, is_binary, load_embeddings
+
+INT8 = 'int8'
+PQ = 'pq'
+METHODS = (INT8, PQ)
+
+# The number of rows, encoded or scored at once, to bound the temporary memory.
+BLOCK_SIZE = 8192
+# The number of centroids of each group of dimensions, so that the code fits one byte.
+PQ_CENTROIDS = 256
+
+
+def _normalized(vectors: np.ndarray) -> np.ndarray:
+    """Return the float32 copy of the vectors, scaled to the unit length."""
+    matrix = np.array(vectors, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.
+    return matrix / norms
+
+
+def default_subvectors(dimensions: int) -> int:
+    """
+    Return the number of the groups of dimensions for the product quantization.
+
+    :param dimensions: The number of dimensions of the embeddings.
+    :return: The largest divisor of dimensions, which leaves at least 16 dimensions per group.
+    """
+    return max(m for m in range(1, max(1, dimensions // 16) + 1) if dimensions % m == 0)
+
+
+class ScalarQuantizer:
+    """
+    The int8 quantization of each dimension between its minimum and maximum.
+
+    :param center: The middle of the range of each dimension.
+    :param scale: The step of the code of each dimension.
+    """
+
+    def __init__(self, center: np.ndarray, scale: np.ndarray) -> None:
+        """Constructor."""
+        self.center = np.asarray(center, dtype=np.float32)
+        self.scale = np.asarray(scale, dtype=np.float32)
+
+    @staticmethod
+    def train(vectors: np.ndarray) -> 'ScalarQuantizer':
+        """
+        Fit the ranges of the dimensions of the unit length vectors.
+
+        :param vectors: The vectors.
+        :return: The quantizer.
+        """
+        low = np.full(vectors.shape[1], np.inf, dtype=np.float32)
+        high = np.full(vectors.shape[1], -np.inf, dtype=np.float32)
+        for start in range(0, len(vectors), BLOCK_SIZE):
+            block = _normalized(vectors[start:start + BLOCK_SIZE])
+            low = np.minimum(low, block.min(axis=0))
+            high = np.maximum(high, block.max(axis=0))
+        scale = (high - low) / 255
+        scale[scale == 0] = 1.
+        return ScalarQuantizer((high + low) / 2, scale)
+
+    def encode(self, vectors: np.ndarray) -> np.ndarray:
+        """Return the int8 codes of the unit length vectors."""
+        return np.clip(np.rint((vectors - self.center) / self.scale), -128, 127).astype(np.int8)
+
+    def score(self, codes: np.ndarray, queries: np.ndarray) -> np.ndarray:
+        """Return the approximate inner products of the unit length queries and the encoded vectors."""
+        return (queries * self.scale) @ codes.astype(np.float32).T + (queries @ self.center)[:, None]
+
+    @property
+    def params(self) -> np.ndarray:
+        return np.stack([self.center, self.scale])
+
+    @staticmethod
+    def from_params(params: np.ndarray) -> 'ScalarQuantizer':
+        return ScalarQuantizer(params[0], params[1])
+
+
+class ProductQuantizer:
+    """
+    The product quantization: each group of dimensions is replaced by the nearest of its centroids.
+
+    :param centroids: The array of the centroids, shaped (groups, centroids, dimensions per group).
+    """
+
+    def __init__(self, centroids: np.ndarray) -> None:
+        """Constructor."""
+        self.centroids = np.asarray(centroids, dtype=np.float32)
+
+    @staticmethod
+    def train(
+            vectors: np.ndarray,
+            subvectors: int,
+            iterations: int = 10,
+            sample_size: int = 16384,
+            seed: int = 0,
+        ) -> 'ProductQuantizer':
+        """
+        Find the centroids of each group of dimensions by the k-means on the sample of the vectors.
+
+        :param vectors: The vectors.
+        :param subvectors: The number of the groups of dimensions.
+        :param iterations: The number of the k-means iterations.
+        :param sample_size: The maximal number of the vectors to train on.
+        :param seed: The seed of the random sample and the initial centroids.
+        :return: The quantizer.
+        """
+        dimensions = vectors.shape[1]
+        if subvectors <= 0 or dimensions % subvectors:
+            raise ValueError(f"The number of subvectors must divide the {dimensions} dimensions.")
+        rng = np.random.default_rng(seed)
+        sample = np.sort(rng.choice(len(vectors), min(sample_size, len(vectors)), replace=False))
+        groups = _normalized(vectors[sample]).reshape(len(sample), subvectors, -1)
+        count = min(PQ_CENTROIDS, len(sample))
+        centroids = np.empty((subvectors, count, groups.shape[2]), dtype=np.float32)
+        for group in range(subvectors):
+            points = groups[:, group]
+            centers = points[rng.choice(len(points), count, replace=False)]
+            for _ in range(iterations):
+                assignment = ProductQuantizer._nearest(points, centers)
+                order = np.argsort(assignment, kind='stable')
+                sizes = np.bincount(assignment, minlength=count)
+                # The empty clusters keep their centroids.
+                filled = sizes > 0
+                starts = np.concatenate([[0], np.cumsum(sizes)[:-1]])[filled]
+                centers[filled] = np.add.reduceat(points[order], starts, axis=0) / sizes[filled, None]
+            centroids[group] = centers
+        return ProductQuantizer(centroids)
+
+    @staticmethod
+    def _nearest(points: np.ndarray, centers: np.ndarray) -> np.ndarray:
+        """Return the index of the nearest center of each point."""
+        distances = (centers * centers).sum(axis=1) - 2 * points @ centers.T
+        return np.argmin(distances, axis=1)
+
+    def encode(self, vectors: np.ndarray) -> np.ndarray:
+        """Return the uint8 codes of the unit length vectors, one per group of dimensions."""
+        groups = vectors.reshape(len(vectors), len(self.centroids), -1)
+        codes = np.empty((len(vectors), len(self.centroids)), dtype=np.uint8)
+        for group, centers in enumerate(self.centroids):
+            codes[:, group] = self._nearest(groups[:, group], centers)
+        return codes
+
+    def score(self, codes: np.ndarray, queries: np.ndarray) -> np.ndarray:
+        """Return the approximate inner products of the unit length queries and the encoded vectors."""
+        # The inner products of each query with all centroids of each group.
+        tables = np.einsum('gkd,qgd->qgk', self.centroids, queries.reshape(len(queries), len(self.centroids), -1))
+        scores = np.zeros((len(queries), len(codes)), dtype=np.float32)
+        for group in range(len(self.centroids)):
+            scores += tables[:, group, codes[:, group]]
+        return scores
+
+    @property
+    def params(self) -> np.ndarray:
+        return self.centroids
+
+    @staticmethod
+    def from_params(params: np.ndarray) -> 'ProductQuantizer':
+        return ProductQuantizer(params)
+
+
+class QuantizedVectors:
+    """
+    The codes of the embeddings with their quantizer.
+
+    :param method: The quantization method, int8 or pq.
+    :param quantizer: The quantizer.
+    :param codes: The codes, one row per embedding.
+    """
+
+    def __init__(self, method: str, quantizer, codes: np.ndarray) -> None:
+        """Constructor."""
+        self.method = method
+        self.quantizer = quantizer
+        self.codes = codes
+
+    def __len__(self) -> int:
+        return len(self.codes)
+
+    @property
+    def nbytes(self) -> int:
+        """The size of the codes and the parameters in bytes."""
+        return self.codes.nbytes + self.quantizer.params.nbytes
+
+    def scores(self, queries: np.ndarray) -> np.ndarray:
+        """
+        Return the approximate cosine similarity of the queries to all embeddings.
+
+        :param queries: The two dimensional array of the queries.
+        :return: The matrix of the scores, one row per query.
+        """
+        queries = _normalized(queries)
+        scores = np.empty((len(queries), len(self.codes)), dtype=np.float32)
+        for start in range(0, len(self.codes), BLOCK_SIZE):
+            block = np.asarray(self.codes[start:start + BLOCK_SIZE])
+            scores[:, start:start + len(block)] = self.quantizer.score(block, queries)
+        return scores
+
+    @staticmethod
+    def build(vectors: np.ndarray, method: str, subvectors: Optional[int] = None) -> 'QuantizedVectors':
+        """
+        Train the quantizer and encode the embeddings.
+
+        :param vectors: The embeddings.
+        :param method: The quantization method, int8 or pq.
+        :param subvectors: The number of the groups of dimensions of pq, by default default_subvectors.
+        :return: The codes.
+        """
+        if method == INT8:
+            quantizer = ScalarQuantizer.train(vectors)
+            codes = np.empty(vectors.shape, dtype=np.int8)
+        elif method == PQ:
+            quantizer = ProductQuantizer.train(vectors, subvectors or default_subvectors(vectors.shape[1]))
+            codes = np.empty((len(vectors), len(quantizer.centroids)), dtype=np.uint8)
+        else:
+            raise ValueError(f"Unknown quantization method {method}, expected one of {METHODS}.")
+        for start in range(0, len(vectors), BLOCK_SIZE):
+            codes[start:start + BLOCK_SIZE] = quantizer.encode(_normalized(vectors[start:start + BLOCK_SIZE]))
+        return QuantizedVectors(method, quantizer, codes)
+
+    @staticmethod
+    def _paths(embeddings_file: str, method: str) -> tuple[str, str]:
+        prefix = embeddings_file[:-len(BINARY_SUFFIX)] if is_binary(embeddings_file) else embeddings_file
+        return f"{prefix}.{method}{BINARY_SUFFIX}", f"{prefix}.{method}.params{BINARY_SUFFIX}"
+
+    def save(self, embeddings_file: str) -> None:
+        """
+        Write the codes next to the embeddings file.
+
+        :param embeddings_file: The embeddings file, the codes were built from.
+        """
+        codes_path, params_path = self._paths(embeddings_file, self.method)
+        with open(params_path + '.tmp', 'wb') as fp:
+            np.save(fp, self.quantizer.params)
+        with open(codes_path + '.tmp', 'wb') as fp:
+            np.save(fp, self.codes)
+        os.replace(params_path + '.tmp', params_path)
+        os.replace(codes_path + '.tmp', codes_path)
+
+    @staticmethod
+    def load(embeddings_file: str, method: str, mmap: bool = True) -> Optional['QuantizedVectors']:
+        """
+        Load the codes, written next to the embeddings file.
+
+        :param embeddings_file: The embeddings file.
+        :param method: The quantization method, int8 or pq.
+        :param mmap: If True, the codes are memory mapped and shared between the processes.
+        :return: The codes or None if they were not written or are older than the embeddings.
+        """
+        codes_path, params_path = QuantizedVectors._paths(embeddings_file, method)
+        if not os.path.isfile(codes_path) or os.path.getmtime(codes_path) < os.path.getmtime(embeddings_file):
+            return None
+        params = np.load(params_path)
+        quantizer = ScalarQuantizer.from_params(params) if method == INT8 else ProductQuantizer.from_params(params)
+        return QuantizedVectors(method, quantizer, np.load(codes_path, mmap_mode='r' if mmap else None))
+
+
+def evaluate(
+        vectors: np.ndarray,
+        quantized: QuantizedVectors,
+        queries: np.ndarray,
+        top_k: int = 5,
+        rescore_factor: int = 10,
+    ) -> dict[str, float]:
+    """
+    Measure the recall of the search on the codes against the exact search.
+
+    :param vectors: The embeddings.
+    :param quantized: Their codes.
+    :param queries: The query vectors.
+    :param top_k: The number of the results.
+    :param rescore_factor: The number of the candidates, rescored exactly, per result.
+    :return: The recall without and with the rescoring and the milliseconds per query.
+    """
+    from .local_search_index import LocalSearchIndex
+    tokens = [str(i) for i in range(len(vectors))]
+    exact = LocalSearchIndex(tokens, vectors).search_batch(queries, top_k=top_k)
+    approximate = quantized.scores(queries)
+    index = LocalSearchIndex(tokens, vectors, quantized=quantized, rescore_factor=rescore_factor)
+    start = time.perf_counter()
+    # The chat searches one question at a time.
+    rescored = [index.search(query, top_k=top_k) for query in queries]
+    elapsed = time.perf_counter() - start
+    recall = rescored_recall = 0.
+    for results, row, rescored_results in zip(exact, approximate, rescored):
+        expected = {int(token) for token, _ in results}
+        recall += len(expected & set(np.argsort(-row)[:top_k].tolist())) / len(expected)
+        rescored_recall += len(expected & {int(token) for token, _ in rescored_results}) / len(expected)
+    return {
+        'recall': recall / len(queries),
+        'rescored_recall': rescored_recall / len(queries),
+        'ms_per_query': 1000 * elapsed / len(queries),
+    }
+
+
+def _sample_queries(vectors: np.ndarray, count: int, seed: int = 0) -> np.ndarray:
+    """Return the synthetic queries, the sums of two random embeddings, which match neither of them exactly."""
+    rng = np.random.default_rng(seed)
+    first, second = rng.integers(0, len(vectors), (2, count))
+    return _normalized(vectors[first]) + _normalized(vectors[second])
+
+
+def main(args: Optional[list[str]] = None) -> None:
+    parser = argparse.ArgumentParser(
+        description="Write the quantized codes of the embeddings and report their memory and recall.")
+    parser.add_argument('embeddings_file', help="The csv file or the .npy file in the binary format.")
+    parser.add_argument('--method', choices=METHODS, action='append',
+                        help="The quantization method; may be repeated, all methods by default.")
+    parser.add_argument('--subvectors', type=int, help="The number of the groups of dimensions of pq.")
+    parser.add_argument('--queries', type=int, default=200, help="The number of the queries to measure recall.")
+    parser.add_argument('--top-k', type=int, default=5, help="The number of the results to measure recall.")
+    parser.add_argument('--rescore-factor', type=int, default=10,
+                        help="The number of the candidates, rescored exactly, per result.")
+    parser.add_argument('--write', action='store_true',
+                        help="Write the codes next to the binary embeddings file.")
+    parser.add_argument('--workers', type=int, default=(os.cpu_count() or 1) * 2 + 1,
+                        help="The number of the gunicorn workers to estimate the memory.")
+    options = parser.parse_args(args)
+    _, vectors = load_embeddings(options.embeddings_file)
+    queries = _sample_queries(vectors, options.queries)
+    n, dimensions = vectors.shape
+    print(f"{n} embeddings of {dimensions} dimensions, float32: {4 * dimensions} B/vector, "
+          f"{vectors.nbytes / 2 ** 20:.1f} MiB.")
+    print(f"{'method':<12}{'B/vector':>10}{'MiB':>10}{'MiB x ' + str(options.workers):>14}{'recall':>10}"
+          f"{'rescored':>10}{'ms/query':>10}")
+    for method in options.method or METHODS:
+        start = time.perf_counter()
+        quantized = QuantizedVectors.build(vectors, method, options.subvectors)
+        built = time.perf_counter() - start
+        metrics = evaluate(vectors, quantized, queries, options.top_k, options.rescore_factor)
+        name = f"{method}/{quantized.codes.shape[1]}" if method == PQ else method
+        size = quantized.nbytes / 2 ** 20
+        row_bytes = quantized.codes.shape[1] * quantized.codes.itemsize
+        print(f"{name:<12}{row_bytes:>10}{size:>10.1f}{size * options.workers:>14.1f}{metrics['recall']:>10.3f}"
+              f"{metrics['rescored_recall']:>10.3f}{metrics['ms_per_query']:>10.2f}   built in {built:.1f} s")
+        if options.write:
+            if not is_binary(options.embeddings_file):
+                parser.error("The codes can be written only next to the binary embeddings file.")
+            quantized.save(options.embeddings_file)
+    print("The codes, written with --write, are memory mapped and shared by the workers, like the "
+          "embeddings file; the codes, built at startup, take the memory of each worker.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,269 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+# See LICENSE file in the project root for full license information.
+import asyncio
+import logging
+import math
+import time
+from collections import deque
+from collections.abc import Awaitable
+from typing import Callable, Optional, TypeVar
+
+from .metrics import CIRCUIT_BREAKER_OPEN, CIRCUIT_BREAKER_REJECTED, HEDGED_REQUESTS
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar('T')
+
+# The states of the circuit breaker.
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class CircuitOpenError(Exception):
+    """
+    The call was not made, because the circuit breaker of the dependency is open.
+
+    :param dependency: The name of the dependency.
+    :param retry_after: The number of seconds after which the dependency is tried again.
+    """
+
+    def __init__(self, dependency: str, retry_after: float) -> None:
+        super().__init__(f"The circuit breaker of {dependency} is open.")
+        self.dependency = dependency
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """
+    The circuit breaker, which stops the calls of the failing dependency.
+
+    The breaker opens after failure_threshold consecutive failures, and the calls are not
+    made while it is open. After reset_timeout seconds, one call is let through to probe
+    the dependency; the breaker closes if it succeeds and opens again if it fails.
+
+    :param dependency: The name of the dependency, used in the metrics and the log.
+    :param failure_threshold: The number of consecutive failures, which open the breaker.
+    :param reset_timeout: The number of seconds the breaker stays open.
+    """
+
+    def __init__(self, dependency: str, failure_threshold: int = 5, reset_timeout: float = 30.) -> None:
+        """Constructor."""
+        if failure_threshold <= 0 or reset_timeout <= 0:
+            raise ValueError("The failure_threshold and reset_timeout must be positive.")
+        self._dependency = dependency
+        self._failure_threshold = failure_threshold
+        self._reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at = 0.
+        self._state = CLOSED
+        self._probing = False
+        CIRCUIT_BREAKER_OPEN.labels(dependency).set(0)
+
+    @property
+    def dependency(self) -> str:
+        """The name of the dependency."""
+        return self._dependency
+
+    @property
+    def state(self) -> str:
+        """The state of the breaker: closed, open or half_open."""
+        if self._state == OPEN and time.monotonic() - self._opened_at >= self._reset_timeout:
+            self._state = HALF_OPEN
+        return self._state
+
+    def retry_after(self) -> float:
+        """Return the number of seconds until the probe of the dependency."""
+        return max(0., self._opened_at + self._reset_timeout - time.monotonic())
+
+    def allow(self) -> bool:
+        """Return True if the call can be made; the probe call must be followed by record."""
+        state = self.state
+        if state == CLOSED:
+            return True
+        if state == HALF_OPEN and not self._probing:
+            self._probing = True
+            return True
+        return False
+
+    def record(self, success: Optional[bool]) -> None:
+        """
+        Record the outcome of the allowed call.
+
+        :param success: True or False, or None if the call neither succeeded nor failed,
+                        like the cancelled one.
+        """
+        probe, self._probing = self._probing, False
+        if success is None:
+            return
+        if success:
+            if self._state != CLOSED:
+                logger.info("The circuit breaker of %s is closed.", self._dependency)
+                CIRCUIT_BREAKER_OPEN.labels(self._dependency).set(0)
+            self._state = CLOSED
+            self._failures = 0
+            return
+        self._failures += 1
+        if probe or (self._state == CLOSED and self._failures >= self._failure_threshold):
+            logger.warning(
+                "The circuit breaker of %s is open for %s seconds after %d failures.",
+                self._dependency, self._reset_timeout, self._failures)
+            self._state = OPEN
+            self._opened_at = time.monotonic()
+            CIRCUIT_BREAKER_OPEN.labels(self._dependency).set(1)
+
+
+class ResilientCaller:
+    """
+    The caller of one dependency, which hedges the slow calls and stops calling it when it fails.
+
+    If the call has not completed within the hedge_percentile of the recent latencies,
+    clamped to [min_hedge_delay, max_hedge_delay], the same call is made again and the answer,
+    which arrives first, is returned, while the other call is cancelled. Until min_samples
+    latencies are recorded, the call is hedged after max_hedge_delay. The hedges are limited
+    by the budget, which grows by hedge_ratio with each call up to hedge_burst hedges, so at
+    most about hedge_ratio of the calls are made twice even if the dependency is slow for all
+    of them. The calls, which fail or take longer than timeout seconds, are counted by the
+    circuit breaker, and while it is open the calls raise CircuitOpenError immediately.
+
+    :param breaker: The circuit breaker of the dependency.
+    :param hedge_percentile: The percentile of the latencies, after which the call is hedged,
+                             0 disables the hedging.
+    :param min_hedge_delay: The minimal number of seconds before the hedge.
+    :param max_hedge_delay: The maximal number of seconds before the hedge.
+    :param hedge_ratio: The maximal ratio of the hedged calls.
+    :param hedge_burst: The maximal number of the hedges, which can be made in a row.
+    :param timeout: The number of seconds, after which the call fails, None for no limit.
+    :param window: The number of the recent latencies, from which the percentile is computed.
+    :param min_samples: The number of latencies, required to compute the percentile.
+    :param excluded: The exceptions, which are not the failures of the dependency,
+                     like the exhausted tokens per minute budget.
+    """
+
+    def __init__(
+            self,
+            breaker: CircuitBreaker,
+            hedge_percentile: float = 95.,
+            min_hedge_delay: float = 0.05,
+            max_hedge_delay: float = 2.,
+            hedge_ratio: float = 0.1,
+            hedge_burst: float = 10.,
+            timeout: Optional[float] = None,
+            window: int = 200,
+            min_samples: int = 20,
+            excluded: tuple[type[BaseException], ...] = (),
+        ) -> None:
+        """Constructor."""
+        if not 0 <= hedge_percentile < 100:
+            raise ValueError("The hedge_percentile must be in [0, 100).")
+        if not 0 < min_hedge_delay <= max_hedge_delay:
+            raise ValueError("The min_hedge_delay must be positive and not above max_hedge_delay.")
+        if hedge_ratio < 0 or hedge_burst < 1 or window <= 0 or min_samples <= 0:
+            raise ValueError("The hedge_ratio must not be negative, hedge_burst must be at least 1 "
+                             "and window and min_samples must be positive.")
+        if timeout is not None and timeout <= 0:
+            raise ValueError("The timeout must be positive.")
+        self._breaker = breaker
+        self._dependency = breaker.dependency
+        self._hedge_percentile = hedge_percentile
+        self._min_hedge_delay = min_hedge_delay
+        self._max_hedge_delay = max_hedge_delay
+        self._hedge_ratio = hedge_ratio
+        self._hedge_burst = hedge_burst
+        self._hedge_tokens = hedge_burst
+        self._timeout = timeout
+        self._latencies: deque[float] = deque(maxlen=window)
+        self._min_samples = min_samples
+        self._excluded = excluded
+        self._hedge_delay: Optional[float] = None
+
+    @property
+    def breaker(self) -> CircuitBreaker:
+        """The circuit breaker of the dependency."""
+        return self._breaker
+
+    def hedge_delay(self) -> Optional[float]:
+        """Return the number of seconds, after which the call is hedged, or None if it is not hedged."""
+        if not self._hedge_percentile:
+            return None
+        if self._hedge_delay is None:
+            if len(self._latencies) < self._min_samples:
+                return self._max_hedge_delay
+            latencies = sorted(self._latencies)
+            index = math.ceil(len(latencies) * self._hedge_percentile / 100) - 1
+            percentile = latencies[min(len(latencies) - 1, index)]
+            self._hedge_delay = min(self._max_hedge_delay, max(self._min_hedge_delay, percentile))
+        return self._hedge_delay
+
+    async def call(self, factory: Callable[[], Awaitable[T]]) -> T:
+        """
+        Make the call, hedging it if it is slow.
+
+        :param factory: The function, which returns the awaitable of a new call.
+        :return: The result of the first successful call.
+        :raises CircuitOpenError: If the circuit breaker is open.
+        """
+        if not self._breaker.allow():
+            CIRCUIT_BREAKER_REJECTED.labels(self._dependency).inc()
+            raise CircuitOpenError(self._dependency, self._breaker.retry_after())
+        success = None
+        try:
+            if self._timeout is not None:
+                result = await asyncio.wait_for(self._call_hedged(factory), self._timeout)
+            else:
+                result = await self._call_hedged(factory)
+            success = True
+            return result
+        except self._excluded:
+            raise
+        except Exception:
+            success = False
+            raise
+        finally:
+            self._breaker.record(success)
+
+    async def _call_hedged(self, factory: Callable[[], Awaitable[T]]) -> T:
+        self._hedge_tokens = min(self._hedge_burst, self._hedge_tokens + self._hedge_ratio)
+        delay = self.hedge_delay()
+        starts = {}
+        pending = set()
+
+        def start() -> asyncio.Future:
+            task = asyncio.ensure_future(factory())
+            starts[task] = time.monotonic()
+            pending.add(task)
+            return task
+
+        primary = start()
+        errors: list[BaseException] = []
+        try:
+            while pending:
+                hedging = delay is not None and len(starts) == 1
+                done, _ = await asyncio.wait(
+                    pending, timeout=delay if hedging else None, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    # The primary call is slow.
+                    if self._hedge_tokens >= 1:
+                        self._hedge_tokens -= 1
+                        start()
+                    else:
+                        delay = None
+                    continue
+                for task in done:
+                    pending.discard(task)
+                    if task.exception() is not None:
+                        errors.append(task.exception())
+                        continue
+                    self._latencies.append(time.monotonic() - starts[task])
+                    self._hedge_delay = None
+                    if len(starts) > 1:
+                        HEDGED_REQUESTS.labels(self._dependency, 'lost' if task is primary else 'won').inc()
+                    return task.result()
+                if len(starts) == 1:
+                    # The errors are retried by the client, not hedged.
+                    break
+            raise errors[0]
+        finally:
+            for task in pending:
+                task.cancel()
@@ -0,0 +1,306 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+# See LICENSE file in the project root for full license information.
+import csv
+import hashlib
+import re
+import time
+import zlib
+from collections import OrderedDict
+from collections.abc import Iterator, Mapping, Sequence
+from typing import Any, Optional
+
+import numpy as np
+
+from .metrics import RETRIEVAL_GATE_DECISIONS, RETRIEVAL_GATE_SAVED_SECONDS
+from .util import ChatRequest, Message
+
+# The decisions of the gate.
+RETRIEVE = 'retrieve'
+SKIP = 'skip'
+REUSE = 'reuse'
+DECISIONS = (RETRIEVE, SKIP, REUSE)
+
+_WORD_PATTERN = re.compile(r"[\w']+")
+# The greetings and acknowledgements, which do not ask anything.
+_SMALL_TALK_WORDS = frozenset(
+    "a alright awesome bye cheers day evening good goodbye got great have hello hey hi it later lot "
+    "morning much nice ok okay perfect see so thank thanks that's there thx ty very wonderful you".split())
+# The requests to change or explain the previous answer.
+_FOLLOW_UP_PATTERN = re.compile(
+    r"^(?:(?:please|can you|could you|now|ok|okay|and)\s+)*"
+    r"(?:make (?:it|that|this)|shorter|longer|explain (?:it|that|this)|more details?|"
+    r"(?:put|write) (?:it|that|this)|in (?:bullet points|a table|a list|one sentence)|what do you mean|"
+    r"are you sure|(?:yes|no|why)\W*$)\b")
+# The requests, which follow up the previous answer only if their object is absent, a pronoun
+# or mentioned in the earlier turns, since "summarize the return policy" asks about a new topic.
+# The object ends before the target, like "in one sentence" or "into French".
+_FOLLOW_UP_VERB_PATTERN = re.compile(
+    r"^(?:(?:please|can you|could you|now|ok|okay|and)\s+)*"
+    r"(?:tell me (?:more|again)|summari[sz]e|translate|format|expand|elaborate|repeat|"
+    r"shorten|rephrase|reword|rewrite|simplify)\b(?P<object>.*?)(?:\s+(?:in|into|to|as)\b.*)?$")
+# The words of the object, which do not name a topic.
+_OBJECT_FILLER_WORDS = frozenset(
+    "a about again all an and answer any bit briefly detail details for further how it its last little me more "
+    "of on please previous response so some that the them these this those up what with".split())
+
+
+def _words(text: str) -> list[str]:
+    return _WORD_PATTERN.findall(text.casefold())
+
+
+class GateClassifier:
+    """
+    The small classifier of the questions to the gate decisions.
+
+    The multinomial logistic regression over the hashed words, word pairs and the first
+    word of the question is trained on the labelled examples when it is created, which
+    takes a fraction of a second for the few hundred examples; the prediction takes
+    tens of microseconds.
+
+    :param texts: The example questions.
+    :param labels: The decisions for the examples, one of DECISIONS.
+    :param features: The number of the hashed features.
+    :param epochs: The number of the gradient descent steps.
+    :param learning_rate: The step of the gradient descent.
+    :param l2: The weight of the L2 regularization.
+    """
+
+    def __init__(
+            self,
+            texts: Sequence[str],
+            labels: Sequence[str],
+            features: int = 4096,
+            epochs: int = 300,
+            learning_rate: float = 2.,
+            l2: float = 1e-4,
+        ) -> None:
+        """Constructor."""
+        if not texts or len(texts) != len(labels):
+            raise ValueError("The classifier needs the same non zero number of texts and labels.")
+        unknown = set(labels) - set(DECISIONS)
+        if unknown:
+            raise ValueError(f"Unknown labels {sorted(unknown)}, expected {DECISIONS}.")
+        self._features = features
+        x = np.stack([self._vectorize(text) for text in texts])
+        y = np.zeros((len(labels), len(DECISIONS)), dtype=np.float32)
+        y[np.arange(len(labels)), [DECISIONS.index(label) for label in labels]] = 1.
+        self._weights = np.zeros((features, len(DECISIONS)), dtype=np.float32)
+        self._bias = np.zeros(len(DECISIONS), dtype=np.float32)
+        for _ in range(epochs):
+            gradient = (self._softmax(x @ self._weights + self._bias) - y) / len(labels)
+            self._weights -= learning_rate * (x.T @ gradient + l2 * self._weights)
+            self._bias -= learning_rate * gradient.sum(axis=0)
+
+    def predict(self, text: str) -> tuple[str, float]:
+        """
+        Return the most probable decision for the question.
+
+        :param text: The question.
+        :return: The decision and its probability.
+        """
+        probabilities = self._softmax(self._vectorize(text) @ self._weights + self._bias)
+        best = int(np.argmax(probabilities))
+        return DECISIONS[best], float(probabilities[best])
+
+    def _vectorize(self, text: str) -> np.ndarray:
+        """Return the L2 normalized counts of the hashed features of the text."""
+        words = _words(text)
+        features = words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+        if words:
+            features.append(f"^{words[0]}")
+        vector = np.zeros(self._features, dtype=np.float32)
+        for feature in features:
+            vector[zlib.crc32(feature.encode('utf-8')) % self._features] += 1.
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    @staticmethod
+    def _softmax(logits: np.ndarray) -> np.ndarray:
+        exp = np.exp(logits - logits.max(axis=-1, keepdims=True))
+        return exp / exp.sum(axis=-1, keepdims=True)
+
+    @staticmethod
+    def from_file(examples_file: str, **kwargs: Any) -> 'GateClassifier':
+        """
+        Train the classifier on the csv file with the label and text columns.
+
+        :param examples_file: The file with the labelled examples.
+        :return: The trained classifier.
+        """
+        with open(examples_file, newline='', encoding='utf-8') as fp:
+            rows = [row for row in csv.DictReader(fp) if row['text'].strip()]
+        return GateClassifier([row['text'] for row in rows], [row['label'].strip() for row in rows], **kwargs)
+
+
+class RetrievalGate:
+    """
+    The gate, which decides if the turn of the conversation needs the retrieval.
+
+    The greetings and acknowledgements, like "thanks!", are answered without the context.
+    The requests to change the previous answer, like "make it shorter", are answered with
+    the context of the newest earlier question, which is kept in the LRU cache by the hash
+    of the conversation; if it was not found, that question is searched again. The other
+    turns are searched as usual. The decisions are made by the rules or, if the classifier
+    is given, by the classifier, whose decisions below min_confidence are overridden by
+    the retrieval. The latency saved by each skipped retrieval is estimated by the
+    moving average of the retrieval time.
+
+    :param classifier: The classifier of the questions. If not set, the rules are used.
+    :param min_confidence: The minimal probability of the classifier to skip the retrieval.
+    :param max_follow_up_words: The maximal number of words of the follow-up request by the rules.
+    :param cache_size: The maximal number of the contexts kept.
+    """
+
+    # The weight of the latest retrieval time in the moving average.
+    LATENCY_SMOOTHING = 0.1
+
+    def __init__(
+            self,
+            classifier: Optional[GateClassifier] = None,
+            min_confidence: float = 0.8,
+            max_follow_up_words: int = 8,
+            cache_size: int = 1024,
+        ) -> None:
+        """Constructor."""
+        if not 0 <= min_confidence <= 1:
+            raise ValueError("The min_confidence must be in [0, 1].")
+        if max_follow_up_words <= 0 or cache_size <= 0:
+            raise ValueError("The max_follow_up_words and cache_size must be positive.")
+        self._classifier = classifier
+        self._min_confidence = min_confidence
+        self._max_follow_up_words = max_follow_up_words
+        self._cache_size = cache_size
+        self._contexts: OrderedDict[str, list[tuple[str, float]]] = OrderedDict()
+        self._retrieval_seconds: Optional[float] = None
+        self._decisions = dict.fromkeys(DECISIONS, 0)
+        self._saved_seconds = 0.
+
+    def decide(self, messages: Sequence[Mapping[str, Any]]) -> str:
+        """
+        Decide if the last message of the conversation needs the retrieval.
+
+        :param messages: The conversation, the last message is the user question.
+        :return: One of RETRIEVE, SKIP or REUSE.
+        """
+        question = messages[-1]['content'] or ''
+        if self._classifier is not None:
+            decision, probability = self._classifier.predict(question)
+            if probability < self._min_confidence:
+                decision = RETRIEVE
+        else:
+            decision = self._apply_rules(messages)
+        if decision == REUSE and next(self._previous_questions(messages), None) is None:
+            # There is no previous answer to follow up.
+            return RETRIEVE
+        return decision
+
+    def _apply_rules(self, messages: Sequence[Mapping[str, Any]]) -> str:
+        words = _words(messages[-1]['content'] or '')
+        if words and all(word in _SMALL_TALK_WORDS for word in words):
+            return SKIP
+        if len(words) > self._max_follow_up_words:
+            return RETRIEVE
+        text = ' '.join(words)
+        if _FOLLOW_UP_PATTERN.search(text):
+            return REUSE
+        match = _FOLLOW_UP_VERB_PATTERN.search(text)
+        if match is None:
+            return RETRIEVE
+        topic = [word for word in match.group('object').split() if word not in _OBJECT_FILLER_WORDS]
+        if topic:
+            earlier = {word for message in messages[:-1] for word in _words(message['content'] or '')}
+            if any(word not in earlier for word in topic):
+                return RETRIEVE
+        return REUSE
+
+    async def retrieve(
+            self,
+            search_index_manager: Any,
+            chat_request: ChatRequest,
+            messages: Sequence[Mapping[str, Any]],
+        ) -> list[tuple[str, float]]:
+        """
+        Return the chunks for the context of the last message, retrieving them only if needed.
+
+        :param search_index_manager: The search index manager.
+        :param chat_request: The request with the new messages and the retrieval options.
+        :param messages: The whole conversation, the last message is the user question.
+        :return: The chunks with their scores, empty if the retrieval was skipped.
+        """
+        decision = self.decide(messages)
+        results = None
+        if decision == SKIP:
+            results = []
+        elif decision == REUSE:
+            # The context of the newest earlier turn, which was not small talk.
+            for previous in self._previous_questions(messages):
+                results = self._get_context(messages[:previous + 1])
+                if results is not None:
+                    break
+                if self.decide(messages[:previous + 1]) == RETRIEVE:
+                    # The context was evicted or cached by the other worker, so the question is searched again.
+                    decision = RETRIEVE
+                    chat_request = ChatRequest(
+                        messages=[Message(role='user', content=messages[previous]['content'])],
+                        retrieval=chat_request.retrieval)
+                    break
+            else:
+                results = []
+        if results is None:
+            start = time.perf_counter()
+            results = await search_index_manager.retrieve(chat_request)
+            self._observe_retrieval(time.perf_counter() - start)
+        else:
+            saved = self._retrieval_seconds or 0.
+            self._saved_seconds += saved
+            RETRIEVAL_GATE_SAVED_SECONDS.inc(saved)
+        if decision != SKIP:
+            self._put_context(messages, results)
+        self._decisions[decision] += 1
+        RETRIEVAL_GATE_DECISIONS.labels(decision).inc()
+        return results
+
+    def stats(self) -> dict[str, Any]:
+        """Return the number of the decisions, the share of the skipped retrievals and the saved seconds."""
+        total = sum(self._decisions.values())
+        return dict(
+            self._decisions,
+            skip_rate=(total - self._decisions[RETRIEVE]) / total if total else 0.,
+            saved_seconds=self._saved_seconds,
+        )
+
+    @staticmethod
+    def _previous_questions(messages: Sequence[Mapping[str, Any]]) -> Iterator[int]:
+        """Return the indices of the earlier user messages, answered by the assistant, the newest first."""
+        for i in range(len(messages) - 2, 0, -1):
+            if messages[i]['role'] == 'assistant' and messages[i - 1]['role'] == 'user':
+                yield i - 1
+
+    @staticmethod
+    def _key(messages: Sequence[Mapping[str, Any]]) -> str:
+        """Return the hash of the conversation up to the question."""
+        conversation_hash = hashlib.sha256()
+        for message in messages:
+            conversation_hash.update(f"{message['role']}\x00{message['content']}\x00".encode())
+        return conversation_hash.hexdigest()
+
+    def _get_context(self, messages: Sequence[Mapping[str, Any]]) -> Optional[list[tuple[str, float]]]:
+        key = self._key(messages)
+        results = self._contexts.get(key)
+        if results is not None:
+            self._contexts.move_to_end(key)
+        return results
+
+    def _put_context(self, messages: Sequence[Mapping[str, Any]], results: list[tuple[str, float]]) -> None:
+        key = self._key(messages)
+        self._contexts[key] = results
+        self._contexts.move_to_end(key)
+        while len(self._contexts) > self._cache_size:
+            self._contexts.popitem(last=False)
+
+    def _observe_retrieval(self, seconds: float) -> None:
+        if self._retrieval_seconds is None:
+            self._retrieval_seconds = seconds
+        else:
+            self._retrieval_seconds += self.LATENCY_SMOOTHING * (seconds - self._retrieval_seconds)
@@ -0,0 +1,133 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+# See LICENSE file in the project root for full license information.
+from collections.abc import Sequence
+from typing import Optional
+
+import numpy as np
+
+from .util import RetrievalOptions
+
+
+class RetrievalPolicy:
+    """
+    The selection of the retrieved chunks for the context.
+
+    The chunks with the cosine similarity to the question below min_score are dropped.
+    If score_gap is set, the chunks after the first drop of the score by more than
+    score_gap are dropped too, so only the group of the best matches is kept. If
+    mmr_lambda is below 1, the chunks are reranked by the maximal marginal relevance:
+    each next chunk maximizes mmr_lambda times its score minus (1 - mmr_lambda) times its
+    largest similarity to the chunks already selected, so the chunks, which repeat each
+    other, are replaced by the more diverse ones. Up to top_k chunks are returned.
+
+    :param top_k: The maximal number of chunks.
+    :param min_score: The minimal cosine similarity of the chunk to the question.
+    :param score_gap: The drop of the score, after which the chunks are dropped, 0 to keep them.
+    :param mmr_lambda: The weight of the relevance against the diversity, 1 to disable the reranking.
+    :param candidates_factor: The number of the candidates, reranked by MMR, per returned chunk.
+    """
+
+    def __init__(
+            self,
+            top_k: int = 5,
+            min_score: Optional[float] = None,
+            score_gap: float = 0.,
+            mmr_lambda: float = 1.,
+            candidates_factor: int = 4,
+        ) -> None:
+        """Constructor."""
+        if top_k <= 0 or candidates_factor <= 0:
+            raise ValueError("The top_k and candidates_factor must be positive.")
+        if score_gap < 0 or not 0 <= mmr_lambda <= 1:
+            raise ValueError("The score_gap must not be negative and mmr_lambda must be in [0, 1].")
+        self.top_k = top_k
+        self.min_score = min_score
+        self.score_gap = score_gap
+        self.mmr_lambda = mmr_lambda
+        self.candidates_factor = candidates_factor
+
+    @property
+    def use_mmr(self) -> bool:
+        """True if the chunks are reranked by the maximal marginal relevance."""
+        return self.mmr_lambda < 1
+
+    @property
+    def uses_similarity(self) -> bool:
+        """True if the selection depends on the cosine similarity or the embeddings of the chunks."""
+        return self.min_score is not None or self.score_gap > 0 or self.use_mmr
+
+    @property
+    def candidates(self) -> int:
+        """The number of the chunks to retrieve before the selection."""
+        return self.top_k * self.candidates_factor if self.use_mmr else self.top_k
+
+    def override(self, options: Optional[RetrievalOptions]) -> 'RetrievalPolicy':
+        """
+        Return the policy with the options of the request.
+
+        :param options: The options, set by the request, or None.
+        :return: The new policy, or this one if no options were set.
+        """
+        if options is None:
+            return self
+        values = options.model_dump(exclude_none=True)
+        if not values:
+            return self
+        return RetrievalPolicy(
+            top_k=values.get('top_k', self.top_k),
+            min_score=values.get('min_score', self.min_score),
+            score_gap=values.get('score_gap', self.score_gap),
+            mmr_lambda=values.get('mmr_lambda', self.mmr_lambda),
+            candidates_factor=self.candidates_factor,
+        )
+
+    def select(
+            self,
+            results: Sequence[tuple[str, float]],
+            vectors: Optional[np.ndarray] = None,
+            fusion_scores: Optional[Sequence[float]] = None,
+        ) -> list[tuple[str, float]]:
+        """
+        Select the chunks for the context.
+
+        :param results: The retrieved chunks with their cosine similarity to the question, the best match first.
+        :param vectors: The embeddings of the chunks, one row per result. Without them MMR is not applied.
+        :param fusion_scores: The scores, one per result, like those of the reciprocal rank fusion, which order
+                              the chunks, kept by min_score and score_gap, instead of the cosine similarity.
+        :return: The selected chunks with their cosine similarity.
+        """
+        indices = list(range(len(results)))
+        if self.min_score is not None:
+            indices = [i for i in indices if results[i][1] >= self.min_score]
+        if self.score_gap > 0:
+            for position in range(1, len(indices)):
+                if results[indices[position - 1]][1] - results[indices[position]][1] > self.score_gap:
+                    indices = indices[:position]
+                    break
+        if fusion_scores is not None:
+            indices.sort(key=lambda i: fusion_scores[i], reverse=True)
+        if self.use_mmr and vectors is not None and len(indices) > 1:
+            indices = self._rerank(indices, [results[i][1] for i in indices], vectors[indices])
+        return [results[i] for i in indices[:self.top_k]]
+
+    def _rerank(self, indices: list[int], scores: list[float], vectors: np.ndarray) -> list[int]:
+        """Order the top_k chunks by the maximal marginal relevance."""
+        matrix = np.asarray(vectors, dtype=np.float32)
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        norms[norms == 0] = 1.
+        matrix = matrix / norms
+        similarity = matrix @ matrix.T
+        relevance = self.mmr_lambda * np.asarray(scores, dtype=np.float32)
+        # The largest similarity of each candidate to the selected ones.
+        redundancy = np.full(len(indices), -np.inf, dtype=np.float32)
+        remaining = np.ones(len(indices), dtype=bool)
+        order = []
+        for _ in range(min(self.top_k, len(indices))):
+            mmr = relevance - (1 - self.mmr_lambda) * np.where(np.isfinite(redundancy), redundancy, 0.)
+            mmr[~remaining] = -np.inf
+            best = int(np.argmax(mmr))
+            order.append(best)
+            remaining[best] = False
+            redundancy = np.maximum(redundancy, similarity[best])
+        return [indices[i] for i in order]
@@ -1,20 +1,39 @@
 # Copyright (c) Microsoft. All rights reserved.
 # Licensed under the MIT license.
 # See LICENSE file in the project root for full license information.
-import json
 import logging
 import os
-from typing import Dict
+import time
+from collections.abc import AsyncIterator
 
 import fastapi
 from fastapi import Request, Depends
-from fastapi.responses import HTMLResponse, StreamingResponse
+from fastapi.responses import HTMLResponse, Response, StreamingResponse
 from fastapi.templating import Jinja2Templates
-from azure.ai.inference.prompts import PromptTemplate
 from azure.ai.inference.aio import ChatCompletionsClient
 
-from .util import get_logger, ChatRequest
+from .admission import AdmissionController, AdmissionRejected, AdmittedStreamingResponse, release_when_done
+from .context_window import ContextWindow
+from .deployment_router import DeploymentRouter
+from .metrics import (
+    GENERATED_TOKENS,
+    GENERATION,
+    GENERATION_TOKENS_PER_SECOND,
+    PHASE_SECONDS,
+    PROMPT_ASSEMBLY,
+    TIME_TO_FIRST_TOKEN,
+    TOTAL,
+    render_metrics,
+    track_stream,
+)
+from .util import get_logger, estimate_tokens, ChatRequest
+from .prompt_builder import PromptBuilder
+from .resilience import CircuitOpenError
+from .retrieval_gate import RetrievalGate
 from .search_index_manager import SearchIndexManager
+from .session_store import SessionStore
+from .sse import coalesce_deltas, serialize_message_event, serialize_sse_event
+from .stream_replay import StreamReplayStore
 from azure.core.exceptions import HttpResponseError
 
 
@@ -58,6 +77,12 @@ logger = get_logger(
 router = fastapi.APIRouter()
 templates = Jinja2Templates(directory="api/templates")
 
+# The message deltas, arriving within the window, are sent in one SSE frame.
+# The coalescing is disabled if the window is 0.
+sse_coalesce_window = float(os.getenv("SSE_COALESCE_WINDOW_MS", "0")) / 1000
+sse_coalesce_max_bytes = int(os.getenv("SSE_COALESCE_MAX_BYTES", "1024"))
+sse_fast_json = os.getenv("SSE_FAST_JSON", "true").lower() == "true"
+
 
 # Accessors to get app state
 def get_chat_client(request: Request) -> ChatCompletionsClient:
@@ -68,11 +93,48 @@ def get_chat_model(request: Request) -> str:
     return request.app.state.chat_model
 
 
+def get_chat_router(request: Request) -> DeploymentRouter:
+    return request.app.state.chat_router
+
+
 def get_search_index_namager(request: Request) -> SearchIndexManager:
     return request.app.state.search_index_manager
 
-def serialize_sse_event(data: Dict) -> str:
-    return f"data: {json.dumps(data)}\n\n"
+
+def get_retrieval_gate(request: Request) -> Optional[RetrievalGate]:
+    return request.app.state.retrieval_gate
+
+
+def get_prompt_builder(request: Request) -> PromptBuilder:
+    return request.app.state.prompt_builder
+
+
+def get_context_window(request: Request) -> Optional[ContextWindow]:
+    return request.app.state.context_window
+
+
+def get_session_store(request: Request) -> Optional[SessionStore]:
+    return request.app.state.session_store
+
+
+def get_stream_replay_store(request: Request) -> Optional[StreamReplayStore]:
+    return request.app.state.stream_replay_store
+
+
+def get_admission_controller(request: Request) -> Optional[AdmissionController]:
+    return request.app.state.admission_controller
+
+
+
+async def replay_stream(store: StreamReplayStore, stream_id: str, after: int = -1) -> AsyncIterator[str]:
+    """Send the recorded events with the IDs, which the client can resume the stream from."""
+    async for event_id, event in store.read(stream_id, after):
+        yield f"id: {stream_id}:{event_id}\n{event}"
+
+def serialize_message(content: str) -> str:
+    if sse_fast_json:
+        return serialize_message_event(content)
+    return serialize_sse_event({"content": content, "type": "message"})
 
 
 @router.get("/", response_class=HTMLResponse)
@@ -84,12 +146,25 @@ async def index_name(request: Request, _ = auth_dependency):
         }
     )
 
+
+@router.get("/metrics")
+async def metrics(_ = auth_dependency):
+    content, content_type = render_metrics()
+    return Response(content=content, media_type=content_type)
+
+
 @router.post("/chat")
 async def chat_stream_handler(
     chat_request: ChatRequest,
-    chat_client: ChatCompletionsClient = Depends(get_chat_client),
-    model_deployment_name: str = Depends(get_chat_model),
+    request: Request,
+    chat_router: DeploymentRouter = Depends(get_chat_router),
     search_index_manager: SearchIndexManager = Depends(get_search_index_namager),
+    retrieval_gate: Optional[RetrievalGate] = Depends(get_retrieval_gate),
+    prompt_builder: PromptBuilder = Depends(get_prompt_builder),
+    context_window: Optional[ContextWindow] = Depends(get_context_window),
+    session_store: Optional[SessionStore] = Depends(get_session_store),
+    stream_replay_store: Optional[StreamReplayStore] = Depends(get_stream_replay_store),
+    admission_controller: Optional[AdmissionController] = Depends(get_admission_controller),
     _ = auth_dependency
 ) -> fastapi.responses.StreamingResponse:
     
@@ -98,41 +173,78 @@ async def chat_stream_handler(
         "Connection": "keep-alive",
         "Content-Type": "text/event-stream"
     }    
-    if chat_client is None:
+    if chat_router is None:
         raise Exception("Chat client not initialized")
 
+    # In the session mode the client sends only the new messages, and the history is kept on the server.
+    session_id = chat_request.session_id
+    history = []
+    if session_id is not None:
+        history = await session_store.get(session_id) if session_store is not None else None
+        if history is None:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND, detail="The session was not found or has expired.")
+        headers["X-Session-Id"] = session_id
+
     async def response_stream():
-        messages = [{"role": message.role, "content": message.content} for message in chat_request.messages]
+        request_start = time.perf_counter()
+        new_messages = [{"role": message.role, "content": message.content} for message in chat_request.messages]
+        messages = history + new_messages
 
-        prompt_messages = PromptTemplate.from_string('You are a helpful assistant').create_messages()
-        # Use RAG model, only if we were provided index and we have found a context there.
-        if search_index_manager is not None:
-            context = await search_index_manager.search(chat_request)
+        try:
+            # Use RAG model, only if we were provided index and we have found a context there.
+            # The search errors, like the exhausted token budget of the embeddings, are sent to the client.
+            results = []
+            if search_index_manager is not None:
+                try:
+                    if retrieval_gate is not None:
+                        # The turns like "thanks!" are not searched.
+                        results = await retrieval_gate.retrieve(search_index_manager, chat_request, messages)
+                    else:
+                        results = await search_index_manager.retrieve(chat_request)
+                except CircuitOpenError as e:
+                    # The failing service is not waited for, the question is answered without the context.
+                    logger.warning(f"{e} The question is answered without the context.")
+                logger.info(f"Retrieved {len(results)} chunks with scores {[round(score, 3) for _, score in results]}.")
+            with PHASE_SECONDS.labels(PROMPT_ASSEMBLY).time():
+                prompt_messages, context = prompt_builder.build([token for token, _ in results])
             if context:
-                prompt_messages = PromptTemplate.from_string(
-                    'You are a helpful assistant that answers some questions '
-                    'with the help of some context data.\n\nHere is '
-                    'the context data:\n\n{{context}}').create_messages(data=dict(context=context))
                 logger.info(f"{prompt_messages=}")
-            else:
+            elif search_index_manager is not None:
                 logger.info("Unable to find the relevant information in the index for the request.")
-        try:
+            # Send only the newest messages of the long conversation.
+            if context_window is not None:
+                chat_messages = await context_window.fit(prompt_messages, messages)
+            else:
+                chat_messages = prompt_messages + messages
             accumulated_message = ""
-            chat_coroutine = await chat_client.complete(
-                model=model_deployment_name, messages=prompt_messages + messages, stream=True
-            )
-            async for event in chat_coroutine:
-                if event.choices:
-                    first_choice = event.choices[0]
-                    if first_choice.delta.content:
-                        message = first_choice.delta.content
-                        accumulated_message += message
-                        yield serialize_sse_event({
-                                        "content": message,
-                                        "type": "message",
-                                    }
-                                )
+            first_token_time = None
+            completion_start = time.perf_counter()
+
+            async def message_deltas() -> AsyncIterator[str]:
+                nonlocal first_token_time
+                # The deployment is chosen by the router, which moves the throttled request to another one.
+                async for content in chat_router.stream(chat_messages):
+                    if first_token_time is None:
+                        first_token_time = time.perf_counter()
+                        PHASE_SECONDS.labels(TIME_TO_FIRST_TOKEN).observe(first_token_time - completion_start)
+                    yield content
+
+            async for message in coalesce_deltas(message_deltas(), sse_coalesce_window, sse_coalesce_max_bytes):
+                accumulated_message += message
+                yield serialize_message(message)
+
+            if session_id is not None:
+                await session_store.append(
+                    session_id, new_messages + [{"role": "assistant", "content": accumulated_message}])
 
+            if first_token_time is not None:
+                generation_time = time.perf_counter() - first_token_time
+                generated_tokens = estimate_tokens(accumulated_message)
+                PHASE_SECONDS.labels(GENERATION).observe(generation_time)
+                GENERATED_TOKENS.inc(generated_tokens)
+                if generation_time > 0:
+                    GENERATION_TOKENS_PER_SECOND.observe(generated_tokens / generation_time)
             yield serialize_sse_event({
                 "content": accumulated_message,
                 "type": "completed_message",
@@ -164,8 +276,104 @@ async def chat_stream_handler(
                             "content": response,
                             "type": "completed_message",
                         })
+        PHASE_SECONDS.labels(TOTAL).observe(time.perf_counter() - request_start)
         yield serialize_sse_event({
             "type": "stream_end"
             })
 
-    return StreamingResponse(response_stream(), headers=headers)
+    events = response_stream()
+    admission = None
+    if admission_controller is not None:
+        client_id = admission_controller.client_id(
+            request.headers.get("X-Forwarded-For"), request.client.host if request.client else "")
+        try:
+            admission = await admission_controller.acquire(client_id)
+        except AdmissionRejected as e:
+            raise HTTPException(
+                status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                detail="Too many requests, please retry later.",
+                headers={"Retry-After": str(e.retry_after)},
+            )
+
+    if stream_replay_store is None:
+        if admission is not None:
+            # The slot is held until the response is sent, and released even if the client
+            # disconnects before the response stream has started.
+            return AdmittedStreamingResponse(track_stream(events), admission, headers=headers)
+        return StreamingResponse(track_stream(events), headers=headers)
+
+    if admission is not None:
+        # The slot is held until the response is generated by the recording.
+        events = release_when_done(events, admission)
+
+    # The response is generated to the end, even if the client disconnects,
+    # so that the client can resume the stream from the last received event.
+    stream_id = stream_replay_store.start(events)
+    headers["X-Stream-Id"] = stream_id
+    return StreamingResponse(track_stream(replay_stream(stream_replay_store, stream_id)), headers=headers)
+
+
+@router.post("/chat/sessions")
+async def create_chat_session(
+    session_store: Optional[SessionStore] = Depends(get_session_store),
+    _ = auth_dependency
+):
+    """Start the conversation, kept on the server, and return its ID to be sent with the chat requests."""
+    if session_store is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="The sessions are disabled.")
+    return {"session_id": await session_store.create()}
+
+
+@router.get("/chat/sessions/{session_id}")
+async def get_chat_session(
+    session_id: str,
+    session_store: Optional[SessionStore] = Depends(get_session_store),
+    _ = auth_dependency
+):
+    """Return the messages of the conversation."""
+    messages = await session_store.get(session_id) if session_store is not None else None
+    if messages is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="The session was not found or has expired.")
+    return {"session_id": session_id, "messages": messages}
+
+
+@router.delete("/chat/sessions/{session_id}", status_code=status.HTTP_204_NO_CONTENT)
+async def delete_chat_session(
+    session_id: str,
+    session_store: Optional[SessionStore] = Depends(get_session_store),
+    _ = auth_dependency
+):
+    """Remove the conversation."""
+    if session_store is not None:
+        await session_store.delete(session_id)
+
+
+@router.get("/chat/streams/{stream_id}")
+async def resume_chat_stream(
+    stream_id: str,
+    request: Request,
+    last_event_id: Optional[str] = None,
+    stream_replay_store: Optional[StreamReplayStore] = Depends(get_stream_replay_store),
+    _ = auth_dependency
+) -> fastapi.responses.StreamingResponse:
+    """
+    Resume the chat stream after the event with last_event_id.
+
+    The last event ID is taken from the query parameter or from the Last-Event-ID header.
+    It is either the full SSE event ID or its sequence number after the colon.
+    """
+    if stream_replay_store is None or not await stream_replay_store.exists(stream_id):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="The stream was not found or has expired.")
+    last_event_id = last_event_id or request.headers.get("Last-Event-ID") or "-1"
+    try:
+        after = int(last_event_id.rpartition(":")[2])
+    except ValueError:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid last event ID.")
+    headers = {
+        "Cache-Control": "no-cache",
+        "Connection": "keep-alive",
+        "Content-Type": "text/event-stream",
+        "X-Stream-Id": stream_id,
+    }
+    return StreamingResponse(
+        track_stream(replay_stream(stream_replay_store, stream_id, after)), headers=headers)
@@ -1,10 +1,20 @@
-from typing import Optional
+from typing import Any, Callable, Optional, TypeVar, Union
+from collections.abc import Awaitable, Iterator
 
+import asyncio
 import glob
 import csv
+import hashlib
+import io
 import json
+import os
+import random
+import time
 
+import numpy as np
+from azure.core.credentials import AzureKeyCredential
 from azure.core.credentials_async import AsyncTokenCredential
+from azure.core.pipeline.transport import AsyncHttpTransport
 from azure.search.documents.aio import SearchClient
 from azure.search.documents.indexes.aio import SearchIndexClient
 from azure.search.documents.models import VectorizedQuery 
@@ -18,36 +28,89 @@ from azure.search.documents.indexes.models import (
     HnswAlgorithmConfiguration)
 from azure.ai.inference.aio import EmbeddingsClient
 from azure.core.exceptions import ResourceNotFoundError, HttpResponseError
+from .chunker import MarkdownChunker
+from .embedding_cache import EmbeddingCache
+from .embeddings_file import iter_embeddings, iter_tokens
+from .keyword_index import KeywordIndex, reciprocal_rank_fusion
+from .local_search_index import LocalSearchIndex
+from .resilience import ResilientCaller
+from .metrics import (
+    KEYWORD_FAST_PATH,
+    KEYWORD_SEARCH,
+    PHASE_SECONDS,
+    QUERY_EMBEDDING,
+    RETRIEVAL_SCORE,
+    RETRIEVED_CHUNKS,
+    VECTOR_SEARCH,
+)
+from .retrieval_policy import RetrievalPolicy
 from .util import ChatRequest
 
+T = TypeVar('T')
+
 
 class SearchIndexManager:
     """
     The class for searching of context for user queries.
 
     :param endpoint: The search endpoint to be used.
-    :param credential: The credential to be used for the search.
+    :param credential: The credential to be used for the search, either the token credential
+                       or AzureKeyCredential with the search API key.
     :param index_name: The name of an index to get or to create.
     :param dimensions: The number of dimensions in the embedding. Set this parameter only if
                        embedding model accepts dimensions parameter.
     :param model: The embedding model to be used,
                   must be the same as one use to build the file with embeddings.
     :param embeddings_client: The embedding client.
+    :param local_index: The in-process index to search instead of Azure AI Search.
+                        If it is set, the search does not require the Azure index to be created.
+    :param embedding_cache: The cache of the query embeddings.
+    :param retrieval_policy: The selection of the retrieved chunks, which the request can override.
+    :param keyword_index: The BM25 index of the chunks. If it is set, its results are added to
+                          the vector search results and the chunks, selected by the retrieval policy,
+                          are ordered by the reciprocal rank fusion of both rankings.
+    :param keyword_fast_path_words: If the best keyword match contains all rare words of the question
+                                    and there are at least this number of them, the keyword results are
+                                    returned without the query embedding, unless the retrieval policy
+                                    depends on the cosine similarity. 0 disables the fast path.
+    :param chunk_vectors: The embeddings of the chunks, which give the keyword matches, absent in
+                          the vector search results, their cosine similarity to the question.
+                          The local index is used by default; without either of them such matches are dropped.
+    :param transport: The shared HTTP transport of the search client. If not set, the client creates its own.
+    :param embeddings_caller: The caller, which hedges the slow query embeddings and stops them
+                              when the embeddings model fails. CircuitOpenError is raised then.
+    :param search_caller: The caller, which hedges the slow Azure AI Search queries and stops them
+                          when the service fails. CircuitOpenError is raised then.
     """
     
     MIN_DIFF_CHARACTERS_IN_LINE = 5
     MIN_LINE_LENGTH = 5
+    # Azure AI Search accepts up to 1000 documents and 16 MB per indexing request.
+    MAX_UPLOAD_BATCH_DOCUMENTS = 1000
+    MAX_UPLOAD_BATCH_BYTES = 8 * 1024 * 1024
+    RETRYABLE_STATUS_CODES = (429, 503)
     
     def __init__(
             self,
             endpoint: str,
-            credential: AsyncTokenCredential,
+            credential: Union[AsyncTokenCredential, AzureKeyCredential],
             index_name: str,
             dimensions: Optional[int],
             model: str,
             embeddings_client: EmbeddingsClient,
+            local_index: Optional[LocalSearchIndex] = None,
+            embedding_cache: Optional[EmbeddingCache] = None,
+            retrieval_policy: Optional[RetrievalPolicy] = None,
+            keyword_index: Optional[KeywordIndex] = None,
+            keyword_fast_path_words: int = 2,
+            transport: Optional[AsyncHttpTransport] = None,
+            embeddings_caller: Optional[ResilientCaller] = None,
+            search_caller: Optional[ResilientCaller] = None,
+            chunk_vectors: Optional[LocalSearchIndex] = None,
         ) -> None:
         """Constructor."""
+        if local_index is not None and dimensions is not None and local_index.dimensions != dimensions:
+            raise ValueError("The dimensions of the local index are different from dimensions provided to constructor.")
         self._dimensions = dimensions
         self._index_name = index_name
         self._embeddings_client = embeddings_client
@@ -56,12 +119,22 @@ class SearchIndexManager:
         self._index = None
         self._model = model
         self._client = None
+        self._local_index = local_index
+        self._embedding_cache = embedding_cache
+        self._retrieval_policy = retrieval_policy or RetrievalPolicy()
+        self._keyword_index = keyword_index
+        self._keyword_fast_path_words = keyword_fast_path_words
+        self._transport = transport
+        self._embeddings_caller = embeddings_caller
+        self._search_caller = search_caller
+        self._chunk_vectors = chunk_vectors or local_index
 
     def _get_client(self):
         """Get search client if it is absent."""
         if self._client is None:
             self._client = SearchClient(
-                endpoint=self._endpoint, index_name=self._index.name, credential=self._credential)
+                endpoint=self._endpoint, index_name=self._index.name, credential=self._credential,
+                transport=self._transport)
         return self._client
 
     async def search(self, message: ChatRequest) -> str:
@@ -71,41 +144,378 @@ class SearchIndexManager:
         :param message: The customer question.
         :return: The context for the question.
         """
-        self._raise_if_no_index()
-        embedded_question = (await self._embeddings_client.embed(
-            input=message.messages[-1].content,
-            dimensions=self._dimensions,
-            model=self._model
-        ))['data'][0]['embedding']
-        vector_query = VectorizedQuery(vector=embedded_question, k_nearest_neighbors=5, fields="embedding")
+        return "\n------\n".join(await self.search_chunks(message))
+
+    async def search_chunks(self, message: ChatRequest) -> list[str]:
+        """
+        Search the message in the vector store.
+
+        :param message: The customer question.
+        :return: The chunks, found for the question, the best match first.
+        """
+        return [token for token, _ in await self.retrieve(message)]
+
+    async def retrieve(self, message: ChatRequest) -> list[tuple[str, float]]:
+        """
+        Search the message in the vector store and select the chunks by the retrieval policy.
+
+        :param message: The customer question with the optional retrieval options.
+        :return: The selected chunks with their cosine similarity to the question, in the order of the policy,
+                 or of the reciprocal rank fusion with the keyword results. If the keyword match was strong
+                 enough to skip the vector search, the keyword results with their BM25 scores.
+        :raises: CircuitOpenError if the embeddings model or the search service is not called
+                 because of the earlier failures.
+        """
+        if self._local_index is None:
+            self._raise_if_no_index()
+        policy = self._retrieval_policy.override(message.retrieval)
+        question = message.messages[-1].content
+        keyword_results = []
+        if self._keyword_index is not None:
+            with PHASE_SECONDS.labels(KEYWORD_SEARCH).time():
+                keyword_search = self._keyword_index.search(question, top_k=policy.top_k)
+            keyword_results = keyword_search.results
+            # The similarity of the chunks is not known without the query embedding.
+            if self._keyword_fast_path_words and not policy.uses_similarity and \
+                    keyword_search.rare_words_in_best == keyword_search.rare_words >= self._keyword_fast_path_words:
+                KEYWORD_FAST_PATH.inc()
+                RETRIEVED_CHUNKS.observe(len(keyword_results))
+                return keyword_results
+        with PHASE_SECONDS.labels(QUERY_EMBEDDING).time():
+            embedded_question = await self._get_embedding(question)
+        with PHASE_SECONDS.labels(VECTOR_SEARCH).time():
+            vectors = None
+            if self._local_index is not None:
+                # The scan of the large index takes milliseconds, so it runs in a thread,
+                # while the event loop keeps streaming the other responses.
+                if policy.use_mmr:
+                    results, vectors = await asyncio.to_thread(
+                        self._local_index.search_with_vectors, embedded_question, policy.candidates)
+                else:
+                    results = await asyncio.to_thread(
+                        self._local_index.search, embedded_question, policy.candidates)
+            else:
+                documents = await self._call(
+                    self._search_caller,
+                    lambda: self._search_documents(embedded_question, policy.candidates, policy.use_mmr))
+                results = [(document['token'], self._to_cosine(document.get('@search.score')))
+                           for document in documents]
+                if policy.use_mmr:
+                    vectors = np.array([document['embedding'] for document in documents], dtype=np.float32)
+            fusion_scores = None
+            if keyword_results:
+                results, vectors, fusion_scores = self._add_keyword_results(
+                    embedded_question, results, vectors, keyword_results)
+            selected = policy.select(results, vectors, fusion_scores)
+        for _, score in selected:
+            RETRIEVAL_SCORE.observe(score)
+        RETRIEVED_CHUNKS.observe(len(selected))
+        return selected
+
+    def _add_keyword_results(
+            self,
+            embedded_question: list[float],
+            results: list[tuple[str, float]],
+            vectors: Optional[np.ndarray],
+            keyword_results: list[tuple[str, float]],
+        ) -> tuple[list[tuple[str, float]], Optional[np.ndarray], list[float]]:
+        """
+        Add the keyword matches to the vector search results with their cosine similarity to the question.
+
+        :return: The chunks, the highest cosine similarity first, their embeddings, if vectors were given,
+                 and their scores of the reciprocal rank fusion of the vector and keyword rankings.
+        """
+        fusion = dict(reciprocal_rank_fusion([results, keyword_results]))
+        found = {token for token, _ in results}
+        missing = [token for token, _ in keyword_results if token not in found]
+        if missing and self._chunk_vectors is not None:
+            added, added_vectors = self._chunk_vectors.score(embedded_question, missing)
+            if vectors is not None:
+                vectors = np.concatenate([vectors, added_vectors.astype(np.float32)])
+            results = results + added
+        order = sorted(range(len(results)), key=lambda i: results[i][1], reverse=True)
+        if vectors is not None:
+            vectors = vectors[order]
+        return [results[i] for i in order], vectors, [fusion[results[i][0]] for i in order]
+
+    async def _search_documents(self, vector: list[float], top: int, with_vectors: bool) -> list[dict[str, Any]]:
+        """Return the documents, nearest to the vector, from Azure AI Search."""
+        vector_query = VectorizedQuery(vector=vector, k_nearest_neighbors=top, fields="embedding")
         response = await self._get_client().search(
             vector_queries=[vector_query],
-            select=['token'],
+            select=['token', 'embedding'] if with_vectors else ['token'],
+            top=top,
         )
-        results = [result['token'] async for result in response]
-        return "\n------\n".join(results)
+        return [result async for result in response]
+
+    @staticmethod
+    async def _call(caller: Optional[ResilientCaller], factory: Callable[[], Awaitable[T]]) -> T:
+        """Make the call through the caller, if it is set."""
+        if caller is None:
+            return await factory()
+        return await caller.call(factory)
+
+    @staticmethod
+    def _to_cosine(score: Optional[float]) -> float:
+        """
+        Convert the score of Azure AI Search to the cosine similarity.
+
+        For the cosine metric the score is 1 / (1 + distance), where the distance is 1 - cosine.
+        """
+        if not score:
+            return 0.
+        return 2. - 1. / score
     
-    async def upload_documents(self, embeddings_file: str) -> None:
+    async def _get_embedding(self, text: str) -> list[float]:
+        """
+        Return the embedding of the question, using the cache if it is available.
+
+        :param text: The question.
+        :return: The embedding.
+        """
+        if self._embedding_cache is not None:
+            embedding = await self._embedding_cache.get(text, self._model, self._dimensions)
+            if embedding is not None:
+                return embedding
+        embedding = (await self._call(self._embeddings_caller, lambda: self._embeddings_client.embed(
+            input=text,
+            dimensions=self._dimensions,
+            model=self._model
+        )))['data'][0]['embedding']
+        if self._embedding_cache is not None:
+            self._embedding_cache.put(text, self._model, self._dimensions, embedding)
+        return embedding
+
+    async def warm_up_embedding_cache(self, questions: list[str]) -> int:
+        """
+        Embed the questions, absent in the cache, with one request and add them to the cache.
+
+        :param questions: The questions, expected to be asked by users.
+        :return: The number of questions embedded.
+        """
+        if self._embedding_cache is None:
+            return 0
+        missing = []
+        for question in questions:
+            if await self._embedding_cache.get(question, self._model, self._dimensions, record_stats=False) is None:
+                missing.append(question)
+        if not missing:
+            return 0
+        embeddings = (await self._embeddings_client.embed(
+            input=missing,
+            dimensions=self._dimensions,
+            model=self._model
+        ))['data']
+        for question, embedding in zip(missing, embeddings):
+            self._embedding_cache.put(question, self._model, self._dimensions, embedding['embedding'])
+        return len(missing)
+
+    async def upload_documents(
+            self,
+            embeddings_file: str,
+            max_batch_documents: int = MAX_UPLOAD_BATCH_DOCUMENTS,
+            max_batch_bytes: int = MAX_UPLOAD_BATCH_BYTES,
+            max_concurrency: int = 4,
+            max_retries: int = 5,
+            skip_ids: Optional[set[str]] = None,
+        ) -> dict[str, Any]:
         """
         Upload the embeggings file to index search.
 
+        The file is read lazily and split into the batches, limited by the number of documents
+        and by the size of serialized documents. Up to max_concurrency batches are uploaded at once,
+        so only these batches are kept in memory. The document key is the hash of the token, see get_embed_id,
+        so the repeated tokens are uploaded once.
+        :param embeddings_file: The embeddings file to upload, either csv or .npy in the binary format.
+        :param max_batch_documents: The maximal number of documents in one upload request.
+        :param max_batch_bytes: The maximal size of the serialized documents in one upload request.
+        :param max_concurrency: The maximal number of upload requests in flight.
+        :param max_retries: The number of retries of the throttled upload request.
+        :param skip_ids: The keys of the documents, which should not be uploaded.
+        :return: The dictionary with the number of uploaded documents and batches, the time spent
+                 and the number of documents per second.
+        """
+        self._raise_if_no_index()
+        start = time.perf_counter()
+        semaphore = asyncio.Semaphore(max_concurrency)
+        tasks = set()
+        documents = 0
+        batches = 0
+
+        async def upload(batch: list[dict[str, Any]]) -> None:
+            try:
+                await self._upload_batch(batch, max_retries)
+            finally:
+                semaphore.release()
+
+        try:
+            for batch in self._iter_upload_batches(embeddings_file, max_batch_documents, max_batch_bytes, skip_ids):
+                await semaphore.acquire()
+                # Stop reading the file as soon as any of the batches has failed.
+                for task in [t for t in tasks if t.done()]:
+                    tasks.discard(task)
+                    task.result()
+                tasks.add(asyncio.create_task(upload(batch)))
+                documents += len(batch)
+                batches += 1
+            await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+        seconds = time.perf_counter() - start
+        return {
+            'documents': documents,
+            'batches': batches,
+            'seconds': seconds,
+            'documents_per_second': documents / seconds if seconds > 0 else 0.,
+        }
+
+    def _iter_upload_batches(
+            self,
+            embeddings_file: str,
+            max_batch_documents: int,
+            max_batch_bytes: int,
+            skip_ids: Optional[set[str]] = None) -> Iterator[list[dict[str, Any]]]:
+        """
+        Read the embeddings file lazily and yield the batches of documents.
+
         :param embeddings_file: The embeddings file to upload.
+        :param max_batch_documents: The maximal number of documents in the batch.
+        :param max_batch_bytes: The maximal size of the serialized documents in the batch.
+        :param skip_ids: The keys of the documents to skip.
+        :return: The iterator over the batches of documents.
+        """
+        # The keys of the documents already read, the service rejects the same key in one batch.
+        seen_ids = set(skip_ids) if skip_ids else set()
+
+        def is_new(token: str) -> bool:
+            embed_id = SearchIndexManager.get_embed_id(token)
+            if embed_id in seen_ids:
+                return False
+            seen_ids.add(embed_id)
+            return True
+
+        batch = []
+        batch_bytes = 0
+        for token, embedding in iter_embeddings(embeddings_file, token_filter=is_new):
+            document = {
+                'embedId': SearchIndexManager.get_embed_id(token),
+                'token': token,
+                'embedding': embedding
+            }
+            # Account for the serialized document and the separating comma.
+            document_bytes = len(json.dumps(document)) + 1
+            if batch and (len(batch) >= max_batch_documents or batch_bytes + document_bytes > max_batch_bytes):
+                yield batch
+                batch = []
+                batch_bytes = 0
+            batch.append(document)
+            batch_bytes += document_bytes
+        if batch:
+            yield batch
+
+    async def _upload_batch(self, batch: list[dict[str, Any]], max_retries: int) -> None:
+        """
+        Upload the batch, retrying the throttled requests and documents with the exponential backoff.
+
+        :param batch: The documents to upload.
+        :param max_retries: The number of retries.
+        :raises: HttpResponseError if the documents were not uploaded.
+        """
+        for attempt in range(max_retries + 1):
+            retry_after = None
+            try:
+                results = await self._get_client().upload_documents(batch)
+            except HttpResponseError as e:
+                if e.status_code not in SearchIndexManager.RETRYABLE_STATUS_CODES or attempt == max_retries:
+                    raise
+                if e.response is not None and e.response.headers.get('Retry-After'):
+                    try:
+                        retry_after = float(e.response.headers['Retry-After'])
+                    except ValueError:
+                        pass
+            else:
+                # The service can accept the request, but throttle the part of documents.
+                retryable = {
+                    result.key for result in results
+                    if not result.succeeded and result.status_code in SearchIndexManager.RETRYABLE_STATUS_CODES}
+                failed = [result for result in results
+                          if not result.succeeded and result.key not in retryable]
+                if failed:
+                    raise HttpResponseError(
+                        message=f"Failed to upload {len(failed)} documents: {failed[0].error_message}")
+                if not retryable:
+                    return
+                if attempt == max_retries:
+                    raise HttpResponseError(
+                        message=f"Failed to upload {len(retryable)} documents, the service is throttling.")
+                batch = [document for document in batch if document['embedId'] in retryable]
+            if retry_after is None:
+                retry_after = min(60., 2 ** attempt) * (0.5 + random.random())
+            await asyncio.sleep(retry_after)
+
+    @staticmethod
+    def get_embed_id(token: str) -> str:
+        """
+        Return the key of the document, derived from the token contents.
+
+        The same chunk always gets the same key, which lets sync_documents find the new,
+        changed and deleted chunks without re-embedding the unchanged ones.
+        :param token: The text chunk.
+        :return: The hex encoded SHA-256 hash of the token.
+        """
+        return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+    async def get_document_ids(self) -> set[str]:
+        """
+        Return the keys of all documents in the index.
+
+        :return: The set of document keys.
+        """
+        self._raise_if_no_index()
+        response = await self._get_client().search(search_text='*', select=['embedId'])
+        return {document['embedId'] async for document in response}
+
+    async def delete_documents(
+            self,
+            embed_ids: set[str],
+            max_batch_documents: int = MAX_UPLOAD_BATCH_DOCUMENTS) -> None:
+        """
+        Delete the documents from the index.
+
+        :param embed_ids: The keys of documents to delete.
+        :param max_batch_documents: The maximal number of documents deleted by one request.
         """
         self._raise_if_no_index()
-        documents = []
-        index = 0
-        with open(embeddings_file, newline='') as fp:
-            reader = csv.DictReader(fp)
-            for row in reader:
-                documents.append(
-                    {
-                        'embedId': str(index),
-                        'token': row['token'],
-                        'embedding': json.loads(row['embedding'])
-                    }
-                )
-                index += 1
-        await self._get_client().upload_documents(documents)
+        embed_ids = sorted(embed_ids)
+        for i in range(0, len(embed_ids), max_batch_documents):
+            await self._get_client().delete_documents(
+                documents=[{'embedId': embed_id} for embed_id in embed_ids[i:i + max_batch_documents]])
+
+    async def sync_documents(self, embeddings_file: str, **kwargs: Any) -> dict[str, Any]:
+        """
+        Make the index contents equal to the embeddings file, uploading only the changes.
+
+        The documents are compared by keys, derived from the token hashes. The tokens absent in the index
+        are uploaded and the documents, absent in the file, are deleted. Together with the incremental
+        build_embeddings_file it lets to refresh the index after the documentation edit, without
+        re-embedding and re-uploading the whole data set.
+        :param embeddings_file: The embeddings file, either csv or .npy in the binary format.
+        :param kwargs: The parameters of upload_documents.
+        :return: The dictionary with the numbers of uploaded, deleted and unchanged documents.
+        """
+        indexed_ids = await self.get_document_ids()
+        file_ids = {SearchIndexManager.get_embed_id(token) for token in iter_tokens(embeddings_file)}
+        upload_stats = await self.upload_documents(embeddings_file, skip_ids=indexed_ids, **kwargs)
+        stale_ids = indexed_ids - file_ids
+        await self.delete_documents(stale_ids)
+        return {
+            'uploaded': upload_stats['documents'],
+            'deleted': len(stale_ids),
+            'unchanged': len(indexed_ids & file_ids),
+        }
 
     async def is_index_empty(self) -> bool:
         """
@@ -295,62 +705,172 @@ class SearchIndexManager:
             self,
             input_directory: str,
             output_file: str,
-            sentences_per_embedding: int=4
+            max_tokens: int=256,
+            overlap_tokens: int=32,
+            batch_size: int=2000,
+            max_concurrency: int=4,
+            incremental: bool=False,
+            max_workers: Optional[int]=None,
             ) -> None:
         """
-        In this method we do lazy loading of nltk and download the needed data set to split
+        Split the markdown files from input_directory into chunks and build the embeddings file.
 
-        document into tokens. This operation takes time that is why we hide import nltk under this
-        method. We also do not include nltk into requirements because this method is only used
-        during rag generation.
-        :param dimensions: The number of dimensions in the embeddings. Must be the same as
-               the one used for SearchIndexManager creation.
-        :param input_directory: The directory with the embedding files.
+        The documents are split by MarkdownChunker into the chunks of up to max_tokens tokens,
+        which follow the headings and sections of documents; the files are processed in parallel
+        by the pool of max_workers processes.
+        The embeddings are requested in batches, up to max_concurrency batches at once, and each
+        batch is appended to the output file as soon as it is embedded, so the rows are not
+        necessarily in the order of the input documents. The progress is saved to the checkpoint
+        file next to output_file, so the interrupted build continues from the last written batch
+        when it is called again with the same input.
+        If incremental is True and output_file exists, the embeddings of the tokens, which are
+        already present in it, are reused and only the new or changed tokens are embedded.
+        :param input_directory: The directory with the markdown files, including subdirectories.
         :param output_file: The file csv file to store embeddings.
-        :param embeddings_client: The embedding client, used to create embeddings. 
-                Must be the same as the one used for SearchIndexManager creation.
-        :param sentences_per_embedding: The number of sentences used to build embedding.
-        :param model: The embedding model to be used.
+        :param max_tokens: The target number of tokens in one chunk.
+        :param overlap_tokens: The number of tokens repeated between the chunks of the long section.
+        :param batch_size: The number of tokens embedded with one request.
+        :param max_concurrency: The maximal number of embedding requests in flight.
+        :param incremental: If True, reuse the embeddings of unchanged tokens from output_file.
+        :param max_workers: The number of processes used to split the files.
         """
-        import nltk
-        nltk.download('punkt')
-        
-        from nltk.tokenize import sent_tokenize
-        # Split the data to sentence tokens.
-        sentence_tokens = []
-        globs = glob.glob(input_directory + '/*.md', recursive=True)
-        index = 0
-        for fle in globs:
-            with open(fle) as f:
-                for line in f:
-                    line = line.strip()
-                    # Skip non informative lines.
-                    if len(line) < SearchIndexManager.MIN_LINE_LENGTH or len(set(line)) < SearchIndexManager.MIN_DIFF_CHARACTERS_IN_LINE:
-                        continue
-                    for sentence in sent_tokenize(line):
-                        if index % sentences_per_embedding == 0:
-                            sentence_tokens.append(sentence)
-                        else:
-                            sentence_tokens[-1] += ' '
-                            sentence_tokens[-1] += sentence
-                        index += 1
-        
-        
+        chunker = MarkdownChunker(
+            max_tokens=max_tokens,
+            overlap_tokens=overlap_tokens,
+            min_line_length=SearchIndexManager.MIN_LINE_LENGTH,
+            min_diff_characters_in_line=SearchIndexManager.MIN_DIFF_CHARACTERS_IN_LINE,
+        )
+        files = sorted(glob.glob(os.path.join(input_directory, '**', '*.md'), recursive=True))
+        chunks = chunker.chunk_files(files, max_workers=max_workers)
+
+        known_embeddings = {}
+        if incremental and os.path.isfile(output_file):
+            # After the interrupted build only the rows of the committed batches are read.
+            size = None
+            if os.path.isfile(output_file + '.checkpoint'):
+                with open(output_file + '.checkpoint') as fp:
+                    size = json.load(fp)['size']
+            wanted = set(chunks)
+            known_embeddings = {
+                token: embedding
+                for token, embedding in SearchIndexManager._read_embeddings(output_file, size).items()
+                if token in wanted}
         # For each token build the embedding, which will be used in the search.
-        batch_size = 2000
-        with open(output_file, 'w') as fp:
-            writer = csv.DictWriter(fp, fieldnames=['token', 'embedding'])
+        await self._write_embeddings(
+            chunks, output_file, batch_size, max_concurrency, known_embeddings)
+
+    async def _write_embeddings(
+            self,
+            tokens: list[str],
+            output_file: str,
+            batch_size: int,
+            max_concurrency: int,
+            known_embeddings: Optional[dict[str, str]] = None) -> None:
+        """
+        Embed the tokens concurrently and append them to the csv file with the checkpoint.
+
+        The checkpoint keeps the fingerprint of the input tokens, the indices of the written batches,
+        the size of the known embeddings at the start of the output file and the size of the file
+        after the last written batch. The rows written after this size, if any, belong to the batch
+        which was not committed and are truncated on resume. On resume the known embeddings are read
+        from the start of the output file, so the tokens are split into the same batches.
+        :param tokens: The tokens to embed.
+        :param output_file: The csv file to store embeddings.
+        :param batch_size: The number of tokens embedded with one request.
+        :param max_concurrency: The maximal number of embedding requests in flight.
+        :param known_embeddings: The JSON encoded embeddings of tokens, which do not need to be embedded.
+        """
+        known_embeddings = known_embeddings or {}
+        checkpoint_file = output_file + '.checkpoint'
+        fingerprint = hashlib.sha256(
+            json.dumps([self._model, self._dimensions, batch_size, tokens]).encode('utf-8')).hexdigest()
+        checkpoint = None
+        if os.path.isfile(checkpoint_file) and os.path.isfile(output_file):
+            with open(checkpoint_file) as fp:
+                checkpoint = json.load(fp)
+            if checkpoint.get('fingerprint') != fingerprint or 'known_size' not in checkpoint:
+                checkpoint = None
+        if checkpoint is None:
+            tokens = [token for token in tokens if token not in known_embeddings]
+            contents = io.StringIO()
+            writer = csv.DictWriter(contents, fieldnames=['token', 'embedding'])
             writer.writeheader()
-            for i in range(0, len(sentence_tokens), batch_size):
-                emedding = (await self._embeddings_client.embed(
-                    input=sentence_tokens[i:i+min(batch_size, len(sentence_tokens))],
+            for token, embedding in known_embeddings.items():
+                writer.writerow({'token': token, 'embedding': embedding})
+            # The known embeddings may be read from the output file itself, so it is replaced atomically.
+            with open(output_file + '.tmp', 'wb') as fp:
+                fp.write(contents.getvalue().encode('utf-8'))
+            os.replace(output_file + '.tmp', output_file)
+            size = os.path.getsize(output_file)
+            checkpoint = {'fingerprint': fingerprint, 'completed': [], 'known_size': size, 'size': size}
+            SearchIndexManager._save_checkpoint(checkpoint_file, checkpoint)
+        else:
+            with open(output_file, 'r+b') as fp:
+                fp.truncate(checkpoint['size'])
+            known_tokens = SearchIndexManager._read_embeddings(output_file, checkpoint['known_size'])
+            tokens = [token for token in tokens if token not in known_tokens]
+
+        completed = set(checkpoint['completed'])
+        starts = [start for start in range(0, len(tokens), batch_size) if start // batch_size not in completed]
+        semaphore = asyncio.Semaphore(max_concurrency)
+
+        async def embed_batch(start: int):
+            async with semaphore:
+                batch = tokens[start:start + batch_size]
+                data = (await self._embeddings_client.embed(
+                    input=batch,
                     dimensions=self._dimensions,
                     model=self._model
                 ))["data"]
-                for token, float_data in zip(sentence_tokens, emedding):
-                    writer.writerow({'token': token, 'embedding': json.dumps(float_data['embedding'])})
+                # Pair each vector with the token of the same batch and position.
+                data = sorted(data, key=lambda item: item['index'])
+                return start, batch, [item['embedding'] for item in data]
+
+        tasks = [asyncio.create_task(embed_batch(start)) for start in starts]
+        try:
+            with open(output_file, 'ab') as fp:
+                for next_batch in asyncio.as_completed(tasks):
+                    start, batch, embeddings = await next_batch
+                    rows = io.StringIO()
+                    writer = csv.DictWriter(rows, fieldnames=['token', 'embedding'])
+                    for token, embedding in zip(batch, embeddings):
+                        writer.writerow({'token': token, 'embedding': json.dumps(embedding)})
+                    fp.write(rows.getvalue().encode('utf-8'))
+                    fp.flush()
+                    os.fsync(fp.fileno())
+                    checkpoint['completed'].append(start // batch_size)
+                    checkpoint['size'] = fp.tell()
+                    SearchIndexManager._save_checkpoint(checkpoint_file, checkpoint)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        os.remove(checkpoint_file)
+
+    @staticmethod
+    def _read_embeddings(embeddings_file: str, size: Optional[int] = None) -> dict[str, str]:
+        """
+        Read the JSON encoded embeddings of the tokens from the csv file.
+
+        :param embeddings_file: The csv file with embeddings.
+        :param size: If set, only the first size bytes of the file are read.
+        :return: The dictionary from the token to its JSON encoded embedding.
+        """
+        with open(embeddings_file, 'rb') as fp:
+            contents = fp.read() if size is None else fp.read(size)
+        reader = csv.DictReader(io.StringIO(contents.decode('utf-8'), newline=''))
+        return {row['token']: row['embedding'] for row in reader}
+
+    @staticmethod
+    def _save_checkpoint(checkpoint_file: str, checkpoint: dict[str, Any]) -> None:
+        """Atomically replace the checkpoint file."""
+        with open(checkpoint_file + '.tmp', 'w') as fp:
+            json.dump(checkpoint, fp)
+        os.replace(checkpoint_file + '.tmp', checkpoint_file)
 
     async def close(self):
         """Close the closeable resources, associated with SearchIndexManager."""
         if self._client:
             await self._client.close()
+        if self._embedding_cache is not None:
+            await self._embedding_cache.close()
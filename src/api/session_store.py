@@ -0,0 +1,207 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+# See LICENSE file in the project root for full license information.
+import asyncio
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Any, Callable, Optional, TypeVar
+
+T = TypeVar('T')
+
+
+class SessionStore:
+    """
+    The store of the conversation histories, so the client sends only the new message.
+
+    The sessions are kept in the LRU dictionary in memory of the worker or, if disk_path is
+    set, in the SQLite database, shared by all workers on the same host. The session expires
+    ttl seconds after it was last used, and the least recently used sessions above max_sessions
+    are removed. Only the newest max_messages messages of each session are kept. The database
+    is read and written in a thread, so the waits for its lock do not block the event loop.
+
+    :param ttl: The time in seconds after the last use, when the session expires.
+    :param max_sessions: The maximal number of the sessions kept.
+    :param max_messages: The maximal number of messages kept in one session.
+    :param disk_path: The path to the SQLite file. If not set, the sessions are kept in memory.
+    """
+
+    def __init__(
+            self,
+            ttl: float = 3600,
+            max_sessions: int = 10000,
+            max_messages: int = 200,
+            disk_path: Optional[str] = None,
+        ) -> None:
+        """Constructor."""
+        if ttl <= 0 or max_sessions <= 0 or max_messages <= 0:
+            raise ValueError("The ttl, max_sessions and max_messages of the session store must be positive.")
+        self._ttl = ttl
+        self._max_sessions = max_sessions
+        self._max_messages = max_messages
+        self._disk_path = disk_path
+        self._sessions: OrderedDict[str, tuple[float, list[dict[str, str]]]] = OrderedDict()
+        # The connection is used by the threads, running the queries one at a time.
+        self._connection: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+        self._closed = False
+
+    async def create(self) -> str:
+        """
+        Start the new session.
+
+        :return: The session ID.
+        """
+        return await self._run(self._create)
+
+    async def get(self, session_id: str) -> Optional[list[dict[str, str]]]:
+        """
+        Return the messages of the session and extend its life.
+
+        :param session_id: The session ID.
+        :return: The messages with the role and content, or None if the session is unknown or has expired.
+        """
+        return await self._run(self._get, session_id)
+
+    async def append(self, session_id: str, messages: list[dict[str, str]]) -> bool:
+        """
+        Add the messages to the session.
+
+        :param session_id: The session ID.
+        :param messages: The messages with the role and content.
+        :return: False if the session is unknown or has expired.
+        """
+        return await self._run(self._append, session_id, messages)
+
+    async def delete(self, session_id: str) -> None:
+        """
+        Remove the session.
+
+        :param session_id: The session ID.
+        """
+        await self._run(self._delete, session_id)
+
+    async def _run(self, function: Callable[..., T], *args: Any) -> T:
+        """Call the function in a thread if the sessions are kept in the SQLite database."""
+        if self._disk_path is None:
+            return function(*args)
+
+        def locked() -> T:
+            with self._lock:
+                return function(*args)
+
+        return await asyncio.to_thread(locked)
+
+    def _create(self) -> str:
+        session_id = uuid.uuid4().hex
+        now = time.time()
+        connection = self._get_connection()
+        if connection is None:
+            self._evict(now)
+            self._sessions[session_id] = (now, [])
+            return session_id
+        connection.execute("DELETE FROM sessions WHERE updated < ?", (now - self._ttl,))
+        connection.execute(
+            "DELETE FROM sessions WHERE session_id IN "
+            "(SELECT session_id FROM sessions ORDER BY updated DESC LIMIT -1 OFFSET ?)", (self._max_sessions - 1,))
+        connection.execute("INSERT INTO sessions (session_id, updated) VALUES (?, ?)", (session_id, now))
+        return session_id
+
+    def _get(self, session_id: str) -> Optional[list[dict[str, str]]]:
+        now = time.time()
+        connection = self._get_connection()
+        if connection is None:
+            entry = self._sessions.get(session_id)
+            if entry is None or now - entry[0] >= self._ttl:
+                return None
+            self._sessions[session_id] = (now, entry[1])
+            self._sessions.move_to_end(session_id)
+            return list(entry[1])
+        if connection.execute(
+                "UPDATE sessions SET updated = ? WHERE session_id = ? AND updated >= ?",
+                (now, session_id, now - self._ttl)).rowcount == 0:
+            return None
+        rows = connection.execute(
+            "SELECT role, content FROM messages WHERE session_id = ? ORDER BY seq", (session_id,)).fetchall()
+        return [{'role': role, 'content': content} for role, content in rows]
+
+    def _append(self, session_id: str, messages: list[dict[str, str]]) -> bool:
+        now = time.time()
+        connection = self._get_connection()
+        if connection is None:
+            entry = self._sessions.get(session_id)
+            if entry is None or now - entry[0] >= self._ttl:
+                return False
+            history = entry[1] + [{'role': m['role'], 'content': m['content']} for m in messages]
+            self._sessions[session_id] = (now, history[-self._max_messages:])
+            self._sessions.move_to_end(session_id)
+            return True
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            if connection.execute(
+                    "UPDATE sessions SET updated = ? WHERE session_id = ? AND updated >= ?",
+                    (now, session_id, now - self._ttl)).rowcount == 0:
+                connection.execute("ROLLBACK")
+                return False
+            last_seq = connection.execute(
+                "SELECT COALESCE(MAX(seq), -1) FROM messages WHERE session_id = ?", (session_id,)).fetchone()[0]
+            connection.executemany(
+                "INSERT INTO messages (session_id, seq, role, content) VALUES (?, ?, ?, ?)",
+                [(session_id, last_seq + 1 + i, m['role'], m['content']) for i, m in enumerate(messages)])
+            connection.execute(
+                "DELETE FROM messages WHERE session_id = ? AND seq <= ?",
+                (session_id, last_seq + len(messages) - self._max_messages))
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        return True
+
+    def _delete(self, session_id: str) -> None:
+        connection = self._get_connection()
+        if connection is None:
+            self._sessions.pop(session_id, None)
+            return
+        connection.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+
+    def _evict(self, now: float) -> None:
+        """Remove the expired and the least recently used sessions above max_sessions from memory."""
+        while self._sessions:
+            session_id, (updated, _) = next(iter(self._sessions.items()))
+            if now - updated < self._ttl and len(self._sessions) < self._max_sessions:
+                break
+            del self._sessions[session_id]
+
+    def _get_connection(self) -> Optional[sqlite3.Connection]:
+        """Open the SQLite database if it was configured; called with the lock held."""
+        if self._disk_path is None:
+            return None
+        if self._closed:
+            raise RuntimeError("The session store is closed.")
+        if self._connection is None:
+            self._connection = sqlite3.connect(
+                self._disk_path, timeout=5, isolation_level=None, check_same_thread=False)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("PRAGMA synchronous=NORMAL")
+            # The messages of the removed sessions are removed with them.
+            self._connection.execute("PRAGMA foreign_keys=ON")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS sessions (session_id TEXT PRIMARY KEY, updated REAL NOT NULL)")
+            self._connection.execute("CREATE INDEX IF NOT EXISTS sessions_updated ON sessions (updated)")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS messages (session_id TEXT NOT NULL "
+                "REFERENCES sessions (session_id) ON DELETE CASCADE, seq INTEGER NOT NULL, "
+                "role TEXT NOT NULL, content TEXT NOT NULL, PRIMARY KEY (session_id, seq))")
+        return self._connection
+
+    async def close(self) -> None:
+        """Close the SQLite database."""
+        await self._run(self._close)
+
+    def _close(self) -> None:
+        self._closed = True
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
@@ -0,0 +1,102 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+# See LICENSE file in the project root for full license information.
+import asyncio
+import json
+from collections.abc import AsyncIterator
+from json.encoder import encode_basestring_ascii
+from typing import Optional
+
+
+def serialize_sse_event(data: dict) -> str:
+    """
+    Serialize the event as the server sent event frame.
+
+    :param data: The event data.
+    :return: The SSE frame.
+    """
+    return f"data: {json.dumps(data)}\n\n"
+
+
+def serialize_message_event(content: str) -> str:
+    """
+    Serialize the message delta event.
+
+    The frame is built from the template and only the content is JSON encoded, using
+    the C implementation of the string encoder. The result is the same as of
+    serialize_sse_event({"content": content, "type": "message"}), but several times faster.
+    :param content: The message delta.
+    :return: The SSE frame.
+    """
+    return 'data: {"content": ' + encode_basestring_ascii(content) + ', "type": "message"}\n\n'
+
+
+async def coalesce_deltas(
+        deltas: AsyncIterator[str],
+        window: float,
+        max_bytes: int = 1024) -> AsyncIterator[str]:
+    """
+    Join the consecutive deltas of the stream to reduce the number of frames.
+
+    The first delta is passed through immediately, so the time to first token is not affected.
+    The following deltas are buffered and the buffer is flushed when window seconds have passed
+    since the first buffered delta, or when the buffer reaches max_bytes, whichever comes first.
+    If window is not positive, the deltas are passed through as is.
+    :param deltas: The stream of deltas.
+    :param window: The maximal time in seconds the delta is kept in the buffer.
+    :param max_bytes: The size of the UTF-8 encoded buffer, at which it is flushed.
+    :return: The stream of joined deltas.
+    """
+    if window <= 0:
+        async for delta in deltas:
+            yield delta
+        return
+    loop = asyncio.get_running_loop()
+    iterator = deltas.__aiter__()
+    buffer: list[str] = []
+    buffered_bytes = 0
+    deadline: Optional[float] = None
+    is_first = True
+    next_delta: Optional[asyncio.Future] = None
+    try:
+        while True:
+            if next_delta is None:
+                # The pending read is not cancelled on the flush timeout, so no delta is lost.
+                next_delta = asyncio.ensure_future(iterator.__anext__())
+            timeout = None if deadline is None else max(0., deadline - loop.time())
+            done, _ = await asyncio.wait({next_delta}, timeout=timeout)
+            if not done:
+                yield ''.join(buffer)
+                buffer.clear()
+                buffered_bytes = 0
+                deadline = None
+                continue
+            read, next_delta = next_delta, None
+            try:
+                delta = read.result()
+            except StopAsyncIteration:
+                break
+            except Exception:
+                # Send the buffered deltas before reporting the error.
+                if buffer:
+                    yield ''.join(buffer)
+                    buffer.clear()
+                raise
+            if is_first:
+                is_first = False
+                yield delta
+                continue
+            buffer.append(delta)
+            buffered_bytes += len(delta.encode('utf-8'))
+            if buffered_bytes >= max_bytes:
+                yield ''.join(buffer)
+                buffer.clear()
+                buffered_bytes = 0
+                deadline = None
+            elif deadline is None:
+                deadline = loop.time() + window
+        if buffer:
+            yield ''.join(buffer)
+    finally:
+        if next_delta is not None:
+            next_delta.cancel()
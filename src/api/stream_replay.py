@@ -0,0 +1,321 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+# See LICENSE file in the project root for full license information.
+import asyncio
+import logging
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from collections.abc import AsyncIterator
+from typing import Any, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class _Stream:
+    """The events of one stream, kept in memory."""
+
+    __slots__ = ('created', 'events', 'finished', 'changed')
+
+    def __init__(self, created: float) -> None:
+        self.created = created
+        self.events: list[str] = []
+        self.finished = False
+        self.changed = asyncio.Event()
+
+    def notify(self) -> None:
+        """Wake up the readers, waiting for the new events."""
+        changed, self.changed = self.changed, asyncio.Event()
+        changed.set()
+
+
+class StreamReplayStore:
+    """
+    The bounded, time limited store of the events of the chat streams.
+
+    The events are kept for ttl seconds after the stream has started, so the client,
+    which has lost the connection, can read the events it has missed, while the stream
+    is still being generated or after it has finished. The events are kept in memory of
+    the worker, and the live stream is sent from there. If disk_path is set, the events
+    are also written to the SQLite database, shared by all workers on the same host, so
+    the stream can be resumed on any of them. The database is written in a thread, in one
+    transaction every poll_interval seconds, and the other workers check it for the new
+    events with the same interval.
+
+    :param ttl: The time in seconds the events of the stream are kept.
+    :param max_streams: The maximal number of the streams kept, the oldest streams are removed first.
+    :param disk_path: The path to the SQLite file. If not set, the events are kept only in memory.
+    :param poll_interval: The time in seconds between the writes to the SQLite database and
+                          between the checks of it for new events.
+    """
+
+    def __init__(
+            self,
+            ttl: float = 300,
+            max_streams: int = 1000,
+            disk_path: Optional[str] = None,
+            poll_interval: float = 0.05,
+        ) -> None:
+        """Constructor."""
+        if ttl <= 0 or max_streams <= 0:
+            raise ValueError("The ttl and max_streams of the stream replay store must be positive.")
+        self._ttl = ttl
+        self._max_streams = max_streams
+        self._disk_path = disk_path
+        self._poll_interval = poll_interval
+        self._streams: OrderedDict[str, _Stream] = OrderedDict()
+        self._pending_writes: list[tuple[str, tuple[Any, ...]]] = []
+        self._writer: Optional[asyncio.Task] = None
+        self._recording: set[asyncio.Task] = set()
+        # The connection is used by the threads, running the reads and the writes.
+        self._connection: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+        self._closed = False
+        self._closing = asyncio.Event()
+        self._disconnected = False
+
+    def create(self) -> str:
+        """
+        Register the new stream.
+
+        :return: The stream ID.
+        """
+        stream_id = uuid.uuid4().hex
+        created = time.time()
+        self._evict(created)
+        self._streams[stream_id] = _Stream(created)
+        self._write("DELETE FROM events WHERE created < ?", (created - self._ttl,))
+        self._write("DELETE FROM streams WHERE created < ?", (created - self._ttl,))
+        self._write(
+            "DELETE FROM streams WHERE stream_id IN "
+            "(SELECT stream_id FROM streams ORDER BY created DESC LIMIT -1 OFFSET ?)", (self._max_streams - 1,))
+        self._write("INSERT INTO streams (stream_id, created, finished) VALUES (?, ?, 0)", (stream_id, created))
+        return stream_id
+
+    def start(self, events: AsyncIterator[str]) -> str:
+        """
+        Register the new stream and record its events in the background,
+        so that they are generated to the end even if the client disconnects.
+
+        :param events: The events.
+        :return: The stream ID.
+        """
+        stream_id = self.create()
+        task = asyncio.create_task(self.record(stream_id, events))
+        self._recording.add(task)
+        task.add_done_callback(self._recording.discard)
+        return stream_id
+
+    def append(self, stream_id: str, event: str) -> Optional[int]:
+        """
+        Add the event to the stream.
+
+        :param stream_id: The stream ID.
+        :param event: The event.
+        :return: The event ID, or None if the stream has expired.
+        """
+        stream = self._streams.get(stream_id)
+        if stream is None:
+            return None
+        event_id = len(stream.events)
+        stream.events.append(event)
+        stream.notify()
+        self._write(
+            "INSERT OR REPLACE INTO events (stream_id, event_id, created, event) VALUES (?, ?, ?, ?)",
+            (stream_id, event_id, time.time(), event))
+        return event_id
+
+    def finish(self, stream_id: str) -> None:
+        """
+        Mark the stream as finished, so that the readers stop after the last event.
+
+        :param stream_id: The stream ID.
+        """
+        stream = self._streams.get(stream_id)
+        if stream is not None:
+            stream.finished = True
+            stream.notify()
+        self._write("UPDATE streams SET finished = 1 WHERE stream_id = ?", (stream_id,))
+
+    async def exists(self, stream_id: str) -> bool:
+        """
+        Return True if the stream is known and has not expired.
+
+        :param stream_id: The stream ID.
+        :return: True if the events of the stream can be read.
+        """
+        stream = self._streams.get(stream_id)
+        if stream is not None:
+            return time.time() - stream.created < self._ttl
+        if self._disk_path is None:
+            return False
+        finished, _ = await asyncio.to_thread(self._read_disk, stream_id, None)
+        return finished is not None
+
+    async def record(self, stream_id: str, events: AsyncIterator[str]) -> None:
+        """
+        Add all events of the stream and mark it as finished.
+
+        :param stream_id: The stream ID.
+        :param events: The events.
+        """
+        try:
+            async for event in events:
+                self.append(stream_id, event)
+        finally:
+            self.finish(stream_id)
+
+    async def read(self, stream_id: str, after: int = -1) -> AsyncIterator[tuple[int, str]]:
+        """
+        Read the events of the stream, waiting for the new ones until the stream is finished.
+
+        The stream, recorded by this worker, is read from memory, and the stream,
+        recorded by another worker, from the SQLite database.
+
+        :param stream_id: The stream ID.
+        :param after: The ID of the last event, received by the client. The events after it are returned.
+        :return: The iterator over the tuples of event ID and event.
+        """
+        stream = self._streams.get(stream_id)
+        if stream is not None:
+            next_event_id = after + 1
+            while True:
+                changed = stream.changed
+                while next_event_id < len(stream.events):
+                    yield next_event_id, stream.events[next_event_id]
+                    next_event_id += 1
+                if stream.finished:
+                    return
+                try:
+                    await asyncio.wait_for(changed.wait(), timeout=self._ttl)
+                except asyncio.TimeoutError:
+                    pass
+                if stream_id not in self._streams:
+                    return
+
+        if self._disk_path is None:
+            return
+        while True:
+            finished, rows = await asyncio.to_thread(self._read_disk, stream_id, after)
+            if finished is None:
+                return
+            for event_id, event in rows:
+                yield event_id, event
+                after = event_id
+            if finished:
+                return
+            await asyncio.sleep(self._poll_interval)
+
+    def _read_disk(self, stream_id: str, after: Optional[int]) -> tuple[Optional[bool], list[tuple[int, str]]]:
+        """
+        Read the state of the stream and its events after the given ID from the SQLite database.
+
+        :return: True if the stream is finished, False if it is running or None if it is absent,
+                 and the events, which are not read if after is None.
+        """
+        with self._lock:
+            connection = self._get_connection()
+            if connection is None:
+                return None, []
+            # The state is read before the events, so the events, written before the stream
+            # was finished, are not missed.
+            row = connection.execute(
+                "SELECT created, finished FROM streams WHERE stream_id = ?", (stream_id,)).fetchone()
+            if row is None or time.time() - row[0] >= self._ttl:
+                return None, []
+            if after is None:
+                return bool(row[1]), []
+            rows = connection.execute(
+                "SELECT event_id, event FROM events WHERE stream_id = ? AND event_id > ? ORDER BY event_id",
+                (stream_id, after)).fetchall()
+            return bool(row[1]), rows
+
+    def _write(self, statement: str, parameters: tuple[Any, ...]) -> None:
+        """Queue the statement for the SQLite database, if it was configured, and start the writer."""
+        if self._disk_path is None or self._closed:
+            return
+        self._pending_writes.append((statement, parameters))
+        if self._writer is None:
+            self._writer = asyncio.get_running_loop().create_task(self._write_pending())
+
+    async def _write_pending(self) -> None:
+        """Execute the queued statements in one transaction every poll_interval seconds, off the event loop."""
+        try:
+            while self._pending_writes:
+                try:
+                    # The pending statements are written without waiting when the store is closed.
+                    await asyncio.wait_for(self._closing.wait(), timeout=self._poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                statements, self._pending_writes = self._pending_writes, []
+                try:
+                    await asyncio.to_thread(self._execute, statements)
+                except sqlite3.Error as e:
+                    logger.error("Failed to record the chat streams to %s, error: %s", self._disk_path, str(e))
+        finally:
+            self._writer = None
+
+    def _execute(self, statements: list[tuple[str, tuple[Any, ...]]]) -> None:
+        """Execute the statements in one transaction."""
+        with self._lock:
+            connection = self._get_connection()
+            if connection is None:
+                return
+            connection.execute("BEGIN")
+            try:
+                for statement, parameters in statements:
+                    connection.execute(statement, parameters)
+                connection.execute("COMMIT")
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+
+    def _evict(self, now: float) -> None:
+        """Remove the expired streams and the oldest streams above max_streams from memory."""
+        while self._streams:
+            stream_id, stream = next(iter(self._streams.items()))
+            if now - stream.created < self._ttl and len(self._streams) < self._max_streams:
+                break
+            del self._streams[stream_id]
+            # Let the readers of the removed stream stop.
+            stream.notify()
+
+    def _get_connection(self) -> Optional[sqlite3.Connection]:
+        """Open the SQLite database if it was configured and has not been closed; called with the lock held."""
+        if self._disk_path is None or self._disconnected:
+            return None
+        if self._connection is None:
+            self._connection = sqlite3.connect(
+                self._disk_path, timeout=5, isolation_level=None, check_same_thread=False)
+            # The write ahead log lets the workers read while the other one writes.
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("PRAGMA synchronous=NORMAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS streams "
+                "(stream_id TEXT PRIMARY KEY, created REAL NOT NULL, finished INTEGER NOT NULL)")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS events (stream_id TEXT NOT NULL, event_id INTEGER NOT NULL, "
+                "created REAL NOT NULL, event TEXT NOT NULL, PRIMARY KEY (stream_id, event_id))")
+            self._connection.execute("CREATE INDEX IF NOT EXISTS events_created ON events (created)")
+        return self._connection
+
+    def _close_connection(self) -> None:
+        """Close the SQLite database."""
+        with self._lock:
+            self._disconnected = True
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+    async def close(self) -> None:
+        """Stop the recording of the running streams, write the pending events and close the SQLite database."""
+        for task in self._recording:
+            task.cancel()
+        await asyncio.gather(*self._recording, return_exceptions=True)
+        self._closed = True
+        self._closing.set()
+        if self._writer is not None:
+            await self._writer
+        await asyncio.to_thread(self._close_connection)
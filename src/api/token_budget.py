@@ -0,0 +1,270 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+# See LICENSE file in the project root for full license information.
+import asyncio
+import json
+import math
+import time
+from collections.abc import Mapping
+from typing import Any, Optional
+
+from azure.core.pipeline import PipelineRequest, PipelineResponse
+from azure.core.pipeline.policies import AsyncHTTPPolicy
+
+from .metrics import MODEL_BUDGET_REJECTED, MODEL_BUDGET_WAIT_SECONDS
+from .util import MESSAGE_OVERHEAD_TOKENS, estimate_tokens
+
+
+class TokenBudgetExceeded(Exception):
+    """
+    The request would exceed the tokens or requests per minute of the deployment.
+
+    :param retry_after: The number of seconds after which the request may be retried.
+    """
+
+    def __init__(self, retry_after: int) -> None:
+        super().__init__(
+            "The model deployment is over its tokens per minute quota, "
+            f"please retry in {retry_after} seconds.")
+        self.retry_after = retry_after
+
+
+def estimate_request_tokens(body: Mapping[str, Any], default_completion_tokens: int) -> int:
+    """
+    Estimate the number of tokens, which the request of the chat completion or the embeddings will use.
+
+    :param body: The JSON body of the request.
+    :param default_completion_tokens: The number of completion tokens if max_tokens is not set.
+    :return: The estimated number of prompt and completion tokens.
+    """
+    tokens = 0
+    for message in body.get('messages') or ():
+        tokens += MESSAGE_OVERHEAD_TOKENS
+        content = message.get('content')
+        if isinstance(content, str):
+            tokens += estimate_tokens(content)
+        elif isinstance(content, list):
+            tokens += sum(estimate_tokens(part.get('text') or '') for part in content if isinstance(part, dict))
+    inputs = body.get('input')
+    if isinstance(inputs, str):
+        inputs = [inputs]
+    for text in inputs or ():
+        if isinstance(text, str):
+            tokens += estimate_tokens(text)
+    if 'messages' in body:
+        tokens += body.get('max_tokens') or default_completion_tokens
+    return tokens
+
+
+class TokenBudget:
+    """
+    The token bucket of the tokens and requests per minute quota of one model deployment.
+
+    The tokens and the request are taken from the buckets before the request is sent, so
+    the buckets may go below zero, and the request waits until the buckets are refilled to
+    zero at the quota rate. The requests are paced in the order they arrive. The request,
+    which would wait longer than max_wait seconds, is rejected instead. The buckets follow
+    the rate limit headers, returned by the service, so that the quota, used by the other
+    workers or applications, is taken into account, and all requests wait after the service
+    has rejected one of them with the Retry-After header.
+
+    :param name: The name of the budget in the metrics.
+    :param tokens_per_minute: The tokens per minute quota, 0 if it is not limited.
+    :param requests_per_minute: The requests per minute quota, 0 if it is not limited.
+    :param max_wait: The maximal time in seconds the request waits for the quota.
+    :param default_completion_tokens: The number of completion tokens if the request does not set max_tokens.
+    """
+
+    def __init__(
+            self,
+            name: str,
+            tokens_per_minute: int = 0,
+            requests_per_minute: int = 0,
+            max_wait: float = 10.,
+            default_completion_tokens: int = 512,
+        ) -> None:
+        """Constructor."""
+        if tokens_per_minute < 0 or requests_per_minute < 0 or max_wait < 0:
+            raise ValueError("The tokens and requests per minute and max_wait must not be negative.")
+        self._name = name
+        self._tokens_per_minute = tokens_per_minute
+        self._requests_per_minute = requests_per_minute
+        self._max_wait = max_wait
+        self.default_completion_tokens = default_completion_tokens
+        self._tokens = float(tokens_per_minute)
+        self._requests = float(requests_per_minute)
+        self._updated = time.monotonic()
+        self._paused_until = 0.
+        self._remaining_tokens: Optional[int] = None
+        self._remaining_requests: Optional[int] = None
+        self._reported = 0.
+
+    @property
+    def max_wait(self) -> float:
+        """The maximal time in seconds the request waits for the quota."""
+        return self._max_wait
+
+    @property
+    def tokens(self) -> float:
+        """The number of tokens available now, negative if the requests are waiting."""
+        self._refill(time.monotonic())
+        return self._tokens
+
+    @property
+    def requests(self) -> float:
+        """The number of requests available now, negative if the requests are waiting."""
+        self._refill(time.monotonic())
+        return self._requests
+
+    @property
+    def reported_remaining(self) -> tuple[Optional[int], Optional[int]]:
+        """The remaining tokens and requests, reported by the service in the last minute, or None."""
+        if time.monotonic() - self._reported > 60:
+            return None, None
+        return self._remaining_tokens, self._remaining_requests
+
+    def wait_time(self, tokens: int) -> float:
+        """
+        Return the time in seconds, which the request would wait for the quota now.
+
+        :param tokens: The estimated number of tokens of the request.
+        :return: The time to wait, 0 if the request can be sent immediately.
+        """
+        now = time.monotonic()
+        self._refill(now)
+        # The request, larger than the quota, is sent when the bucket is full.
+        tokens = min(tokens, self._tokens_per_minute)
+        return max(
+            0.,
+            self._paused_until - now,
+            self._deficit(self._tokens - tokens, self._tokens_per_minute),
+            self._deficit(self._requests - 1, self._requests_per_minute),
+        )
+
+    async def acquire(self, tokens: int) -> None:
+        """
+        Take the tokens and one request from the buckets, waiting until they are available.
+
+        :param tokens: The estimated number of tokens of the request.
+        :raises: TokenBudgetExceeded if the request would wait longer than max_wait.
+        """
+        wait = self.wait_time(tokens)
+        tokens = min(tokens, self._tokens_per_minute)
+        if wait > self._max_wait:
+            MODEL_BUDGET_REJECTED.labels(self._name).inc()
+            raise TokenBudgetExceeded(max(1, math.ceil(wait)))
+        if self._tokens_per_minute:
+            self._tokens -= tokens
+        if self._requests_per_minute:
+            self._requests -= 1
+        MODEL_BUDGET_WAIT_SECONDS.labels(self._name).observe(wait)
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def update(
+            self,
+            remaining_tokens: Optional[int] = None,
+            remaining_requests: Optional[int] = None,
+            retry_after: Optional[float] = None,
+        ) -> None:
+        """
+        Adjust the buckets to the quota, reported by the service.
+
+        :param remaining_tokens: The remaining tokens in the current minute.
+        :param remaining_requests: The remaining requests in the current minute.
+        :param retry_after: The time in seconds, during which the service rejects the requests.
+        """
+        now = time.monotonic()
+        self._refill(now)
+        if remaining_tokens is not None or remaining_requests is not None:
+            self._remaining_tokens = remaining_tokens
+            self._remaining_requests = remaining_requests
+            self._reported = now
+        if remaining_tokens is not None and self._tokens_per_minute:
+            self._tokens = min(self._tokens, remaining_tokens)
+        if remaining_requests is not None and self._requests_per_minute:
+            self._requests = min(self._requests, remaining_requests)
+        if retry_after is not None:
+            self._paused_until = max(self._paused_until, now + retry_after)
+
+    def update_from_headers(self, headers: Mapping[str, str]) -> None:
+        """
+        Adjust the buckets to the rate limit headers of the response.
+
+        :param headers: The response headers.
+        """
+        retry_after = _parse_number(headers.get('retry-after-ms'))
+        if retry_after is not None:
+            retry_after /= 1000
+        else:
+            retry_after = _parse_number(headers.get('retry-after'))
+        remaining_tokens = _parse_number(headers.get('x-ratelimit-remaining-tokens'))
+        remaining_requests = _parse_number(headers.get('x-ratelimit-remaining-requests'))
+        self.update(
+            remaining_tokens=int(remaining_tokens) if remaining_tokens is not None else None,
+            remaining_requests=int(remaining_requests) if remaining_requests is not None else None,
+            retry_after=retry_after,
+        )
+
+    def _refill(self, now: float) -> None:
+        """Add the tokens and requests of the time passed since the last refill."""
+        elapsed = now - self._updated
+        self._updated = now
+        self._tokens = min(self._tokens_per_minute, self._tokens + elapsed * self._tokens_per_minute / 60)
+        self._requests = min(self._requests_per_minute, self._requests + elapsed * self._requests_per_minute / 60)
+
+    @staticmethod
+    def _deficit(level: float, per_minute: int) -> float:
+        """Return the time in seconds, in which the bucket is refilled from the level to zero."""
+        if not per_minute or level >= 0:
+            return 0.
+        return -level * 60 / per_minute
+
+
+def _parse_number(value: Optional[str]) -> Optional[float]:
+    """Parse the numeric header, returning None if it is absent or is not a number."""
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+
+class TokenBudgetPolicy(AsyncHTTPPolicy):
+    """
+    The pipeline policy, which paces the requests of the Azure AI Inference client by the token budget.
+
+    It is added to the per retry policies of the ChatCompletionsClient or the EmbeddingsClient, so
+    that each attempt is counted, and the rate limit headers of each response adjust the budget.
+
+    :param budget: The token budget of the deployment.
+    """
+
+    def __init__(self, budget: TokenBudget) -> None:
+        """Constructor."""
+        super().__init__()
+        self._budget = budget
+
+    async def send(self, request: PipelineRequest) -> PipelineResponse:
+        """
+        Wait for the budget, send the request and update the budget from the response.
+
+        :param request: The pipeline request.
+        :return: The pipeline response.
+        """
+        await self._budget.acquire(self._estimate(request))
+        response = await self.next.send(request)
+        self._budget.update_from_headers(response.http_response.headers)
+        return response
+
+    def _estimate(self, request: PipelineRequest) -> int:
+        """Estimate the tokens of the request from its JSON body."""
+        content = getattr(request.http_request, 'content', None)
+        try:
+            body: dict[str, Any] = json.loads(content) if content else {}
+        except (TypeError, ValueError):
+            return 0
+        if not isinstance(body, dict):
+            return 0
+        return estimate_request_tokens(body, self._budget.default_completion_tokens)
@@ -0,0 +1,161 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+# See LICENSE file in the project root for full license information.
+import asyncio
+import inspect
+import logging
+import time
+from typing import Any, Optional
+
+from azure.core.credentials import AccessToken
+
+from .metrics import TOKEN_ACQUISITION_SECONDS, TOKEN_CACHE_REQUESTS
+
+logger = logging.getLogger(__name__)
+
+# The modes of the token acquisition.
+BACKGROUND = 'background'
+BLOCKING = 'blocking'
+
+
+class CachingTokenCredential:
+    """
+    The async credential, which shares the tokens of the wrapped credential between the clients.
+
+    The tokens are cached by their scopes and tenant, and each of them is refreshed in the
+    background refresh_margin seconds before it expires, or in the middle of its lifetime
+    if it is shorter, so the requests do not wait for the identity endpoint. The concurrent
+    requests of the same token, which is not cached, wait for one acquisition. If the
+    background refresh fails, it is retried every retry_interval seconds while the cached
+    token is valid. The tokens with the claims of the authentication challenge are never cached.
+    The synchronous credentials, like those of azure.identity, are called in a thread,
+    so they do not block the event loop.
+
+    :param credential: The wrapped credential, synchronous or asynchronous.
+    :param refresh_margin: The number of seconds before the expiration to refresh the token.
+                           It should be above the 300 seconds, before which the Azure SDK
+                           clients ask for the new token.
+    :param retry_interval: The number of seconds between the retries of the failed refresh.
+    :param min_lifetime: The token, which expires sooner, is not returned from the cache.
+    """
+
+    def __init__(
+            self,
+            credential: Any,
+            refresh_margin: float = 600.,
+            retry_interval: float = 30.,
+            min_lifetime: float = 30.,
+        ) -> None:
+        """Constructor."""
+        if refresh_margin <= min_lifetime or retry_interval <= 0:
+            raise ValueError("The refresh_margin must be above min_lifetime and retry_interval must be positive.")
+        self._credential = credential
+        self._refresh_margin = refresh_margin
+        self._retry_interval = retry_interval
+        self._min_lifetime = min_lifetime
+        self._is_async = inspect.iscoroutinefunction(credential.get_token)
+        self._tokens: dict[tuple, AccessToken] = {}
+        self._requests: dict[tuple, tuple[tuple[str, ...], dict[str, Any]]] = {}
+        self._in_flight: dict[tuple, asyncio.Task] = {}
+        self._timers: dict[tuple, asyncio.TimerHandle] = {}
+
+    async def get_token(
+            self,
+            *scopes: str,
+            claims: Optional[str] = None,
+            tenant_id: Optional[str] = None,
+            **kwargs: Any,
+        ) -> AccessToken:
+        """
+        Return the cached token or acquire it.
+
+        :param scopes: The scopes of the token.
+        :param claims: The claims of the authentication challenge; the token is acquired anew.
+        :param tenant_id: The tenant of the token.
+        :return: The token.
+        """
+        if tenant_id is not None:
+            kwargs['tenant_id'] = tenant_id
+        if claims is not None:
+            TOKEN_CACHE_REQUESTS.labels('claims').inc()
+            return await self._call_credential(scopes, dict(kwargs, claims=claims), BLOCKING)
+        key = (scopes, tuple(sorted(kwargs.items())))
+        token = self._tokens.get(key)
+        lifetime = token.expires_on - time.time() if token is not None else 0.
+        if lifetime > self._min_lifetime:
+            TOKEN_CACHE_REQUESTS.labels('hit').inc()
+            if lifetime <= self._refresh_margin and key not in self._timers:
+                # The refresh, scheduled when the token was acquired, has failed.
+                self._refresh(key, BACKGROUND)
+            return token
+        TOKEN_CACHE_REQUESTS.labels('miss').inc()
+        self._requests[key] = (scopes, kwargs)
+        return await asyncio.shield(self._refresh(key, BLOCKING))
+
+    def _refresh(self, key: tuple, mode: str) -> asyncio.Task:
+        """Return the acquisition of the token, in flight or started now."""
+        task = self._in_flight.get(key)
+        if task is None:
+            task = asyncio.get_running_loop().create_task(self._acquire(key, mode))
+            self._in_flight[key] = task
+            task.add_done_callback(lambda done: self._on_acquired(key, done))
+        return task
+
+    async def _acquire(self, key: tuple, mode: str) -> AccessToken:
+        scopes, kwargs = self._requests[key]
+        token = await self._call_credential(scopes, kwargs, mode)
+        self._tokens[key] = token
+        return token
+
+    def _on_acquired(self, key: tuple, task: asyncio.Task) -> None:
+        """Schedule the next refresh of the token."""
+        self._in_flight.pop(key, None)
+        if task.cancelled():
+            return
+        token = self._tokens.get(key)
+        lifetime = token.expires_on - time.time() if token is not None else 0.
+        if task.exception() is not None:
+            logger.warning("Failed to refresh the access token: %s", task.exception())
+            if lifetime <= self._min_lifetime:
+                # The next request will try again.
+                return
+            delay = min(self._retry_interval, lifetime - self._min_lifetime)
+        else:
+            delay = max(lifetime - self._refresh_margin, lifetime / 2)
+        timer = self._timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+        self._timers[key] = asyncio.get_running_loop().call_later(delay, self._on_timer, key)
+
+    def _on_timer(self, key: tuple) -> None:
+        del self._timers[key]
+        self._refresh(key, BACKGROUND)
+
+    async def _call_credential(self, scopes: tuple[str, ...], kwargs: dict[str, Any], mode: str) -> AccessToken:
+        """Call the wrapped credential and measure the time."""
+        start = time.perf_counter()
+        try:
+            if self._is_async:
+                return await self._credential.get_token(*scopes, **kwargs)
+            return await asyncio.to_thread(self._credential.get_token, *scopes, **kwargs)
+        finally:
+            TOKEN_ACQUISITION_SECONDS.labels(mode).observe(time.perf_counter() - start)
+
+    async def close(self) -> None:
+        """Stop the refreshes and close the wrapped credential."""
+        for timer in self._timers.values():
+            timer.cancel()
+        self._timers.clear()
+        for task in list(self._in_flight.values()):
+            task.cancel()
+        close = getattr(self._credential, 'close', None)
+        if close is not None:
+            result = close()
+            if inspect.isawaitable(result):
+                await result
+
+    async def __aenter__(self) -> 'CachingTokenCredential':
+        return self
+
+    async def __aexit__(self, *args: Any) -> None:
+        await self.close()
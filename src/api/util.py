@@ -4,9 +4,15 @@
 from typing import Optional
 
 import logging
+import os
 import pydantic
+import re
 import sys
 
+# Words are split to the pieces of up to four characters, which is close to the
+# average token length of the BPE tokenizers on English text.
+_TOKEN_PATTERN = re.compile(r"\w{1,4}|[^\w\s]")
+
 
 def get_logger(name: str,
                log_level: int = logging.INFO,
@@ -41,10 +47,49 @@ def get_logger(name: str,
     return logger
 
 
+# The tokens, which the service adds to each chat message for the role and the separators.
+MESSAGE_OVERHEAD_TOKENS = 4
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Estimate the number of model tokens in the text without the tokenizer.
+
+    :param text: The text.
+    :returns: The approximate number of tokens.
+    """
+    return len(_TOKEN_PATTERN.findall(text))
+
+
+def get_default_embeddings_file() -> str:
+    """
+    Return the embeddings file, shipped with the application.
+
+    The binary file is preferred, if it was generated from the csv file.
+    :returns: The path to the embeddings file.
+    """
+    data_dir = os.path.join(os.path.dirname(__file__), 'data')
+    binary_file = os.path.join(data_dir, 'embeddings.npy')
+    if os.path.isfile(binary_file):
+        return binary_file
+    return os.path.join(data_dir, 'embeddings.csv')
+
+
 class Message(pydantic.BaseModel):
     content: str
     role: str = "user"
 
 
+class RetrievalOptions(pydantic.BaseModel):
+    """The retrieval policy options, overriding the defaults for one request."""
+    top_k: Optional[int] = pydantic.Field(default=None, ge=1, le=50)
+    min_score: Optional[float] = pydantic.Field(default=None, ge=-1, le=1)
+    score_gap: Optional[float] = pydantic.Field(default=None, ge=0)
+    mmr_lambda: Optional[float] = pydantic.Field(default=None, ge=0, le=1)
+
+
 class ChatRequest(pydantic.BaseModel):
     messages: list[Message]
+    retrieval: Optional[RetrievalOptions] = None
+    # If set, the messages are only the new messages of the conversation, kept on the server.
+    session_id: Optional[str] = None
@@ -2,11 +2,29 @@
 # Licensed under the MIT license.
 # See LICENSE file in the project root for full license information.
 import asyncio
+import glob
+import logging
 import multiprocessing
 import os
+import tempfile
 
 from azure.identity.aio import DefaultAzureCredential
 
+from api.util import get_logger
+
+# The workers write the Prometheus metrics to the files in this directory,
+# so that /metrics, served by any worker, aggregates the metrics of all workers.
+# It must be set before the application, importing prometheus_client, is loaded.
+if not os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+    os.environ['PROMETHEUS_MULTIPROC_DIR'] = tempfile.mkdtemp(prefix='prometheus_')
+
+logger = get_logger(
+    name="azureaiapp_gunicorn",
+    log_level=logging.INFO,
+    log_file_name=os.getenv("APP_LOG_FILE"),
+    log_to_console=True
+)
+
 
 async def create_index_maybe():
     """
@@ -16,36 +34,65 @@ async def create_index_maybe():
     called. This code ensures that the index is being populated only once.
     rag.create_index return True if the index was created, meaning that this
     docker node have started first and must populate index.
+    If AZURE_AI_SEARCH_SYNC is true, the existing index is synchronized with
+    the embeddings file: only the new chunks are uploaded and the chunks
+    absent in the file are deleted.
     """
+    from azure.core.credentials import AzureKeyCredential
+
     from api.search_index_manager import SearchIndexManager
+    from api.util import get_default_embeddings_file
     async with DefaultAzureCredential() as creds:
         endpoint = os.environ.get('AZURE_AI_SEARCH_ENDPOINT')
-        if endpoint:
+        # The local search backend loads the embeddings in each worker
+        # and does not need the Azure index.
+        search_credential = creds
+        if search_key := os.getenv('AZURE_AI_SEARCH_KEY'):
+            search_credential = AzureKeyCredential(search_key)
+        if endpoint and os.getenv('SEARCH_BACKEND', 'azure').lower() != 'local':
             search_mgr = SearchIndexManager(
                 endpoint=endpoint,
-                credential=creds,
+                credential=search_credential,
                 index_name=os.getenv('AZURE_AI_SEARCH_INDEX_NAME'),
                 dimensions=None,
                 model=os.getenv('AZURE_AI_EMBED_DEPLOYMENT_NAME'),
                 embeddings_client=None
             )
+            vector_index_dimensions = int(os.getenv('AZURE_AI_EMBED_DIMENSIONS'))
+            embeddings_path = get_default_embeddings_file()
             # If another application instance already have created the index,
             # do not upload the documents.
             if await search_mgr.create_index(
-              vector_index_dimensions=int(
-                  os.getenv('AZURE_AI_EMBED_DIMENSIONS'))):
-                embeddings_path = os.path.join(
-                    os.path.dirname(__file__), 'api', 'data', 'embeddings.csv')
+              vector_index_dimensions=vector_index_dimensions):
                 assert embeddings_path, f'File {embeddings_path} not found.'
-                await search_mgr.upload_documents(embeddings_path)
-                await search_mgr.close()
+                stats = await search_mgr.upload_documents(embeddings_path)
+                logger.info(
+                    "Uploaded %d documents in %d batches, %.1f documents per second.",
+                    stats['documents'], stats['batches'], stats['documents_per_second'])
+            elif os.getenv('AZURE_AI_SEARCH_SYNC', '').lower() == 'true':
+                await search_mgr.ensure_index_created(
+                    vector_index_dimensions=vector_index_dimensions)
+                stats = await search_mgr.sync_documents(embeddings_path)
+                logger.info(
+                    "Synchronized the index: %d documents uploaded, %d deleted, %d unchanged.",
+                    stats['uploaded'], stats['deleted'], stats['unchanged'])
+            await search_mgr.close()
 
 
 def on_starting(server):
     """Server hook, called just before the master process is initialized."""
+    # Remove the metrics, left by the previous run.
+    for metrics_file in glob.glob(os.path.join(os.environ['PROMETHEUS_MULTIPROC_DIR'], '*.db')):
+        os.remove(metrics_file)
     asyncio.get_event_loop().run_until_complete(create_index_maybe())
 
 
+def child_exit(server, worker):
+    """Server hook, called in the master process after the worker has exited."""
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
+
+
 max_requests = 1000
 max_requests_jitter = 50
 log_file = "-"
@@ -0,0 +1,143 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+# See LICENSE file in the project root for full license information.
+import asyncio
+import unittest
+
+from admission import AdmissionController, AdmissionRejected, AdmittedStreamingResponse, release_when_done
+
+
+class TestAdmissionController(unittest.IsolatedAsyncioTestCase):
+    """Tests for the admission control."""
+
+    async def test_queue_and_release(self):
+        """Test that the waiting request is admitted when the slot is released."""
+        controller = AdmissionController(max_concurrency=1, max_per_client=2, max_queue=1)
+        first = await controller.acquire("a")
+        waiting = asyncio.create_task(controller.acquire("a"))
+        await asyncio.sleep(0)
+        self.assertEqual(controller.queued, 1)
+        first.release()
+        first.release()
+        second = await waiting
+        self.assertEqual((controller.active, controller.queued), (1, 0))
+        second.release()
+        self.assertEqual(controller.active, 0)
+
+    async def test_queue_full(self):
+        """Test that the request is rejected at once if the queue is full."""
+        controller = AdmissionController(max_concurrency=1, max_per_client=1, max_queue=1)
+        admission = await controller.acquire("a")
+        waiting = asyncio.create_task(controller.acquire("b"))
+        await asyncio.sleep(0)
+        with self.assertRaises(AdmissionRejected) as cm:
+            await controller.acquire("c")
+        self.assertEqual(cm.exception.reason, 'queue_full')
+        self.assertGreaterEqual(cm.exception.retry_after, 1)
+        admission.release()
+        (await waiting).release()
+
+    async def test_timeout(self):
+        """Test that the request, waiting for too long, is rejected and removed from the queue."""
+        controller = AdmissionController(max_concurrency=1, queue_timeout=0.01)
+        admission = await controller.acquire("a")
+        with self.assertRaises(AdmissionRejected) as cm:
+            await controller.acquire("b")
+        self.assertEqual(cm.exception.reason, 'timeout')
+        self.assertEqual(controller.queued, 0)
+        admission.release()
+        self.assertEqual(controller.active, 0)
+
+    async def test_fair_turns(self):
+        """Test that the released slots are given to the clients in turn."""
+        controller = AdmissionController(max_concurrency=1, max_per_client=4, max_queue=10)
+        admission = await controller.acquire("a")
+        order = []
+
+        async def request(client_id):
+            admitted = await controller.acquire(client_id)
+            order.append(client_id)
+            await asyncio.sleep(0)
+            admitted.release()
+
+        tasks = [asyncio.create_task(request(client_id)) for client_id in ["a", "a", "a", "b", "c"]]
+        await asyncio.sleep(0)
+        admission.release()
+        await asyncio.gather(*tasks)
+        self.assertEqual(order, ["a", "b", "c", "a", "a"])
+
+    async def test_per_client_limit(self):
+        """Test that the client does not take more than max_per_client slots."""
+        controller = AdmissionController(max_concurrency=4, max_per_client=1, max_queue=4)
+        admission = await controller.acquire("a")
+        waiting = asyncio.create_task(controller.acquire("a"))
+        other = await controller.acquire("b")
+        await asyncio.sleep(0)
+        self.assertFalse(waiting.done())
+        admission.release()
+        (await waiting).release()
+        other.release()
+
+    async def test_client_id(self):
+        """Test that the client is identified by the address, added by the trusted proxy, not by the spoofed one."""
+        controller = AdmissionController(max_concurrency=4, max_per_client=1, max_queue=0)
+        spoofed = [controller.client_id(f"10.0.0.{i}, 203.0.113.7", "172.16.0.1") for i in range(3)]
+        self.assertEqual(spoofed, ["203.0.113.7"] * 3)
+        # The client, rotating the spoofed addresses, is limited as one client.
+        admission = await controller.acquire(spoofed[0])
+        with self.assertRaises(AdmissionRejected):
+            await controller.acquire(spoofed[1])
+        admission.release()
+        self.assertEqual(controller.client_id(None, "172.16.0.1"), "172.16.0.1")
+        self.assertEqual(controller.client_id(" , ", "172.16.0.1"), "172.16.0.1")
+        two_proxies = AdmissionController(trusted_proxies=2)
+        self.assertEqual(two_proxies.client_id("1.1.1.1, 203.0.113.7, 10.1.0.1", "172.16.0.1"), "203.0.113.7")
+        self.assertEqual(two_proxies.client_id("203.0.113.7", "172.16.0.1"), "203.0.113.7")
+        direct = AdmissionController(trusted_proxies=0)
+        self.assertEqual(direct.client_id("203.0.113.7", "172.16.0.1"), "172.16.0.1")
+
+    async def test_release_when_done(self):
+        """Test that the admission is released when the stream is closed."""
+        controller = AdmissionController(max_concurrency=1)
+
+        async def stream():
+            while True:
+                yield "event"
+
+        events = release_when_done(stream(), await controller.acquire("a"))
+        await events.__anext__()
+        self.assertEqual(controller.active, 1)
+        await events.aclose()
+        self.assertEqual(controller.active, 0)
+
+    async def test_cancel_before_stream(self):
+        """Test that the admission is released if the response is cancelled before its stream has started."""
+        controller = AdmissionController(max_concurrency=1)
+        started = []
+
+        async def stream():
+            started.append(True)
+            yield "event"
+
+        async def send(message):
+            # The client is slow to accept the response headers.
+            await asyncio.sleep(10)
+
+        async def receive():
+            await asyncio.sleep(10)
+            return {'type': 'http.disconnect'}
+
+        response = AdmittedStreamingResponse(stream(), await controller.acquire("a"))
+        scope = {'type': 'http', 'asgi': {'spec_version': '2.4'}}
+        sending = asyncio.create_task(response(scope, receive, send))
+        await asyncio.sleep(0)
+        self.assertEqual(controller.active, 1)
+        sending.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await sending
+        self.assertEqual(started, [])
+        self.assertEqual(controller.active, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,76 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+# See LICENSE file in the project root for full license information.
+import os
+import tempfile
+import unittest
+
+from chunker import MarkdownChunker
+from util import estimate_tokens
+
+DOCUMENT = """# TrailMaster X4 Tent
+
+## Features
+- Waterproof rain fly.
+- Sets up in five minutes.
+
+## Care
+Clean the tent with the mild soap. Dry the tent completely before packing it.
+Store it in the cool and dry place. Do not use the dryer.
+
+---
+"""
+
+
+class TestMarkdownChunker(unittest.TestCase):
+    """Tests for the markdown chunker."""
+
+    def test_small_sections_packed(self):
+        """Test that the small sections are packed into one chunk with their headings."""
+        chunks = MarkdownChunker(max_tokens=200).chunk_text(DOCUMENT)
+        self.assertEqual(len(chunks), 1)
+        self.assertTrue(chunks[0].startswith("# TrailMaster X4 Tent\n## Features\n- Waterproof rain fly."))
+        self.assertIn("## Care\nClean the tent", chunks[0])
+        self.assertNotIn("---", chunks[0])
+
+    def test_long_section_split(self):
+        """Test that the long section is split within the budget with the headings path and overlap."""
+        chunks = MarkdownChunker(max_tokens=32, overlap_tokens=12).chunk_text(DOCUMENT)
+        self.assertGreater(len(chunks), 2)
+        for chunk in chunks:
+            self.assertLessEqual(estimate_tokens(chunk), 32)
+            self.assertTrue(chunk.startswith("# TrailMaster X4 Tent"))
+        care_chunks = [chunk for chunk in chunks if "## Care" in chunk]
+        self.assertGreater(len(care_chunks), 1)
+        # The last sentence of one chunk is repeated at the start of the next one.
+        last_line = care_chunks[0].splitlines()[-1]
+        self.assertEqual(care_chunks[1].splitlines()[2], last_line)
+
+    def test_code_block_headings(self):
+        """Test that the comment in the code block is not treated as a heading."""
+        chunks = MarkdownChunker().chunk_text("# Setup\n```shell\n# install the tool\npip install tool\n```\n")
+        self.assertEqual(chunks, ["# Setup\n# install the tool\npip install tool"])
+
+    def test_code_block_verbatim(self):
+        """Test that the code lines keep their indentation and the short lines are not dropped."""
+        code = ("def pitch(tent):\n    if tent.poles:\n        tent.raise_poles(\n            height=2)\n"
+                "    return {\n    }")
+        chunks = MarkdownChunker().chunk_text(f"# Setup\nPitch the tent:\n```python\n{code}\n\n```\n")
+        self.assertEqual(chunks, [f"# Setup\nPitch the tent:\n{code}"])
+
+    def test_chunk_files(self):
+        """Test that the files are chunked in the process pool in the order of files."""
+        with tempfile.TemporaryDirectory() as d:
+            files = []
+            for i in range(3):
+                files.append(os.path.join(d, f"doc{i}.md"))
+                with open(files[-1], 'w') as fp:
+                    fp.write(f"# Document {i}\nThe text of document number {i}.\n")
+            chunker = MarkdownChunker()
+            self.assertEqual(chunker.chunk_files(files, max_workers=2), chunker.chunk_files(files, max_workers=1))
+            self.assertEqual(len(chunker.chunk_files(files)), 3)
+            self.assertTrue(chunker.chunk_files(files)[2].startswith("# Document 2"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,84 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+# See LICENSE file in the project root for full license information.
+import unittest
+from unittest.mock import AsyncMock, MagicMock
+
+from context_window import SUMMARY_PREFIX, ContextWindow, count_message_tokens
+
+
+def _conversation(turns):
+    messages = []
+    for i in range(turns):
+        messages.append({"role": "user", "content": f"question {i} " + "word " * 20})
+        messages.append({"role": "assistant", "content": f"answer {i} " + "word " * 20})
+    return messages
+
+
+def _summarizer():
+    client = MagicMock()
+    calls = []
+
+    async def complete(model, messages, max_tokens):
+        calls.append(messages[1]["content"])
+        response = MagicMock()
+        response.choices[0].message.content = f"summary {len(calls)}"
+        return response
+
+    client.complete = AsyncMock(side_effect=complete)
+    return client, calls
+
+
+class TestContextWindow(unittest.IsolatedAsyncioTestCase):
+    """Tests for the conversation window."""
+
+    async def test_short_conversation(self):
+        """Test that the conversation within the budget is sent as is."""
+        prompt = [{"role": "system", "content": "You are a helpful assistant"}]
+        messages = _conversation(2)
+        window = ContextWindow(max_tokens=1000)
+        self.assertEqual(await window.fit(prompt, messages), prompt + messages)
+
+    async def test_newest_messages(self):
+        """Test that only the newest messages are sent, and the last message is always sent."""
+        prompt = [{"role": "system", "content": "context " * 50}]
+        messages = _conversation(10)
+        budget = count_message_tokens(prompt) + count_message_tokens(messages[-3:])
+        window = ContextWindow(max_tokens=budget)
+        self.assertEqual(await window.fit(prompt, messages), prompt + messages[-3:])
+        window = ContextWindow(max_tokens=1)
+        self.assertEqual(await window.fit(prompt, messages), prompt + messages[-1:])
+
+    async def test_rolling_summary(self):
+        """Test that the older messages are summarized, starting from the cached summary."""
+        client, calls = _summarizer()
+        prompt = [{"role": "system", "content": "You are a helpful assistant"}]
+        messages = _conversation(10)
+        budget = count_message_tokens(prompt) + count_message_tokens(messages[-4:]) + 100 + 4
+        window = ContextWindow(max_tokens=budget, chat_client=client, model="model", summary_max_tokens=100)
+        fitted = await window.fit(prompt, messages[:-1])
+        self.assertEqual(fitted[1], {"role": "system", "content": SUMMARY_PREFIX + "summary 1"})
+        self.assertEqual(len(calls), 1)
+
+        # The next turn summarizes only the messages dropped since the previous one.
+        fitted = await window.fit(prompt, messages + [{"role": "user", "content": "next question"}])
+        self.assertEqual(fitted[1]["content"], SUMMARY_PREFIX + "summary 2")
+        self.assertIn("summary 1", calls[1])
+        self.assertNotIn("question 0", calls[1])
+
+        # The same history reuses the summary.
+        await window.fit(prompt, messages + [{"role": "user", "content": "next question"}])
+        self.assertEqual(len(calls), 2)
+
+    async def test_summary_error(self):
+        """Test that the older messages are dropped if the summary fails."""
+        client = MagicMock()
+        client.complete = AsyncMock(side_effect=RuntimeError("error"))
+        messages = _conversation(10)
+        window = ContextWindow(max_tokens=100, chat_client=client, model="model", summary_max_tokens=10)
+        fitted = await window.fit([], messages)
+        self.assertEqual(fitted, messages[-len(fitted):])
+
+
+if __name__ == "__main__":
+    unittest.main()
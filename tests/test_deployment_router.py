@@ -0,0 +1,156 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+# See LICENSE file in the project root for full license information.
+import asyncio
+import unittest
+from collections import Counter
+from types import SimpleNamespace
+from unittest.mock import patch
+
+from azure.core.exceptions import HttpResponseError, ServiceRequestError
+from deployment_router import ChatDeployment, DeploymentRouter
+from token_budget import TokenBudget, TokenBudgetExceeded
+
+
+def make_event(content):
+    return SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=content))])
+
+
+class FakeStream:
+    """The streamed chat completion, which raises the error, if it is given, after the deltas."""
+
+    def __init__(self, deltas, error=None, delay=0.):
+        self.deltas = deltas
+        self.error = error
+        self.delay = delay
+        self.closed = False
+
+    async def __aiter__(self):
+        await asyncio.sleep(self.delay)
+        yield make_event(None)
+        for delta in self.deltas:
+            yield make_event(delta)
+        if self.error is not None:
+            raise self.error
+
+    async def aclose(self):
+        self.closed = True
+
+
+class FakeClient:
+    """The chat client, which returns the streams or raises the errors in turn."""
+
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.models = []
+        self.closed = False
+
+    async def complete(self, model, messages, stream, **kwargs):
+        self.models.append(model)
+        response = self.responses.pop(0) if len(self.responses) > 1 else self.responses[0]
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    async def close(self):
+        self.closed = True
+
+
+def throttled():
+    error = HttpResponseError("Too many requests.")
+    error.status_code = 429
+    return error
+
+
+async def collect(router, messages=None):
+    return [delta async for delta in router.stream(messages or [{'role': 'user', 'content': 'hello'}])]
+
+
+class TestDeploymentRouter(unittest.IsolatedAsyncioTestCase):
+    """Tests for the routing of the chat completions."""
+
+    async def test_failover(self):
+        """Test that the throttled request is sent to the other deployment before the first token."""
+        first = ChatDeployment('first', FakeClient(throttled(), FakeStream(['a'])))
+        second = ChatDeployment('second', FakeClient(FakeStream(['b', 'c'])))
+        router = DeploymentRouter([first, second])
+        # The first of the available deployments is chosen.
+        with patch('deployment_router.random.choices', lambda population, weights: population[:1]):
+            self.assertEqual(await collect(router), ['b', 'c'])
+            self.assertEqual(await collect(router), ['a'])
+        self.assertEqual(first.client.models, ['first', 'first'])
+        self.assertEqual(second.client.models, ['second'])
+        self.assertEqual(first.stats()['throttled'], 1)
+        self.assertEqual(first.stats()['success'], 1)
+        self.assertEqual(second.stats()['success'], 1)
+        self.assertGreater(first.error_rate, 0)
+        self.assertEqual(second.error_rate, 0)
+
+    async def test_errors(self):
+        """Test that the errors after the first token and the bad requests are not sent to the other deployment."""
+        bad_request = HttpResponseError("The content was filtered.")
+        bad_request.status_code = 400
+        first = ChatDeployment('first', FakeClient(FakeStream(['a'], error=ServiceRequestError("Disconnected."))))
+        second = ChatDeployment('second', FakeClient(bad_request))
+        router = DeploymentRouter([first, second])
+        with patch('deployment_router.random.choices', lambda population, weights: population[:1]):
+            with self.assertRaises(ServiceRequestError):
+                await collect(router)
+            self.assertTrue(first.client.responses[0].closed)
+            # The bad request is not sent to the first deployment.
+            with self.assertRaises(HttpResponseError):
+                await collect(DeploymentRouter([second, first]))
+        self.assertEqual(first.client.models, ['first'])
+        self.assertEqual(second.client.models, ['second'])
+        self.assertEqual(router.stats()['first']['error'], 1)
+        self.assertEqual(router.stats()['second']['bad_request'], 1)
+        self.assertEqual(second.error_rate, 0)
+        # All deployments have failed before the first token.
+        router = DeploymentRouter([
+            ChatDeployment('first', FakeClient(ServiceRequestError("Refused."))),
+            ChatDeployment('second', FakeClient(throttled())),
+        ])
+        with self.assertRaises((ServiceRequestError, HttpResponseError)):
+            await collect(router)
+        self.assertEqual([len(deployment.client.models) for deployment in router.deployments], [1, 1])
+
+    async def test_choose_by_latency(self):
+        """Test that the faster deployment gets more requests."""
+        fast = ChatDeployment('fast', FakeClient(FakeStream(['a'])))
+        slow = ChatDeployment('slow', FakeClient(FakeStream(['b'], delay=0.02)))
+        router = DeploymentRouter([fast, slow])
+        for _ in range(10):
+            await collect(router)
+        fast.record_first_token(0.01)
+        slow.record_first_token(1.)
+        chosen = Counter(router.choose(100).label for _ in range(1000))
+        self.assertGreater(chosen['fast'], 900)
+        self.assertEqual(router.choose(100, exclude={'fast'}).label, 'slow')
+        self.assertIsNone(router.choose(100, exclude={'fast', 'slow'}))
+
+    async def test_choose_by_quota(self):
+        """Test that the deployments with the little remaining quota or the rejecting budget are avoided."""
+        budgets = [TokenBudget('test', max_wait=1.) for _ in range(3)]
+        deployments = [ChatDeployment(f'd{i}', FakeClient(FakeStream(['a'])), budgets[i]) for i in range(3)]
+        router = DeploymentRouter(deployments)
+        budgets[0].update(remaining_tokens=0)
+        budgets[1].update(retry_after=10.)
+        self.assertEqual({router.choose(1000).label for _ in range(100)}, {'d2'})
+        budgets[2].update(retry_after=5.)
+        # The budget of the deployment, which is the first to recover, rejects the request.
+        self.assertEqual(router.choose(1000, exclude={'d0'}).label, 'd2')
+        with self.assertRaises(TokenBudgetExceeded):
+            await budgets[2].acquire(1000)
+
+    def test_validation(self):
+        """Test that the wrong parameters are rejected."""
+        with self.assertRaises(ValueError):
+            DeploymentRouter([])
+        with self.assertRaises(ValueError):
+            DeploymentRouter([ChatDeployment('a', FakeClient()), ChatDeployment('a', FakeClient())])
+        with self.assertRaises(ValueError):
+            ChatDeployment('a', FakeClient(), smoothing=0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,57 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+# See LICENSE file in the project root for full license information.
+import asyncio
+import unittest
+from unittest.mock import AsyncMock
+
+from embedding_batcher import EmbeddingBatcher
+
+
+def _mock_embed(input, dimensions, model):
+    """Return the embedding equal to the length of each input."""
+    return {'data': [{'embedding': [float(len(text))], 'index': i} for i, text in enumerate(input)]}
+
+
+class TestEmbeddingBatcher(unittest.IsolatedAsyncioTestCase):
+    """Tests for the embedding coalescer."""
+
+    async def test_concurrent_inputs_batched(self):
+        """Test that the concurrent inputs are sent in one request."""
+        client = AsyncMock()
+        client.embed.side_effect = _mock_embed
+        batcher = EmbeddingBatcher(client, max_wait=0.01, max_batch_size=10)
+        results = await asyncio.gather(*[
+            batcher.embed(input=text, dimensions=1, model='model') for text in ['a', 'bb', 'ccc', 'bb']])
+        self.assertEqual([r['data'][0]['embedding'] for r in results], [[1.], [2.], [3.], [2.]])
+        client.embed.assert_called_once_with(input=['a', 'bb', 'ccc'], dimensions=1, model='model')
+        self.assertEqual(batcher.stats()['batch_sizes'], {3: 1})
+
+    async def test_max_batch_size(self):
+        """Test that the full batch is sent without waiting."""
+        client = AsyncMock()
+        client.embed.side_effect = _mock_embed
+        batcher = EmbeddingBatcher(client, max_wait=10, max_batch_size=2)
+        results = await asyncio.wait_for(asyncio.gather(
+            batcher.embed(input='a', model='model'),
+            batcher.embed(input='bb', model='model')), timeout=1)
+        self.assertEqual([r['data'][0]['embedding'] for r in results], [[1.], [2.]])
+        stats = batcher.stats()
+        self.assertEqual(stats['batches'], 1)
+        self.assertEqual(stats['mean_batch_size'], 2.)
+
+    async def test_list_input_and_errors(self):
+        """Test the pass through of the list inputs and the propagation of errors."""
+        client = AsyncMock()
+        client.embed.side_effect = _mock_embed
+        batcher = EmbeddingBatcher(client, max_wait=0.001)
+        result = await batcher.embed(input=['a', 'bb'], model='model')
+        self.assertEqual(len(result['data']), 2)
+        client.embed.side_effect = ValueError("Mock")
+        with self.assertRaisesRegex(ValueError, "Mock"):
+            await batcher.embed(input='a', model='model')
+        await batcher.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
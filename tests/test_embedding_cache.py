@@ -0,0 +1,93 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+# See LICENSE file in the project root for full license information.
+import asyncio
+import os
+import sqlite3
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from embedding_cache import EmbeddingCache, read_questions
+
+
+class TestEmbeddingCache(unittest.IsolatedAsyncioTestCase):
+    """Tests for the query embedding cache."""
+
+    def test_normalized_key(self):
+        """Test that the key depends on normalized text, model and dimensions."""
+        key = EmbeddingCache.make_key("What  tents\tdo you have?", "model", 100)
+        self.assertEqual(key, EmbeddingCache.make_key("what tents do you HAVE?", "model", 100))
+        self.assertNotEqual(key, EmbeddingCache.make_key("what tents do you have?", "model", 50))
+        self.assertNotEqual(key, EmbeddingCache.make_key("what tents do you have?", "other", 100))
+
+    async def test_lru_and_counters(self):
+        """Test the eviction of the least recently used entry."""
+        cache = EmbeddingCache(max_size=2)
+        cache.put("a", "model", None, [1.])
+        cache.put("b", "model", None, [2.])
+        self.assertEqual(await cache.get("a", "model", None), [1.])
+        cache.put("c", "model", None, [3.])
+        self.assertIsNone(await cache.get("b", "model", None))
+        self.assertEqual(await cache.get("c", "model", None), [3.])
+        self.assertEqual(await cache.get("c", "model", None, record_stats=False), [3.])
+        self.assertEqual(cache.stats(), {'memory_hits': 2, 'disk_hits': 0, 'misses': 1, 'size': 2})
+
+    async def test_ttl(self):
+        """Test that the expired entries are not returned."""
+        cache = EmbeddingCache(ttl=10)
+        with patch('embedding_cache.time.time', return_value=100.):
+            cache.put("a", "model", None, [1.])
+        with patch('embedding_cache.time.time', return_value=105.):
+            self.assertEqual(await cache.get("a", "model", None), [1.])
+        with patch('embedding_cache.time.time', return_value=111.):
+            self.assertIsNone(await cache.get("a", "model", None))
+
+    async def test_disk_shared(self):
+        """Test that the embedding, written by one cache, is read by the other one."""
+        with tempfile.TemporaryDirectory() as d:
+            disk_path = os.path.join(d, 'cache.sqlite')
+            writer = EmbeddingCache(disk_path=disk_path)
+            reader = EmbeddingCache(disk_path=disk_path)
+            writer.put("a", "model", 2, [0.5, 0.25])
+            # Closing waits for the background write.
+            await writer.close()
+            self.assertEqual(await reader.get("a", "model", 2), [0.5, 0.25])
+            self.assertEqual(await reader.get("a", "model", 2), [0.5, 0.25])
+            self.assertEqual(reader.stats()['disk_hits'], 1)
+            self.assertEqual(reader.stats()['memory_hits'], 1)
+            await reader.close()
+
+    async def test_locked_database(self):
+        """Test that the write, waiting for the lock of the database, does not block the event loop."""
+        with tempfile.TemporaryDirectory() as d:
+            disk_path = os.path.join(d, 'cache.sqlite')
+            cache = EmbeddingCache(disk_path=disk_path)
+            self.assertIsNone(await cache.get("a", "model", 2))
+            other = sqlite3.connect(disk_path, isolation_level=None)
+            other.execute("BEGIN IMMEDIATE")
+            cache.put("a", "model", 2, [0.5, 0.25])
+            # The embedding is served from memory while the write waits.
+            self.assertEqual(await cache.get("a", "model", 2), [0.5, 0.25])
+            await asyncio.sleep(0.1)
+            other.execute("COMMIT")
+            await cache.close()
+            row = other.execute("SELECT COUNT(*) FROM embeddings").fetchone()
+            self.assertEqual(row[0], 1)
+            other.close()
+
+    def test_read_questions(self):
+        """Test reading of the questions from the markdown and text files."""
+        with tempfile.TemporaryDirectory() as d:
+            md_file = os.path.join(d, 'questions.md')
+            with open(md_file, 'w') as fp:
+                fp.write("# Questions\n\nSome text.\n- First question?\n* Second question?\n")
+            txt_file = os.path.join(d, 'questions.txt')
+            with open(txt_file, 'w') as fp:
+                fp.write("First question?\n\nSecond question?\n")
+            self.assertEqual(read_questions(md_file), ["First question?", "Second question?"])
+            self.assertEqual(read_questions(txt_file), ["First question?", "Second question?"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,54 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+# See LICENSE file in the project root for full license information.
+import csv
+import json
+import os
+import tempfile
+import unittest
+
+import numpy as np
+from embeddings_file import convert_csv_to_binary, iter_embeddings, load_embeddings
+
+
+class TestEmbeddingsFile(unittest.TestCase):
+    """Tests for the binary embeddings format."""
+
+    TOKENS = ['TrailMaster X4 Tent', '', 'Ünïcode ✓ token']
+    VECTORS = [[0.5, -1.], [0., 0.], [1.25, 3.]]
+
+    def setUp(self) -> None:
+        self._dir = tempfile.TemporaryDirectory()
+        self.csv_file = os.path.join(self._dir.name, 'embeddings.csv')
+        with open(self.csv_file, 'w', newline='') as fp:
+            writer = csv.DictWriter(fp, fieldnames=['token', 'embedding'])
+            writer.writeheader()
+            for token, vector in zip(self.TOKENS, self.VECTORS):
+                writer.writerow({'token': token, 'embedding': json.dumps(vector)})
+        self.binary_file = os.path.join(self._dir.name, 'embeddings.npy')
+
+    def tearDown(self) -> None:
+        self._dir.cleanup()
+
+    def test_convert_and_load(self):
+        """Test that the binary file contains the same data as csv."""
+        self.assertEqual(convert_csv_to_binary(self.csv_file, self.binary_file), len(self.TOKENS))
+        for mmap in (True, False):
+            tokens, vectors = load_embeddings(self.binary_file, mmap=mmap)
+            self.assertEqual(list(tokens), self.TOKENS)
+            self.assertEqual(tokens[-1], self.TOKENS[-1])
+            self.assertEqual(vectors.dtype, np.float32)
+            np.testing.assert_array_equal(vectors, np.array(self.VECTORS, dtype=np.float32))
+        tokens, vectors = load_embeddings(self.binary_file)
+        self.assertIsInstance(vectors, np.memmap)
+        with self.assertRaises(IndexError):
+            tokens[len(self.TOKENS)]
+
+    def test_iter_embeddings(self):
+        """Test that both formats are iterated in the same way."""
+        convert_csv_to_binary(self.csv_file, self.binary_file)
+        self.assertEqual(list(iter_embeddings(self.csv_file)), list(iter_embeddings(self.binary_file)))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,59 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+# See LICENSE file in the project root for full license information.
+import unittest
+
+from aiohttp import web
+from azure.core.pipeline.transport import HttpRequest
+from http_pool import HttpPool
+from metrics import HTTP_POOL_REQUESTS
+
+
+class TestHttpPool(unittest.IsolatedAsyncioTestCase):
+    """Tests for the shared HTTP connection pool."""
+
+    async def asyncSetUp(self):
+        app = web.Application()
+        app.router.add_route('*', '/{tail:.*}', lambda request: web.Response(text="ok"))
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, '127.0.0.1', 0)
+        await site.start()
+        self.url = f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}"
+
+    async def asyncTearDown(self):
+        await self.runner.cleanup()
+
+    async def test_warm_up_and_reuse(self):
+        """Test that the warmed up connections are reused by the requests of the transport."""
+        pool = HttpPool()
+        opened = await pool.warm_up([f"{self.url}/chat", f"{self.url}/embeddings", "not a url"], connections=3)
+        self.assertEqual(opened, 3)
+        self.assertEqual(pool.stats(), {'in_use': 0, 'idle': 3})
+        reused = HTTP_POOL_REQUESTS.labels('reused')._value.get()
+        async with pool.transport as transport:
+            response = await transport.send(HttpRequest("GET", f"{self.url}/chat"))
+            await response.load_body()
+            self.assertEqual(response.text(), "ok")
+        self.assertEqual(HTTP_POOL_REQUESTS.labels('reused')._value.get(), reused + 1)
+        # The transport does not own the session, so the connections stay open.
+        self.assertEqual(pool.stats(), {'in_use': 0, 'idle': 3})
+        await pool.close()
+        self.assertEqual(pool.stats(), {'in_use': 0, 'idle': 0})
+
+    async def test_warm_up_failure(self):
+        """Test that the hosts, which are not available, are skipped."""
+        pool = HttpPool(connect_timeout=1.)
+        self.assertEqual(await pool.warm_up(["http://127.0.0.1:1/"]), 0)
+        await pool.close()
+
+    def test_validation(self):
+        """Test that the wrong limits and timeouts are rejected."""
+        with self.assertRaises(ValueError):
+            HttpPool(limit=-1)
+        with self.assertRaises(ValueError):
+            HttpPool(connect_timeout=0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,43 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+# See LICENSE file in the project root for full license information.
+import unittest
+
+from keyword_index import KeywordIndex, reciprocal_rank_fusion
+
+TOKENS = [
+    "TrailMaster X4 Tent, price $250. The tent is easy to set up.",
+    "Alpine Explorer Tent, price $350. The tent is light.",
+    "CozyNights Sleeping Bag keeps you warm.",
+    "Is the tent waterproof? Yes, the TrailMaster X4 tent is water resistant.",
+] + [f"Review {i}: the camping trip was great and the gear was fine." for i in range(100)]
+
+
+class TestKeywordIndex(unittest.TestCase):
+    """Tests for the BM25 keyword index."""
+
+    def test_search(self):
+        """Test that the chunks, naming the product, are found first."""
+        index = KeywordIndex(TOKENS)
+        result = index.search("What is the price of the TrailMaster X4 tent?", top_k=2)
+        self.assertEqual([token for token, _ in result.results], [TOKENS[0], TOKENS[3]])
+        self.assertGreater(result.results[0][1], result.results[1][1])
+        self.assertEqual((result.rare_words, result.rare_words_in_best), (3, 3))
+
+    def test_rare_words(self):
+        """Test that the best chunk is reported if it lacks the rare words of the question."""
+        index = KeywordIndex(TOKENS)
+        result = index.search("Compare the TrailMaster X4 and the Alpine Explorer")
+        self.assertEqual((result.rare_words, result.rare_words_in_best), (5, 2))
+        self.assertEqual(index.search("unknown words").results, [])
+        self.assertEqual(index.search("great camping").rare_words, 0)
+
+    def test_reciprocal_rank_fusion(self):
+        """Test that the chunks, ranked high by both rankings, come first."""
+        fused = reciprocal_rank_fusion([[("a", 0.9), ("b", 0.8), ("c", 0.7)], [("c", 10.), ("a", 5.)]], k=1)
+        self.assertEqual([token for token, _ in fused], ["a", "c", "b"])
+        self.assertAlmostEqual(fused[0][1], 1 / 2 + 1 / 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
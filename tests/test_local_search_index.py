@@ -0,0 +1,70 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+# See LICENSE file in the project root for full license information.
+import csv
+import json
+import os
+import tempfile
+import unittest
+
+import numpy as np
+from local_search_index import LocalSearchIndex
+
+
+class TestLocalSearchIndex(unittest.TestCase):
+    """Tests for the in-process vector index."""
+
+    TOKENS = ['north', 'east', 'south', 'north-east']
+    VECTORS = [[0., 2.], [3., 0.], [0., -1.], [1., 1.]]
+
+    def test_search_order_and_scores(self):
+        """Test that the results are ordered by cosine similarity."""
+        index = LocalSearchIndex(self.TOKENS, np.array(self.VECTORS))
+        results = index.search([0., 10.], top_k=2)
+        self.assertEqual([token for token, _ in results], ['north', 'north-east'])
+        self.assertAlmostEqual(results[0][1], 1.0, places=6)
+        self.assertAlmostEqual(results[1][1], np.sqrt(0.5), places=6)
+
+    def test_search_batch(self):
+        """Test that the batch search returns one result per query."""
+        index = LocalSearchIndex(self.TOKENS, np.array(self.VECTORS))
+        results = index.search_batch([[1., 0.], [0., -5.]], top_k=10)
+        self.assertEqual(len(results), 2)
+        self.assertEqual(len(results[0]), len(self.TOKENS))
+        self.assertEqual(results[0][0][0], 'east')
+        self.assertEqual(results[1][0][0], 'south')
+
+    def test_score(self):
+        """Test that the given chunks are scored in their order and the unknown ones are skipped."""
+        index = LocalSearchIndex(self.TOKENS, np.array(self.VECTORS))
+        results, vectors = index.score([0., 10.], ['north-east', 'unknown', 'south'])
+        self.assertEqual([token for token, _ in results], ['north-east', 'south'])
+        self.assertAlmostEqual(results[0][1], np.sqrt(0.5), places=6)
+        self.assertAlmostEqual(results[1][1], -1.0, places=6)
+        np.testing.assert_array_equal(vectors, [[1., 1.], [0., -1.]])
+
+    def test_wrong_dimensions(self):
+        """Test that the mismatch of dimensions raises the exception."""
+        index = LocalSearchIndex(self.TOKENS, np.array(self.VECTORS))
+        with self.assertRaisesRegex(ValueError, "The query vectors must have 2 dimensions."):
+            index.search([1., 2., 3.])
+        with self.assertRaisesRegex(ValueError, "The number of tokens .+"):
+            LocalSearchIndex(self.TOKENS[:2], np.array(self.VECTORS))
+
+    def test_from_file(self):
+        """Test loading of the embeddings file."""
+        with tempfile.TemporaryDirectory() as d:
+            embeddings_file = os.path.join(d, 'embeddings.csv')
+            with open(embeddings_file, 'w', newline='') as fp:
+                writer = csv.DictWriter(fp, fieldnames=['token', 'embedding'])
+                writer.writeheader()
+                for token, vector in zip(self.TOKENS, self.VECTORS):
+                    writer.writerow({'token': token, 'embedding': json.dumps(vector)})
+            index = LocalSearchIndex.from_file(embeddings_file)
+        self.assertEqual(len(index), len(self.TOKENS))
+        self.assertEqual(index.dimensions, 2)
+        self.assertEqual(index.search([1., 0.], top_k=1)[0][0], 'east')
+
+
+if __name__ == "__main__":
+    unittest.main()
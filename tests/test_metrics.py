@@ -0,0 +1,46 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+# See LICENSE file in the project root for full license information.
+import unittest
+
+from metrics import PHASE_SECONDS, STREAMS_IN_FLIGHT, VECTOR_SEARCH, render_metrics, track_stream
+
+
+class TestMetrics(unittest.IsolatedAsyncioTestCase):
+    """Tests for the Prometheus metrics."""
+
+    async def test_track_stream(self):
+        """Test that the stream is counted as in flight until it is exhausted."""
+        async def stream():
+            yield 'a'
+            yield 'b'
+
+        in_flight = []
+        async for _ in track_stream(stream()):
+            in_flight.append(STREAMS_IN_FLIGHT._value.get())
+        self.assertEqual(in_flight, [1, 1])
+        self.assertEqual(STREAMS_IN_FLIGHT._value.get(), 0)
+
+    async def test_track_stream_closed(self):
+        """Test that the stream, closed by the disconnected client, is not counted."""
+        async def stream():
+            while True:
+                yield 'a'
+
+        tracked = track_stream(stream())
+        await tracked.__anext__()
+        self.assertEqual(STREAMS_IN_FLIGHT._value.get(), 1)
+        await tracked.aclose()
+        self.assertEqual(STREAMS_IN_FLIGHT._value.get(), 0)
+
+    def test_render_metrics(self):
+        """Test that the phase histograms are rendered in the Prometheus format."""
+        PHASE_SECONDS.labels(VECTOR_SEARCH).observe(0.02)
+        content, content_type = render_metrics()
+        self.assertTrue(content_type.startswith('text/plain'))
+        self.assertIn(b'chat_phase_seconds_bucket{le="0.025",phase="vector_search"}', content)
+        self.assertIn(b'chat_streams_in_flight', content)
+
+
+if __name__ == "__main__":
+    unittest.main()
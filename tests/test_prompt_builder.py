@@ -0,0 +1,41 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+# See LICENSE file in the project root for full license information.
+import unittest
+
+from azure.ai.inference.prompts import PromptTemplate
+from prompt_builder import CONTEXT_SEPARATOR, RAG_PROMPT, SYSTEM_PROMPT, PromptBuilder
+from util import estimate_tokens
+
+
+class TestPromptBuilder(unittest.TestCase):
+    """Tests for the prompt builder."""
+
+    def test_same_prompt_as_template(self):
+        """Test that the compiled templates produce the same messages as the templates."""
+        builder = PromptBuilder()
+        context = "The TrailMaster X4 tent costs $250."
+        self.assertEqual(
+            builder.build([context]),
+            (PromptTemplate.from_string(RAG_PROMPT).create_messages(data=dict(context=context)), context))
+        self.assertEqual(builder.build([]), (PromptTemplate.from_string(SYSTEM_PROMPT).create_messages(), ""))
+
+    def test_budget(self):
+        """Test that the chunks are added in the score order while they fit into the budget."""
+        chunks = ["alpha " * 100, "beta " * 300, "gamma " * 50, "delta " * 100]
+        budget = estimate_tokens(chunks[0] + CONTEXT_SEPARATOR) + estimate_tokens(chunks[2] + CONTEXT_SEPARATOR)
+        builder = PromptBuilder(max_context_tokens=budget)
+        self.assertEqual(builder.pack_context(chunks), [chunks[0], chunks[2]])
+        self.assertEqual(PromptBuilder(max_context_tokens=0).pack_context(chunks), chunks)
+
+    def test_duplicates(self):
+        """Test that the duplicates and the near duplicates are skipped."""
+        text = " ".join(f"word{i}" for i in range(100))
+        near_duplicate = text.replace("word50", "other")
+        different = " ".join(f"term{i}" for i in range(100))
+        builder = PromptBuilder(max_context_tokens=0, duplicate_threshold=0.8)
+        self.assertEqual(builder.pack_context([text, near_duplicate, text, different, ""]), [text, different])
+
+
+if __name__ == "__main__":
+    unittest.main()
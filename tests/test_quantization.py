@@ -0,0 +1,82 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+# See LICENSE file in the project root for full license information.
+import os
+import tempfile
+import unittest
+
+import numpy as np
+from embeddings_file import write_binary
+from local_search_index import LocalSearchIndex
+from quantization import INT8, PQ, QuantizedVectors, default_subvectors, evaluate
+
+
+def make_vectors(count=2000, dimensions=32, seed=0):
+    """Return the clustered random vectors, similar to the embeddings of related chunks."""
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(50, dimensions))
+    return (centers[rng.integers(0, 50, count)] + 0.3 * rng.normal(size=(count, dimensions))).astype(np.float32)
+
+
+class TestQuantization(unittest.TestCase):
+    """Tests for the quantized codes of the embeddings."""
+
+    def test_int8(self):
+        """Test that the int8 scores are close to the cosine similarity."""
+        vectors = make_vectors()
+        quantized = QuantizedVectors.build(vectors, INT8)
+        self.assertEqual(quantized.codes.shape, vectors.shape)
+        self.assertEqual(quantized.codes.dtype, np.int8)
+        normalized = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+        np.testing.assert_allclose(quantized.scores(vectors[:5]), normalized[:5] @ normalized.T, atol=0.02)
+
+    def test_pq(self):
+        """Test that the product quantization compresses the vectors and keeps the nearest ones."""
+        vectors = make_vectors()
+        quantized = QuantizedVectors.build(vectors, PQ, subvectors=8)
+        self.assertEqual(quantized.codes.shape, (len(vectors), 8))
+        self.assertEqual(quantized.codes.nbytes, vectors.nbytes / 16)
+        metrics = evaluate(vectors, quantized, vectors[:50] + 0.1, top_k=5, rescore_factor=10)
+        self.assertGreaterEqual(metrics['rescored_recall'], metrics['recall'])
+        self.assertGreater(metrics['rescored_recall'], 0.9)
+        with self.assertRaises(ValueError):
+            QuantizedVectors.build(vectors, PQ, subvectors=5)
+
+    def test_default_subvectors(self):
+        """Test that the groups have at least 16 dimensions."""
+        self.assertEqual(default_subvectors(1536), 96)
+        self.assertEqual(default_subvectors(100), 5)
+        self.assertEqual(default_subvectors(8), 1)
+
+    def test_quantized_search(self):
+        """Test that the search on the codes returns the exact scores of the rescored chunks."""
+        vectors = make_vectors()
+        tokens = [f"chunk {i}" for i in range(len(vectors))]
+        exact = LocalSearchIndex(tokens, vectors)
+        quantized = LocalSearchIndex(tokens, vectors, quantized=QuantizedVectors.build(vectors, INT8))
+        self.assertLess(quantized.nbytes, exact.nbytes)
+        for query in vectors[:10] + 0.05:
+            expected = exact.search(query, top_k=3)
+            results = quantized.search(query, top_k=3)
+            self.assertEqual([token for token, _ in results], [token for token, _ in expected])
+            np.testing.assert_allclose([s for _, s in results], [s for _, s in expected], rtol=1e-5)
+
+    def test_save_and_load(self):
+        """Test that the codes, written next to the embeddings file, are loaded instead of being built."""
+        vectors = make_vectors(count=300)
+        tokens = [f"chunk {i}" for i in range(len(vectors))]
+        with tempfile.TemporaryDirectory() as d:
+            embeddings_file = os.path.join(d, 'embeddings.npy')
+            write_binary(embeddings_file, tokens, vectors)
+            self.assertIsNone(QuantizedVectors.load(embeddings_file, PQ))
+            QuantizedVectors.build(vectors, PQ, subvectors=4).save(embeddings_file)
+            self.assertTrue(os.path.isfile(os.path.join(d, 'embeddings.pq.npy')))
+            loaded = QuantizedVectors.load(embeddings_file, PQ, mmap=False)
+            self.assertEqual(loaded.codes.shape, (len(vectors), 4))
+            index = LocalSearchIndex.from_file(embeddings_file, mmap=False, quantization=PQ)
+            self.assertEqual(index.nbytes, loaded.nbytes)
+            self.assertEqual(index.search(vectors[7], top_k=1)[0][0], "chunk 7")
+
+
+if __name__ == "__main__":
+    unittest.main()
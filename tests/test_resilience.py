@@ -0,0 +1,156 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+# See LICENSE file in the project root for full license information.
+import asyncio
+import time
+import unittest
+
+from resilience import CLOSED, HALF_OPEN, OPEN, CircuitBreaker, CircuitOpenError, ResilientCaller
+
+
+class SlowService:
+    """The service, which answers after the given delays of the successive calls."""
+
+    def __init__(self, *delays):
+        self.delays = list(delays)
+        self.calls = 0
+        self.cancelled = 0
+
+    async def call(self):
+        self.calls += 1
+        number = self.calls
+        try:
+            await asyncio.sleep(self.delays[number - 1] if number <= len(self.delays) else 0.)
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+        return number
+
+    async def fail(self):
+        self.calls += 1
+        raise RuntimeError("The service is not available.")
+
+
+class TestCircuitBreaker(unittest.TestCase):
+    """Tests for the circuit breaker."""
+
+    def test_open_and_close(self):
+        """Test that the breaker opens after the failures, lets one probe through and closes on success."""
+        breaker = CircuitBreaker('test', failure_threshold=2, reset_timeout=0.01)
+        self.assertTrue(breaker.allow())
+        breaker.record(False)
+        breaker.record(True)
+        breaker.record(False)
+        self.assertEqual(breaker.state, CLOSED)
+        breaker.record(False)
+        self.assertEqual(breaker.state, OPEN)
+        self.assertFalse(breaker.allow())
+        time.sleep(0.02)
+        self.assertEqual(breaker.state, HALF_OPEN)
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+        # The failed probe opens the breaker again.
+        breaker.record(False)
+        self.assertEqual(breaker.state, OPEN)
+        time.sleep(0.02)
+        self.assertTrue(breaker.allow())
+        breaker.record(None)
+        self.assertTrue(breaker.allow())
+        breaker.record(True)
+        self.assertEqual(breaker.state, CLOSED)
+
+    def test_validation(self):
+        """Test that the wrong parameters are rejected."""
+        with self.assertRaises(ValueError):
+            CircuitBreaker('test', failure_threshold=0)
+        with self.assertRaises(ValueError):
+            ResilientCaller(CircuitBreaker('test'), hedge_percentile=100)
+        with self.assertRaises(ValueError):
+            ResilientCaller(CircuitBreaker('test'), min_hedge_delay=1., max_hedge_delay=0.5)
+
+
+class TestResilientCaller(unittest.IsolatedAsyncioTestCase):
+    """Tests for the hedged calls."""
+
+    async def test_hedge(self):
+        """Test that the slow call is hedged and the first answer is returned."""
+        caller = ResilientCaller(CircuitBreaker('test'), max_hedge_delay=0.05)
+        service = SlowService(1., 0.)
+        self.assertEqual(await caller.call(service.call), 2)
+        self.assertEqual(service.calls, 2)
+        # The slower call is cancelled.
+        await asyncio.sleep(0)
+        self.assertEqual(service.cancelled, 1)
+        # The fast call is not hedged.
+        service = SlowService(0.)
+        self.assertEqual(await caller.call(service.call), 1)
+        self.assertEqual(service.calls, 1)
+
+    async def test_adaptive_delay(self):
+        """Test that the delay follows the percentile of the recent latencies."""
+        caller = ResilientCaller(
+            CircuitBreaker('test'), hedge_percentile=50, min_hedge_delay=0.001, max_hedge_delay=1., min_samples=4)
+        self.assertEqual(caller.hedge_delay(), 1.)
+        for _ in range(4):
+            await caller.call(SlowService(0.01).call)
+        self.assertGreaterEqual(caller.hedge_delay(), 0.01)
+        self.assertLess(caller.hedge_delay(), 0.1)
+        self.assertIsNone(ResilientCaller(CircuitBreaker('test'), hedge_percentile=0).hedge_delay())
+
+    async def test_hedge_budget(self):
+        """Test that at most the hedge_burst hedges are made, refilled by hedge_ratio of the calls."""
+        caller = ResilientCaller(
+            CircuitBreaker('test'), min_hedge_delay=0.01, max_hedge_delay=0.01, hedge_ratio=0.5, hedge_burst=2)
+        hedged = 0
+        for _ in range(6):
+            service = SlowService(0.05, 0.)
+            await caller.call(service.call)
+            hedged += service.calls - 1
+        # The two hedges of the burst and one hedge for each two calls after them.
+        self.assertEqual(hedged, 4)
+
+    async def test_failures(self):
+        """Test that the failures and the timeouts open the breaker and the calls are not made then."""
+        caller = ResilientCaller(
+            CircuitBreaker('test', failure_threshold=2), hedge_percentile=0, timeout=0.05, excluded=(KeyError,))
+        service = SlowService(1.)
+        with self.assertRaises(asyncio.TimeoutError):
+            await caller.call(service.call)
+        self.assertEqual(service.cancelled, 1)
+
+        async def budget_exceeded():
+            raise KeyError()
+
+        with self.assertRaises(KeyError):
+            await caller.call(budget_exceeded)
+        self.assertEqual(caller.breaker.state, CLOSED)
+        with self.assertRaises(RuntimeError):
+            await caller.call(service.fail)
+        self.assertEqual(caller.breaker.state, OPEN)
+        with self.assertRaises(CircuitOpenError) as context:
+            await caller.call(service.fail)
+        self.assertEqual(service.calls, 2)
+        self.assertGreater(context.exception.retry_after, 0)
+
+    async def test_failed_primary(self):
+        """Test that the failure of the hedged call does not fail the hedge, and the errors are not hedged."""
+        caller = ResilientCaller(CircuitBreaker('test'), min_hedge_delay=0.01, max_hedge_delay=0.01)
+        calls = []
+
+        async def call():
+            calls.append(len(calls))
+            if len(calls) == 1:
+                await asyncio.sleep(0.03)
+                raise RuntimeError("The first call has failed.")
+            await asyncio.sleep(0.05)
+            return len(calls)
+
+        self.assertEqual(await caller.call(call), 2)
+        service = SlowService()
+        with self.assertRaises(RuntimeError):
+            await caller.call(service.fail)
+        self.assertEqual(service.calls, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,95 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+# See LICENSE file in the project root for full license information.
+import os
+import unittest
+from unittest.mock import AsyncMock
+
+from retrieval_gate import RETRIEVE, REUSE, SKIP, GateClassifier, RetrievalGate
+from util import ChatRequest, Message
+
+EXAMPLES_FILE = os.path.join(
+    os.path.dirname(__file__), '..', 'src', 'api', 'data', 'retrieval_gate_examples.csv')
+RESULTS = [("The TrailMaster X4 tent costs $250.", 0.9)]
+
+
+def conversation(*contents):
+    """Return the conversation of the user and assistant messages, starting with the user one."""
+    return [{'role': 'user' if i % 2 == 0 else 'assistant', 'content': content}
+            for i, content in enumerate(contents)]
+
+
+class TestRetrievalGate(unittest.IsolatedAsyncioTestCase):
+    """Tests for the retrieval gate."""
+
+    def test_rules(self):
+        """Test that the small talk is skipped and the follow-ups reuse the context."""
+        gate = RetrievalGate()
+        history = ("How much is the TrailMaster X4 tent?", "It costs $250.")
+        self.assertEqual(gate.decide(conversation(*history, "Thanks a lot!")), SKIP)
+        self.assertEqual(gate.decide(conversation(*history, "Make it shorter, please")), REUSE)
+        self.assertEqual(gate.decide(conversation(*history, "Can you put it in a table?")), REUSE)
+        self.assertEqual(gate.decide(conversation(*history, "Summarize it in one sentence")), REUSE)
+        self.assertEqual(gate.decide(conversation(*history, "Translate into French")), REUSE)
+        self.assertEqual(gate.decide(conversation(*history, "Tell me more about the tent")), REUSE)
+        self.assertEqual(gate.decide(conversation(*history, "Why does the tent leak?")), RETRIEVE)
+        # The follow-up verbs with the new topic.
+        self.assertEqual(gate.decide(conversation(*history, "Summarize the return policy")), RETRIEVE)
+        self.assertEqual(gate.decide(
+            conversation("What is your return policy?", "30 days.", "Tell me more about the TrailMaster X4 tent")),
+            RETRIEVE)
+        self.assertEqual(gate.decide(conversation(*history, "Translate the warranty terms")), RETRIEVE)
+        self.assertEqual(gate.decide(conversation(*history, "Is it waterproof?")), RETRIEVE)
+        # There is nothing to follow up in the first turn.
+        self.assertEqual(gate.decide(conversation("Make it shorter")), RETRIEVE)
+
+    def test_classifier(self):
+        """Test that the classifier, trained on the shipped examples, separates the new questions."""
+        classifier = GateClassifier.from_file(EXAMPLES_FILE)
+        self.assertEqual(classifier.predict("What is the price of the Alpine tent?")[0], RETRIEVE)
+        self.assertEqual(classifier.predict("thanks so much!")[0], SKIP)
+        self.assertEqual(classifier.predict("make it more concise")[0], REUSE)
+        self.assertEqual(classifier.predict("Summarize the shipping policy")[0], RETRIEVE)
+        gate = RetrievalGate(classifier=classifier, min_confidence=1.)
+        self.assertEqual(gate.decide(conversation("q", "a", "thanks so much!")), RETRIEVE)
+        with self.assertRaises(ValueError):
+            GateClassifier(["hi"], ["unknown"])
+
+    async def test_retrieve(self):
+        """Test that the context of the previous turn is reused and the saved time is reported."""
+        gate = RetrievalGate()
+        search_index_manager = AsyncMock()
+        search_index_manager.retrieve.return_value = RESULTS
+        request = ChatRequest(messages=[Message(content="How much is the TrailMaster X4 tent?")])
+        messages = conversation("How much is the TrailMaster X4 tent?")
+        self.assertEqual(await gate.retrieve(search_index_manager, request, messages), RESULTS)
+
+        messages = conversation("How much is the TrailMaster X4 tent?", "It costs $250.", "thanks!")
+        self.assertEqual(await gate.retrieve(search_index_manager, request, messages), [])
+        messages[-1]['content'] = "make it shorter"
+        self.assertEqual(await gate.retrieve(search_index_manager, request, messages), RESULTS)
+        # The small talk between the question and the follow-up is passed over.
+        messages = conversation(
+            "How much is the TrailMaster X4 tent?", "It costs $250.", "thanks!", "You are welcome.", "in bullet points")
+        self.assertEqual(await gate.retrieve(search_index_manager, request, messages), RESULTS)
+        search_index_manager.retrieve.assert_awaited_once()
+        stats = gate.stats()
+        self.assertEqual((stats[RETRIEVE], stats[SKIP], stats[REUSE]), (1, 1, 2))
+        self.assertAlmostEqual(stats['skip_rate'], 3 / 4)
+        self.assertGreaterEqual(stats['saved_seconds'], 0)
+
+    async def test_retrieve_previous_question(self):
+        """Test that the previous question is searched if its context is not cached."""
+        gate = RetrievalGate()
+        search_index_manager = AsyncMock()
+        search_index_manager.retrieve.return_value = RESULTS
+        messages = conversation("How much is the TrailMaster X4 tent?", "It costs $250.", "shorter")
+        request = ChatRequest(messages=[Message(content="shorter")])
+        self.assertEqual(await gate.retrieve(search_index_manager, request, messages), RESULTS)
+        searched = search_index_manager.retrieve.await_args.args[0]
+        self.assertEqual(searched.messages[-1].content, "How much is the TrailMaster X4 tent?")
+        self.assertEqual(gate.stats()[RETRIEVE], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,63 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+# See LICENSE file in the project root for full license information.
+import unittest
+
+import numpy as np
+from retrieval_policy import RetrievalPolicy
+from util import RetrievalOptions
+
+RESULTS = [('a', 0.9), ('b', 0.88), ('c', 0.85), ('d', 0.6), ('e', 0.55)]
+
+
+class TestRetrievalPolicy(unittest.TestCase):
+    """Tests for the retrieval policy."""
+
+    def test_default(self):
+        """Test that the default policy returns the top_k results as they are."""
+        self.assertEqual(RetrievalPolicy(top_k=3).select(RESULTS), RESULTS[:3])
+        self.assertEqual(RetrievalPolicy(top_k=3).candidates, 3)
+
+    def test_min_score_and_gap(self):
+        """Test that the weak results and the results after the score gap are dropped."""
+        self.assertEqual(RetrievalPolicy(min_score=0.58).select(RESULTS), RESULTS[:4])
+        self.assertEqual(RetrievalPolicy(score_gap=0.1).select(RESULTS), RESULTS[:3])
+        self.assertEqual(RetrievalPolicy(min_score=0.95).select(RESULTS), [])
+
+    def test_fusion_scores(self):
+        """Test that the results, kept by the thresholds, are ordered by the fusion scores."""
+        fusion_scores = [0.1, 0.3, 0.2, 0.5, 0.4]
+        self.assertEqual(
+            RetrievalPolicy(top_k=2, min_score=0.58).select(RESULTS, fusion_scores=fusion_scores),
+            [('d', 0.6), ('b', 0.88)])
+        self.assertFalse(RetrievalPolicy().uses_similarity)
+        self.assertTrue(RetrievalPolicy(score_gap=0.1).uses_similarity)
+
+    def test_mmr(self):
+        """Test that the result, repeating the selected one, is replaced by the more diverse one."""
+        vectors = np.array([[1., 0., 0.], [1., 0.01, 0.], [0., 1., 0.], [0., 0., 1.], [0., 1., 1.]])
+        policy = RetrievalPolicy(top_k=3, mmr_lambda=0.5)
+        self.assertEqual(policy.candidates, 12)
+        self.assertEqual([token for token, _ in policy.select(RESULTS, vectors)], ['a', 'c', 'd'])
+        # Without the vectors the results are not reranked.
+        self.assertEqual(policy.select(RESULTS), RESULTS[:3])
+
+    def test_override(self):
+        """Test that the request options override the defaults."""
+        policy = RetrievalPolicy(top_k=5, min_score=0.5)
+        self.assertIs(policy.override(None), policy)
+        self.assertIs(policy.override(RetrievalOptions()), policy)
+        overridden = policy.override(RetrievalOptions(top_k=2, mmr_lambda=0.7))
+        self.assertEqual(
+            (overridden.top_k, overridden.min_score, overridden.mmr_lambda), (2, 0.5, 0.7))
+
+    def test_invalid(self):
+        """Test that the invalid parameters are rejected."""
+        with self.assertRaises(ValueError):
+            RetrievalPolicy(top_k=0)
+        with self.assertRaises(ValueError):
+            RetrievalPolicy(mmr_lambda=1.5)
+
+
+if __name__ == "__main__":
+    unittest.main()
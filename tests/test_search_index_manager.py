@@ -1,15 +1,22 @@
 # Copyright (c) Microsoft. All rights reserved.
 # Licensed under the MIT license.
 # See LICENSE file in the project root for full license information.
+import asyncio
 import csv
+import io
 import json
 import os
 import unittest
+import numpy as np
 from unittest.mock import AsyncMock, Mock, patch
 from azure.identity.aio import DefaultAzureCredential
 
-from util import ChatRequest, Message
+from util import ChatRequest, Message, RetrievalOptions, estimate_tokens
 from search_index_manager import SearchIndexManager
+from local_search_index import LocalSearchIndex
+from keyword_index import KeywordIndex
+from embedding_cache import EmbeddingCache
+from resilience import CircuitBreaker, CircuitOpenError, ResilientCaller
 from azure.ai.projects.aio import AIProjectClient
 from azure.core.exceptions import ResourceNotFoundError, HttpResponseError
 import tempfile
@@ -177,6 +184,246 @@ class TestSearchIndexManager(unittest.IsolatedAsyncioTestCase):
                 mock_serch_client.search.assert_called_once()
                 self.assertEqual(search_result, "a\n------\nb")
 
+    async def test_local_search_mock(self):
+        """Test that the local index is searched without Azure index."""
+        mock_embedding = AsyncMock()
+        mock_embedding.embed.return_value = {
+            'data': [{'embedding': [1., 0.]}]
+        }
+        local_index = LocalSearchIndex(['a', 'b', 'c'], np.array([[1., 0.], [0., 1.], [1., 1.]]))
+        rag = SearchIndexManager(
+            endpoint=self.search_endpoint,
+            credential=AsyncMock(),
+            index_name=self.index_name,
+            dimensions=2,
+            model="mock_embedding_model",
+            embeddings_client=mock_embedding,
+            local_index=local_index
+        )
+        with patch('search_index_manager.SearchClient') as mock_search_client, \
+                patch('search_index_manager.asyncio.to_thread', wraps=asyncio.to_thread) as mock_to_thread:
+            search_result = await rag.search(ChatRequest(messages=[Message(content='test')]))
+            mock_search_client.assert_not_called()
+        self.assertTrue(search_result.startswith("a\n------\nc"))
+        # The index is scanned outside of the event loop.
+        self.assertEqual(mock_to_thread.call_args.args[0], local_index.search)
+
+    async def test_retrieval_policy_mock(self):
+        """Test that the request overrides the retrieval policy and gets the scores."""
+        mock_embedding = AsyncMock()
+        mock_embedding.embed.return_value = {
+            'data': [{'embedding': [1., 0.]}]
+        }
+        local_index = LocalSearchIndex(
+            ['a', 'a2', 'b', 'c'], np.array([[1., 0.], [1., 0.01], [1., 0.5], [0., 1.]]))
+        rag = SearchIndexManager(
+            endpoint=self.search_endpoint,
+            credential=AsyncMock(),
+            index_name=self.index_name,
+            dimensions=2,
+            model="mock_embedding_model",
+            embeddings_client=mock_embedding,
+            local_index=local_index
+        )
+        results = await rag.retrieve(ChatRequest(messages=[Message(content='test')]))
+        self.assertEqual([token for token, _ in results], ['a', 'a2', 'b', 'c'])
+        self.assertAlmostEqual(results[0][1], 1.)
+        results = await rag.retrieve(ChatRequest(
+            messages=[Message(content='test')], retrieval=RetrievalOptions(top_k=2, mmr_lambda=0.3)))
+        self.assertEqual([token for token, _ in results], ['a', 'c'])
+        results = await rag.retrieve(ChatRequest(
+            messages=[Message(content='test')], retrieval=RetrievalOptions(min_score=0.5)))
+        self.assertEqual([token for token, _ in results], ['a', 'a2', 'b'])
+
+    async def test_keyword_search_mock(self):
+        """Test the fusion with the keyword results and the keyword fast path."""
+        mock_embedding = AsyncMock()
+        mock_embedding.embed.return_value = {
+            'data': [{'embedding': [1., 0.]}]
+        }
+        tokens = ['TrailMaster X4 tent', 'Alpine Explorer tent', 'sleeping bag'] + ['tent review'] * 100
+        vectors = np.array([[0., 1.], [1., 0.], [1., 0.1]] + [[0., 1.]] * 100)
+        rag = SearchIndexManager(
+            endpoint=self.search_endpoint,
+            credential=AsyncMock(),
+            index_name=self.index_name,
+            dimensions=2,
+            model="mock_embedding_model",
+            embeddings_client=mock_embedding,
+            local_index=LocalSearchIndex(tokens, vectors),
+            keyword_index=KeywordIndex(tokens)
+        )
+        results = await rag.retrieve(ChatRequest(
+            messages=[Message(content='Which tent is better than TrailMaster?')],
+            retrieval=RetrievalOptions(top_k=2)))
+        mock_embedding.embed.assert_called_once()
+        self.assertEqual([token for token, _ in results], ['Alpine Explorer tent', 'TrailMaster X4 tent'])
+        # The scores are the cosine similarity, also of the chunk found only by the keywords.
+        self.assertEqual([round(score, 3) for _, score in results], [1., 0.])
+        # The keyword matches are dropped by the minimal score as the vector search results.
+        results = await rag.retrieve(ChatRequest(
+            messages=[Message(content='Which tent is better than TrailMaster?')],
+            retrieval=RetrievalOptions(top_k=2, min_score=0.5)))
+        self.assertEqual([token for token, _ in results], ['Alpine Explorer tent', 'sleeping bag'])
+
+        mock_embedding.embed.reset_mock()
+        results = await rag.retrieve(ChatRequest(messages=[Message(content='Tell me about the TrailMaster X4 tent')]))
+        mock_embedding.embed.assert_not_called()
+        self.assertEqual(results[0][0], 'TrailMaster X4 tent')
+        # The fast path is not taken if the chunks are selected by their similarity.
+        results = await rag.retrieve(ChatRequest(
+            messages=[Message(content='Tell me about the TrailMaster X4 tent')],
+            retrieval=RetrievalOptions(min_score=0.5)))
+        mock_embedding.embed.assert_called_once()
+        self.assertNotIn('TrailMaster X4 tent', [token for token, _ in results])
+
+    async def test_azure_scores_mock(self):
+        """Test that the scores of Azure AI Search are converted to the cosine similarity."""
+        mock_ix_client = AsyncMock()
+        mock_serch_client = AsyncMock()
+        mock_serch_client.search.return_value = MockAsyncIterator([
+            {'token': 'a', '@search.score': 1.},
+            {'token': 'b', '@search.score': 0.5}
+        ])
+        mock_embedding = AsyncMock()
+        mock_embedding.embed.return_value = {
+            'data': [{'embedding': [1., 0.]}]
+        }
+        with patch('search_index_manager.SearchIndexClient', return_value=mock_ix_client), \
+                patch('search_index_manager.SearchClient', return_value=mock_serch_client):
+            mock_ix_client.__aenter__.return_value = AsyncMock()
+            rag = self._get_mock_rag(mock_embedding)
+            await rag.ensure_index_created()
+            results = await rag.retrieve(ChatRequest(messages=[Message(content='test')]))
+        self.assertEqual(results, [('a', 1.), ('b', 0.)])
+        self.assertEqual(mock_serch_client.search.call_args.kwargs['select'], ['token'])
+
+    async def test_circuit_breaker_mock(self):
+        """Test that the search service is not called while its circuit breaker is open."""
+        mock_ix_client = AsyncMock()
+        mock_serch_client = AsyncMock()
+        mock_serch_client.search.side_effect = HttpResponseError("The service is not available.")
+        mock_embedding = AsyncMock()
+        mock_embedding.embed.return_value = {
+            'data': [{'embedding': [1., 0.]}]
+        }
+        with patch('search_index_manager.SearchIndexClient', return_value=mock_ix_client), \
+                patch('search_index_manager.SearchClient', return_value=mock_serch_client):
+            mock_ix_client.__aenter__.return_value = AsyncMock()
+            rag = SearchIndexManager(
+                endpoint=self.search_endpoint,
+                credential=AsyncMock(),
+                index_name=self.index_name,
+                dimensions=100,
+                model="mock_embedding_model",
+                embeddings_client=mock_embedding,
+                search_caller=ResilientCaller(CircuitBreaker('search', failure_threshold=1), hedge_percentile=0),
+            )
+            await rag.ensure_index_created()
+            with self.assertRaises(HttpResponseError):
+                await rag.retrieve(ChatRequest(messages=[Message(content='test')]))
+            with self.assertRaises(CircuitOpenError):
+                await rag.retrieve(ChatRequest(messages=[Message(content='test')]))
+        self.assertEqual(mock_serch_client.search.call_count, 1)
+
+    async def test_embedding_cache_mock(self):
+        """Test that the repeated question is embedded only once."""
+        mock_embedding = AsyncMock()
+        mock_embedding.embed.return_value = {
+            'data': [{'embedding': [1., 0.]}]
+        }
+        rag = SearchIndexManager(
+            endpoint=self.search_endpoint,
+            credential=AsyncMock(),
+            index_name=self.index_name,
+            dimensions=2,
+            model="mock_embedding_model",
+            embeddings_client=mock_embedding,
+            local_index=LocalSearchIndex(['a', 'b'], np.array([[1., 0.], [0., 1.]])),
+            embedding_cache=EmbeddingCache()
+        )
+        await rag.search(ChatRequest(messages=[Message(content='Which tent?')]))
+        await rag.search(ChatRequest(messages=[Message(content='which  tent?')]))
+        mock_embedding.embed.assert_called_once()
+        mock_embedding.embed.reset_mock()
+        warmed = await rag.warm_up_embedding_cache(['Which tent?', 'Which boots?'])
+        self.assertEqual(warmed, 1)
+        self.assertEqual(mock_embedding.embed.call_args.kwargs['input'], ['Which boots?'])
+
+    def _write_embeddings(self, directory, rows):
+        """Write the embeddings file with the given number of rows."""
+        embeddings_file = os.path.join(directory, 'embeddings.csv')
+        with open(embeddings_file, 'w', newline='') as fp:
+            writer = csv.DictWriter(fp, fieldnames=['token', 'embedding'])
+            writer.writeheader()
+            for i in range(rows):
+                writer.writerow({'token': f'token {i}', 'embedding': json.dumps([i, i])})
+        return embeddings_file
+
+    async def test_upload_documents_batches_mock(self):
+        """Test that documents are uploaded in batches, limited by count and size."""
+        mock_ix_client = AsyncMock()
+        mock_serch_client = AsyncMock()
+        mock_serch_client.upload_documents.return_value = []
+        with patch('search_index_manager.SearchIndexClient', return_value=mock_ix_client):
+            with patch('search_index_manager.SearchClient', return_value=mock_serch_client):
+                rag = self._get_mock_rag(AsyncMock())
+                await rag.ensure_index_created()
+                with tempfile.TemporaryDirectory() as d:
+                    embeddings_file = self._write_embeddings(d, 5)
+                    stats = await rag.upload_documents(embeddings_file, max_batch_documents=2)
+                    self.assertEqual(stats['documents'], 5)
+                    self.assertEqual(stats['batches'], 3)
+                    uploaded = [doc['token'] for call in mock_serch_client.upload_documents.call_args_list
+                                for doc in call.args[0]]
+                    self.assertEqual(sorted(uploaded), [f'token {i}' for i in range(5)])
+                    mock_serch_client.upload_documents.reset_mock()
+                    stats = await rag.upload_documents(embeddings_file, max_batch_bytes=100)
+                    self.assertEqual(stats['batches'], 5)
+
+    async def test_upload_documents_retry_mock(self):
+        """Test that the throttled batch is retried."""
+        mock_ix_client = AsyncMock()
+        mock_serch_client = AsyncMock()
+        throttled = HttpResponseError("Mock")
+        throttled.status_code = 429
+        mock_serch_client.upload_documents.side_effect = [throttled, []]
+        with patch('search_index_manager.SearchIndexClient', return_value=mock_ix_client):
+            with patch('search_index_manager.SearchClient', return_value=mock_serch_client):
+                with patch('search_index_manager.asyncio.sleep') as mock_sleep:
+                    rag = self._get_mock_rag(AsyncMock())
+                    await rag.ensure_index_created()
+                    with tempfile.TemporaryDirectory() as d:
+                        stats = await rag.upload_documents(self._write_embeddings(d, 3))
+                    self.assertEqual(stats['documents'], 3)
+                    self.assertEqual(mock_serch_client.upload_documents.call_count, 2)
+                    mock_sleep.assert_called_once()
+                    mock_serch_client.upload_documents.side_effect = HttpResponseError("Mock")
+                    with tempfile.TemporaryDirectory() as d:
+                        with self.assertRaisesRegex(HttpResponseError, "Mock"):
+                            await rag.upload_documents(self._write_embeddings(d, 3))
+
+    async def test_sync_documents_mock(self):
+        """Test that only new documents are uploaded and the stale ones are deleted."""
+        mock_ix_client = AsyncMock()
+        mock_serch_client = AsyncMock()
+        mock_serch_client.upload_documents.return_value = []
+        mock_serch_client.search.return_value = MockAsyncIterator([
+            {'embedId': SearchIndexManager.get_embed_id('token 0')},
+            {'embedId': 'stale'}
+        ])
+        with patch('search_index_manager.SearchIndexClient', return_value=mock_ix_client):
+            with patch('search_index_manager.SearchClient', return_value=mock_serch_client):
+                rag = self._get_mock_rag(AsyncMock())
+                await rag.ensure_index_created()
+                with tempfile.TemporaryDirectory() as d:
+                    stats = await rag.sync_documents(self._write_embeddings(d, 3))
+        self.assertEqual(stats, {'uploaded': 2, 'deleted': 1, 'unchanged': 1})
+        uploaded = mock_serch_client.upload_documents.call_args.args[0]
+        self.assertEqual([doc['token'] for doc in uploaded], ['token 1', 'token 2'])
+        self.assertEqual(uploaded[0]['embedId'], SearchIndexManager.get_embed_id('token 1'))
+        mock_serch_client.delete_documents.assert_called_once_with(documents=[{'embedId': 'stale'}])
+
     async def test_is_empty_mock(self):
         """Test how we check if the index is empty."""
         mock_ix_client = AsyncMock()
@@ -258,12 +505,12 @@ class TestSearchIndexManager(unittest.IsolatedAsyncioTestCase):
                     await rag.close()
                     self.assertTrue(bool(result))
 
-    @data(2, 4)
-    async def test_build_embeddings_file_mock(self, sentences_per_embedding):
-        """Use this test to build the new embeddings file in the data directory."""
+    @data(12, 24)
+    async def test_build_embeddings_file_mock(self, max_tokens):
+        """Test that the documents are chunked within the budget and each chunk gets its embedding."""
         embedding_client = AsyncMock()
-        embedding_client.embed.retun_value = {'data': [[0, 0], [1, 1], [
-            2, 2]] if sentences_per_embedding == 4 else [[0, 0], [1, 1]]}
+        embedding_client.embed.side_effect = lambda input, dimensions, model: {
+            'data': [{'embedding': [len(text), len(text)], 'index': i} for i, text in enumerate(input)]}
         rag = SearchIndexManager(
             endpoint=self.search_endpoint,
             credential=AsyncMock(),
@@ -273,32 +520,127 @@ class TestSearchIndexManager(unittest.IsolatedAsyncioTestCase):
             embeddings_client=embedding_client,
         )
         sentences = [
-            f"This is {v} sentence" for v in [
+            f"This is {v} sentence." for v in [
                 'first', 'second', 'third', 'forth', 'fifth']]
         with tempfile.TemporaryDirectory() as d:
-            data = ' '.join(sentences)
-            input_file = os.path.join(d, 'input.csv')
-            with open(input_file, 'w') as f:
-                f.write(data)
+            with open(os.path.join(d, 'input.md'), 'w') as f:
+                f.write("# Header\n\n" + ' '.join(sentences))
             out_file = os.path.join(d, 'embeddings.csv')
             await rag.build_embeddings_file(
-                input_directory=input_file,
+                input_directory=d,
                 output_file=out_file,
-                sentences_per_embedding=sentences_per_embedding
+                max_tokens=max_tokens,
+                overlap_tokens=0,
+                batch_size=2
             )
-            index = 1
             with open(out_file, newline='') as fp:
-                reader = csv.DictReader(fp)
-                for row in reader:
-                    self.assertEqual(
-                        ' '.join(
-                            sentences[
-                                index * sentences_per_embedding: (index + 1) * sentences_per_embedding]))
-                    self.assertListEqual(
-                        json.loads(
-                            row['embedding']), [
-                            index, index])
-                    index += 1
+                rows = list(csv.DictReader(fp))
+        self.assertGreater(len(rows), 1)
+        for row in rows:
+            self.assertTrue(row['token'].startswith("# Header"))
+            self.assertLessEqual(estimate_tokens(row['token']), max_tokens)
+            self.assertListEqual(json.loads(row['embedding']), [len(row['token'])] * 2)
+        for sentence in sentences:
+            self.assertTrue(any(sentence in row['token'] for row in rows))
+
+    async def test_write_embeddings_resume_mock(self):
+        """Test that the interrupted embedding continues from the last written batch."""
+        tokens = [f"token {i}" for i in range(5)]
+
+        def embed(input, dimensions, model):
+            if input[0] == "token 2" and embed.fail:
+                raise HttpResponseError("Mock")
+            return {'data': [{'embedding': [int(text.split()[1])] * 2, 'index': i}
+                             for i, text in enumerate(input)]}
+        embed.fail = True
+        embedding_client = AsyncMock()
+        embedding_client.embed.side_effect = embed
+        rag = self._get_mock_rag(embedding_client)
+        with tempfile.TemporaryDirectory() as d:
+            out_file = os.path.join(d, 'embeddings.csv')
+            with self.assertRaisesRegex(HttpResponseError, "Mock"):
+                await rag._write_embeddings(tokens, out_file, batch_size=2, max_concurrency=1)
+            self.assertTrue(os.path.isfile(out_file + '.checkpoint'))
+            embed.fail = False
+            embedding_client.embed.reset_mock()
+            await rag._write_embeddings(tokens, out_file, batch_size=2, max_concurrency=1)
+            self.assertEqual(
+                [call.kwargs['input'] for call in embedding_client.embed.call_args_list],
+                [["token 2", "token 3"], ["token 4"]])
+            self.assertFalse(os.path.isfile(out_file + '.checkpoint'))
+            with open(out_file, newline='') as fp:
+                rows = list(csv.DictReader(fp))
+        self.assertEqual([row['token'] for row in rows], tokens)
+        for row in rows:
+            index = int(row['token'].split()[1])
+            self.assertListEqual(json.loads(row['embedding']), [index, index])
+
+    async def test_build_embeddings_file_resume_truncated_mock(self):
+        """Test that the incremental build resumes after the crash, which cut the last row."""
+
+        def embed(input, dimensions, model):
+            embed.calls += 1
+            if embed.calls == embed.fail_at:
+                embed.failed = input
+                raise HttpResponseError("Mock")
+            return {'data': [{'embedding': [len(text)] * 2, 'index': i} for i, text in enumerate(input)]}
+        embed.calls = 0
+        embed.fail_at = None
+        embedding_client = AsyncMock()
+        embedding_client.embed.side_effect = embed
+        rag = self._get_mock_rag(embedding_client)
+        with tempfile.TemporaryDirectory() as d:
+            with open(os.path.join(d, 'old.md'), 'w') as f:
+                f.write("# Old\n\nThe old section of the documentation.\n")
+            out_file = os.path.join(d, 'embeddings.csv')
+            await rag.build_embeddings_file(d, out_file, max_tokens=12, overlap_tokens=0, batch_size=1)
+            old_rows = embed.calls
+            with open(os.path.join(d, 'new.md'), 'w') as f:
+                f.write("# New\n\n" + ' '.join(f"This is sentence number {i}." for i in range(6)) + "\n")
+            embed.calls = 0
+            embed.fail_at = 3
+            with self.assertRaisesRegex(HttpResponseError, "Mock"):
+                await rag.build_embeddings_file(
+                    d, out_file, max_tokens=12, overlap_tokens=0, batch_size=1, max_concurrency=1,
+                    incremental=True)
+            self.assertTrue(os.path.isfile(out_file + '.checkpoint'))
+            # The crash cut the row of the batch, which was not committed.
+            rows = io.StringIO()
+            csv.writer(rows).writerow([embed.failed[0], "[1, 1]"])
+            with open(out_file, 'ab') as fp:
+                fp.write(rows.getvalue()[:-6].encode('utf-8'))
+            embed.calls = 0
+            embed.fail_at = None
+            embedding_client.embed.reset_mock()
+            await rag.build_embeddings_file(
+                d, out_file, max_tokens=12, overlap_tokens=0, batch_size=1, max_concurrency=1,
+                incremental=True)
+            self.assertFalse(os.path.isfile(out_file + '.checkpoint'))
+            with open(out_file, newline='') as fp:
+                rows = list(csv.DictReader(fp))
+        tokens = [row['token'] for row in rows]
+        self.assertEqual(len(tokens), len(set(tokens)))
+        self.assertGreater(len(tokens), old_rows + 3)
+        # The two committed batches are not embedded again.
+        self.assertEqual(embedding_client.embed.call_count, len(tokens) - old_rows - 2)
+        for row in rows:
+            self.assertListEqual(json.loads(row['embedding']), [len(row['token'])] * 2)
+
+    async def test_write_embeddings_incremental_mock(self):
+        """Test that the known embeddings are reused."""
+        embedding_client = AsyncMock()
+        embedding_client.embed.return_value = {'data': [{'embedding': [2, 2], 'index': 0}]}
+        rag = self._get_mock_rag(embedding_client)
+        with tempfile.TemporaryDirectory() as d:
+            out_file = os.path.join(d, 'embeddings.csv')
+            await rag._write_embeddings(
+                ["old", "new"], out_file, batch_size=10, max_concurrency=1,
+                known_embeddings={"old": "[1, 1]"})
+            with open(out_file, newline='') as fp:
+                rows = {row['token']: json.loads(row['embedding']) for row in csv.DictReader(fp)}
+        embedding_client.embed.assert_called_once()
+        self.assertEqual(embedding_client.embed.call_args.kwargs['input'], ["new"])
+        self.assertEqual(rows, {"old": [1, 1], "new": [2, 2]})
 
     @unittest.skip("Only for live tests.")
     async def test_build_embeddings_file(self):
@@ -0,0 +1,91 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+# See LICENSE file in the project root for full license information.
+import asyncio
+import os
+import sqlite3
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from session_store import SessionStore
+
+
+def _turn(i):
+    return [{"role": "user", "content": f"question {i}"}, {"role": "assistant", "content": f"answer {i}"}]
+
+
+class TestSessionStore(unittest.IsolatedAsyncioTestCase):
+    """Tests for the conversation session store."""
+
+    async def _check_store(self, store):
+        with patch('session_store.time.time', return_value=100.):
+            session_id = await store.create()
+            self.assertEqual(await store.get(session_id), [])
+            self.assertTrue(await store.append(session_id, _turn(0)))
+            self.assertTrue(await store.append(session_id, _turn(1)))
+            self.assertTrue(await store.append(session_id, _turn(2)))
+            # Only the newest messages are kept.
+            self.assertEqual(await store.get(session_id), _turn(1) + _turn(2))
+            self.assertIsNone(await store.get('unknown'))
+            self.assertFalse(await store.append('unknown', _turn(0)))
+        # The session is extended by the use.
+        with patch('session_store.time.time', return_value=105.):
+            self.assertIsNotNone(await store.get(session_id))
+        with patch('session_store.time.time', return_value=114.):
+            self.assertIsNotNone(await store.get(session_id))
+        with patch('session_store.time.time', return_value=125.):
+            self.assertIsNone(await store.get(session_id))
+            self.assertFalse(await store.append(session_id, _turn(3)))
+            other = await store.create()
+            await store.delete(other)
+            self.assertIsNone(await store.get(other))
+
+    async def test_memory(self):
+        """Test the sessions in memory."""
+        await self._check_store(SessionStore(ttl=10, max_messages=4))
+
+    async def test_disk(self):
+        """Test the sessions in the SQLite file, shared by the stores."""
+        with tempfile.TemporaryDirectory() as d:
+            disk_path = os.path.join(d, 'sessions.sqlite')
+            store = SessionStore(ttl=10, max_messages=4, disk_path=disk_path)
+            await self._check_store(store)
+            other = SessionStore(disk_path=disk_path)
+            session_id = await store.create()
+            await store.append(session_id, _turn(0))
+            self.assertEqual(await other.get(session_id), _turn(0))
+            await store.close()
+            await other.close()
+
+    async def test_locked_database(self):
+        """Test that the event loop is not blocked while the other process holds the lock of the database."""
+        with tempfile.TemporaryDirectory() as d:
+            disk_path = os.path.join(d, 'sessions.sqlite')
+            store = SessionStore(disk_path=disk_path)
+            session_id = await store.create()
+            other = sqlite3.connect(disk_path, isolation_level=None)
+            other.execute("BEGIN IMMEDIATE")
+            appending = asyncio.create_task(store.append(session_id, _turn(0)))
+            await asyncio.sleep(0.1)
+            self.assertFalse(appending.done())
+            other.execute("COMMIT")
+            self.assertTrue(await appending)
+            other.close()
+            await store.close()
+            with self.assertRaises(RuntimeError):
+                await store.get(session_id)
+
+    async def test_evict_least_recently_used(self):
+        """Test that the least recently used session is removed."""
+        store = SessionStore(max_sessions=2)
+        first = await store.create()
+        second = await store.create()
+        await store.get(first)
+        await store.create()
+        self.assertIsNotNone(await store.get(first))
+        self.assertIsNone(await store.get(second))
+
+
+if __name__ == "__main__":
+    unittest.main()
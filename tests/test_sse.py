@@ -0,0 +1,62 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+# See LICENSE file in the project root for full license information.
+import asyncio
+import unittest
+
+from sse import coalesce_deltas, serialize_message_event, serialize_sse_event
+
+
+async def _deltas(items):
+    """Yield the deltas, sleeping for the given number of seconds before each of them."""
+    for delay, delta in items:
+        await asyncio.sleep(delay)
+        yield delta
+
+
+async def _collect(stream):
+    return [item async for item in stream]
+
+
+class TestSse(unittest.IsolatedAsyncioTestCase):
+    """Tests for the server sent events helpers."""
+
+    def test_serialize_message_event(self):
+        """Test that the fast serialization is the same as the generic one."""
+        for content in ["Hello", 'The "X4" tent\n', "Température 25°C ✓", "\\ \t  "]:
+            self.assertEqual(
+                serialize_message_event(content),
+                serialize_sse_event({"content": content, "type": "message"}))
+
+    async def test_coalesce_disabled(self):
+        """Test that the deltas are passed through if the window is not positive."""
+        deltas = [(0, "a"), (0, "b"), (0, "c")]
+        self.assertEqual(await _collect(coalesce_deltas(_deltas(deltas), 0)), ["a", "b", "c"])
+
+    async def test_coalesce_window(self):
+        """Test that the first delta is sent at once and the following ones are joined within the window."""
+        deltas = [(0, "a"), (0, "b"), (0, "c"), (0.2, "d"), (0, "e")]
+        self.assertEqual(await _collect(coalesce_deltas(_deltas(deltas), 0.05)), ["a", "bc", "de"])
+
+    async def test_coalesce_max_bytes(self):
+        """Test that the buffer is flushed when it reaches max_bytes."""
+        deltas = [(0, "a"), (0, "bb"), (0, "cc"), (0, "d")]
+        self.assertEqual(
+            await _collect(coalesce_deltas(_deltas(deltas), 10, max_bytes=4)), ["a", "bbcc", "d"])
+
+    async def test_coalesce_error(self):
+        """Test that the buffered deltas are sent before the error."""
+        async def failing():
+            yield "a"
+            yield "b"
+            raise ValueError("Stream failed.")
+
+        received = []
+        with self.assertRaises(ValueError):
+            async for delta in coalesce_deltas(failing(), 10):
+                received.append(delta)
+        self.assertEqual(received, ["a", "b"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,100 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+# See LICENSE file in the project root for full license information.
+import asyncio
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from stream_replay import StreamReplayStore
+
+
+async def _events(count, delay=0.01):
+    for i in range(count):
+        await asyncio.sleep(delay)
+        yield f"event{i}"
+
+
+async def _read(store, stream_id, after=-1):
+    return [item async for item in store.read(stream_id, after)]
+
+
+class TestStreamReplayStore(unittest.IsolatedAsyncioTestCase):
+    """Tests for the replay store of the chat streams."""
+
+    async def test_resume_running_stream(self):
+        """Test that the reader gets the missed events and waits for the rest of the running stream."""
+        store = StreamReplayStore()
+        stream_id = store.create()
+        recording = asyncio.create_task(store.record(stream_id, _events(5)))
+        await asyncio.sleep(0.025)
+        self.assertEqual(await _read(store, stream_id, after=0), [(i, f"event{i}") for i in range(1, 5)])
+        await recording
+        self.assertEqual(await _read(store, stream_id, after=3), [(4, "event4")])
+
+    async def test_expired_and_evicted(self):
+        """Test that the expired and the oldest streams are removed."""
+        store = StreamReplayStore(ttl=10, max_streams=2)
+        with patch('stream_replay.time.time', return_value=100.):
+            first = store.create()
+            second = store.create()
+            third = store.create()
+            self.assertFalse(await store.exists(first))
+            self.assertTrue(await store.exists(second))
+            self.assertIsNone(store.append(first, "event"))
+        with patch('stream_replay.time.time', return_value=111.):
+            self.assertFalse(await store.exists(third))
+
+    async def test_shared_disk(self):
+        """Test that the stream, recorded by one worker, is resumed on the other one."""
+        with tempfile.TemporaryDirectory() as d:
+            disk_path = os.path.join(d, 'streams.sqlite')
+            writer = StreamReplayStore(disk_path=disk_path, poll_interval=0.01)
+            reader = StreamReplayStore(disk_path=disk_path, poll_interval=0.01)
+            stream_id = writer.create()
+            recording = asyncio.create_task(writer.record(stream_id, _events(5)))
+            # The stream is written to the database in the background.
+            for _ in range(100):
+                if await reader.exists(stream_id):
+                    break
+                await asyncio.sleep(0.01)
+            self.assertTrue(await reader.exists(stream_id))
+            self.assertEqual(await _read(reader, stream_id, after=1), [(i, f"event{i}") for i in range(2, 5)])
+            await recording
+            self.assertFalse(await reader.exists('unknown'))
+            await writer.close()
+            await reader.close()
+
+    async def test_live_stream_from_memory(self):
+        """Test that the worker, recording the stream, sends the events without waiting for the database."""
+        with tempfile.TemporaryDirectory() as d:
+            store = StreamReplayStore(disk_path=os.path.join(d, 'streams.sqlite'), poll_interval=10)
+            stream_id = store.create()
+            reading = asyncio.create_task(_read(store, stream_id))
+            store.append(stream_id, "event0")
+            store.finish(stream_id)
+            self.assertEqual(await asyncio.wait_for(reading, timeout=1), [(0, "event0")])
+            # The pending events are written on close.
+            await store.close()
+            reader = StreamReplayStore(disk_path=os.path.join(d, 'streams.sqlite'))
+            self.assertEqual(await _read(reader, stream_id), [(0, "event0")])
+            await reader.close()
+
+    async def test_close(self):
+        """Test that close stops the recording and the database is not opened again after it."""
+        with tempfile.TemporaryDirectory() as d:
+            store = StreamReplayStore(disk_path=os.path.join(d, 'streams.sqlite'), poll_interval=0.01)
+            stream_id = store.start(_events(100, delay=1))
+            await asyncio.sleep(0)
+            await asyncio.wait_for(store.close(), timeout=1)
+            self.assertFalse(store._recording)
+            self.assertTrue(await store.exists(stream_id))
+            self.assertEqual(store.append(stream_id, "event"), 0)
+            await asyncio.sleep(0.02)
+            self.assertIsNone(store._connection)
+            self.assertIsNone(store._writer)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,86 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+# See LICENSE file in the project root for full license information.
+import json
+import unittest
+from unittest.mock import AsyncMock, MagicMock, patch
+
+from token_budget import (
+    TokenBudget,
+    TokenBudgetExceeded,
+    TokenBudgetPolicy,
+    estimate_request_tokens,
+)
+
+
+class TestTokenBudget(unittest.IsolatedAsyncioTestCase):
+    """Tests for the tokens per minute budget."""
+
+    def test_estimate_request_tokens(self):
+        """Test the estimation of the chat and embeddings requests."""
+        chat = {"messages": [{"role": "user", "content": "Hello world"}], "max_tokens": 10}
+        self.assertEqual(estimate_request_tokens(chat, 100), 4 + 4 + 10)
+        del chat["max_tokens"]
+        self.assertEqual(estimate_request_tokens(chat, 100), 4 + 4 + 100)
+        self.assertEqual(estimate_request_tokens({"input": ["Hello world", "Hi"]}, 100), 5)
+
+    async def test_pace_and_reject(self):
+        """Test that the request waits for the refill and is rejected if it would wait too long."""
+        with patch('token_budget.time.monotonic', return_value=0.), \
+                patch('token_budget.asyncio.sleep', new_callable=AsyncMock) as sleep:
+            budget = TokenBudget('test', tokens_per_minute=600, max_wait=20)
+            await budget.acquire(500)
+            sleep.assert_not_called()
+            # 100 tokens are missing, they are refilled in 10 seconds.
+            await budget.acquire(200)
+            sleep.assert_awaited_once_with(10.)
+            with self.assertRaises(TokenBudgetExceeded) as cm:
+                await budget.acquire(200)
+            self.assertEqual(cm.exception.retry_after, 30)
+        self.assertEqual(budget._tokens, -100)
+
+    async def test_requests_per_minute(self):
+        """Test that the requests per minute are limited."""
+        with patch('token_budget.time.monotonic', return_value=0.):
+            budget = TokenBudget('test', requests_per_minute=1, max_wait=0)
+            await budget.acquire(1000)
+            with self.assertRaises(TokenBudgetExceeded):
+                await budget.acquire(1)
+        with patch('token_budget.time.monotonic', return_value=60.):
+            await budget.acquire(1)
+
+    async def test_update_from_headers(self):
+        """Test that the budget follows the rate limit headers."""
+        with patch('token_budget.time.monotonic', return_value=0.):
+            budget = TokenBudget('test', tokens_per_minute=6000, requests_per_minute=60, max_wait=0)
+            budget.update_from_headers({
+                "x-ratelimit-remaining-tokens": "100", "x-ratelimit-remaining-requests": "5"})
+            self.assertEqual((budget.tokens, budget.requests), (100, 5))
+            budget.update_from_headers({"retry-after-ms": "1500"})
+            with self.assertRaises(TokenBudgetExceeded) as cm:
+                await budget.acquire(1)
+            self.assertEqual(cm.exception.retry_after, 2)
+            self.assertEqual(budget.wait_time(1), 1.5)
+            self.assertEqual(budget.reported_remaining, (100, 5))
+        with patch('token_budget.time.monotonic', return_value=61.):
+            # The reported quota is forgotten after a minute.
+            self.assertEqual(budget.reported_remaining, (None, None))
+            self.assertEqual(budget.wait_time(1), 0.)
+
+    async def test_policy(self):
+        """Test that the policy takes the tokens of the request body and reads the response headers."""
+        response = MagicMock()
+        response.http_response.headers = {"x-ratelimit-remaining-tokens": "1000"}
+        next_policy = MagicMock()
+        next_policy.send = AsyncMock(return_value=response)
+        request = MagicMock()
+        request.http_request.content = json.dumps({"input": ["Hello world"]})
+        with patch('token_budget.time.monotonic', return_value=0.):
+            policy = TokenBudgetPolicy(TokenBudget('test', tokens_per_minute=6000))
+            policy.next = next_policy
+            self.assertIs(await policy.send(request), response)
+            self.assertEqual(policy._budget.tokens, 1000)
+
+
+if __name__ == "__main__":
+    unittest.main()
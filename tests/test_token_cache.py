@@ -0,0 +1,106 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+# See LICENSE file in the project root for full license information.
+import asyncio
+import threading
+import time
+import unittest
+
+from azure.core.credentials import AccessToken
+from token_cache import CachingTokenCredential
+
+
+class FakeCredential:
+    """The asynchronous credential, which issues the numbered tokens."""
+
+    def __init__(self, lifetime=3600., delay=0.):
+        self.lifetime = lifetime
+        self.delay = delay
+        self.calls = []
+        self.fail = False
+        self.closed = False
+
+    async def get_token(self, *scopes, **kwargs):
+        self.calls.append((scopes, kwargs))
+        await asyncio.sleep(self.delay)
+        if self.fail:
+            raise RuntimeError("The identity endpoint is not available.")
+        return AccessToken(f"token{len(self.calls)}", time.time() + self.lifetime)
+
+    async def close(self):
+        self.closed = True
+
+
+class SyncCredential:
+    """The synchronous credential, like those of azure.identity."""
+
+    def __init__(self):
+        self.threads = []
+
+    def get_token(self, *scopes, **kwargs):
+        self.threads.append(threading.current_thread())
+        return AccessToken("sync", int(time.time() + 3600))
+
+
+class TestCachingTokenCredential(unittest.IsolatedAsyncioTestCase):
+    """Tests for the shared token cache."""
+
+    async def test_cache(self):
+        """Test that the token is acquired once per scope and tenant."""
+        credential = FakeCredential()
+        cache = CachingTokenCredential(credential)
+        self.assertEqual((await cache.get_token("scope1")).token, "token1")
+        self.assertEqual((await cache.get_token("scope1")).token, "token1")
+        self.assertEqual((await cache.get_token("scope2")).token, "token2")
+        self.assertEqual((await cache.get_token("scope1", tenant_id="tenant")).token, "token3")
+        self.assertEqual(credential.calls[2], (("scope1",), {'tenant_id': "tenant"}))
+        # The tokens for the authentication challenge are not cached.
+        self.assertEqual((await cache.get_token("scope1", claims="claims")).token, "token4")
+        self.assertEqual((await cache.get_token("scope1")).token, "token1")
+        await cache.close()
+        self.assertTrue(credential.closed)
+
+    async def test_single_flight(self):
+        """Test that the concurrent requests wait for one acquisition."""
+        credential = FakeCredential(delay=0.05)
+        async with CachingTokenCredential(credential) as cache:
+            tokens = await asyncio.gather(*(cache.get_token("scope") for _ in range(10)))
+        self.assertEqual({token.token for token in tokens}, {"token1"})
+        self.assertEqual(len(credential.calls), 1)
+
+    async def test_background_refresh(self):
+        """Test that the token is refreshed before it expires and the failed refresh is retried."""
+        credential = FakeCredential(lifetime=2.)
+        async with CachingTokenCredential(
+                credential, refresh_margin=1.8, retry_interval=0.3, min_lifetime=0.1) as cache:
+            self.assertEqual((await cache.get_token("scope")).token, "token1")
+            # The refresh is scheduled in the middle of the lifetime.
+            credential.fail = True
+            await asyncio.sleep(1.2)
+            self.assertEqual(len(credential.calls), 2)
+            self.assertEqual((await cache.get_token("scope")).token, "token1")
+            credential.fail = False
+            await asyncio.sleep(0.5)
+            self.assertEqual(len(credential.calls), 3)
+            self.assertEqual((await cache.get_token("scope")).token, "token3")
+
+    async def test_failure(self):
+        """Test that the failure is raised to the requests waiting for the token."""
+        credential = FakeCredential()
+        credential.fail = True
+        async with CachingTokenCredential(credential) as cache:
+            with self.assertRaises(RuntimeError):
+                await cache.get_token("scope")
+            credential.fail = False
+            self.assertEqual((await cache.get_token("scope")).token, "token2")
+
+    async def test_sync_credential(self):
+        """Test that the synchronous credential is called outside of the event loop thread."""
+        credential = SyncCredential()
+        async with CachingTokenCredential(credential) as cache:
+            self.assertEqual((await cache.get_token("scope")).token, "sync")
+        self.assertIsNot(credential.threads[0], threading.current_thread())
+
+
+if __name__ == "__main__":
+    unittest.main()